@@ -0,0 +1,39 @@
+import numpy as np
+
+from data_handle.image_stack import channel_view
+
+'''
+Agent-centric crop of image stacks.
+
+A fixed-size window centred at the current position of the agent (the last point of "traj") is cut out of
+the stacked frames, so the network only sees the neighbourhood relevant for the next seconds of motion.
+Labels are then relative to the current position (sample['centre']), add it back to get world coordinates.
+Constant channels (the T plane) should be filled after cropping, the padding would overwrite them otherwise.
+'''
+
+def crop_stack(input_img, centre, crop_size, channels_first=False, pad_value=255):
+    '''
+    Description:
+        Crop a window out of an image stack, the parts outside of the image are filled with "pad_value".
+    Arguments:
+        input_img (HxWxC or CxHxW) - The image stack.
+        centre    (x, y)           - Centre of the window in pixels.
+        crop_size (h, w)           - Size of the window in pixels.
+        pad_value <scalar or C>    - Per channel or for all, the default is free space (white) in SID.
+    Return:
+        crop   (hxwxC or Cxhxw) - The window (same layout and dtype).
+        origin (x, y)           - Position of the top-left corner of the window in the image (pixels).
+    '''
+    channels = channel_view(input_img, channels_first)
+    C, H, W = channels.shape
+    h, w = crop_size
+    crop = np.empty([C,h,w] if channels_first else [h,w,C], dtype=input_img.dtype)
+    crop_channels = channel_view(crop, channels_first)
+    crop_channels[:] = np.reshape(pad_value, (-1,1,1))
+
+    x0, y0 = int(round(centre[0]))-w//2, int(round(centre[1]))-h//2
+    sx0, sx1 = max(x0, 0), min(x0+w, W)
+    sy0, sy1 = max(y0, 0), min(y0+h, H)
+    if (sx0<sx1) & (sy0<sy1):
+        crop_channels[:, sy0-y0:sy1-y0, sx0-x0:sx1-x0] = channels[:, sy0:sy1, sx0:sx1]
+    return crop, np.array([x0, y0])
@@ -0,0 +1,108 @@
+import torch
+import torch.nn.functional as F
+
+from data_handle.heatmap import gaussian_maps_torch
+
+'''
+Transforms on collated batches (dicts of tensors), used by "DataHandler(batch_transform=...)".
+They run once per batch after collation, instead of once per sample in the workers.
+Several of them can be chained with "torchvision.transforms.Compose".
+'''
+
+def float_image(image):
+    if not torch.is_floating_point(image): # compact (uint8) batch
+        return image.float()
+    return image
+
+
+class ObjectHeatmaps(object):
+    '''
+    Insert the object heatmaps of SDD samples loaded with "defer_obj_maps=True".
+    The image channels [f0, f1, ..., (T)] become [f0, map0, f1, map1, ..., (T)],
+    the same layout as the maps rendered in the dataset.
+    With "crop_size", the maps are windows of the full-frame maps (sample['crop_origin'] and sample['frame_shape']).
+    '''
+    def __init__(self, sigmas=(20,20), truncate=None, device=None):
+        super().__init__()
+        self.sigmas = sigmas
+        self.truncate = truncate
+        self.device = device
+
+    def __call__(self, sample_batch):
+        image, coords = sample_batch['image'], sample_batch['obj_coords'] # BxCxHxW, BxKx2
+        if self.device is not None:
+            image, coords = image.to(self.device), coords.to(self.device)
+        image = float_image(image)
+        B, K = coords.shape[:2]
+        H, W = image.shape[-2:]
+        origin, frame_shape = None, None
+        if 'crop_origin' in sample_batch:
+            origin = sample_batch['crop_origin'].to(coords.device).float()
+            frame_shape = sample_batch['frame_shape'][0].tolist() # the same for all samples
+            coords = coords + origin.unsqueeze(1) # in the frames
+        maps = gaussian_maps_torch(coords.float(), (H,W), self.sigmas, self.truncate, origin, frame_shape).to(image.dtype)
+        stack = torch.stack((image[:,:K], maps), dim=2).reshape(B, 2*K, H, W)
+        sample_batch['image'] = torch.cat((stack, image[:,K:]), dim=1)
+        return sample_batch
+
+class BatchRescale(object):
+    '''
+    Batched version of "Rescale": resize BxCxHxW images by bilinear interpolation.
+    With "antialias" the downsampling is smoothed like "skimage.transform.resize".
+    '''
+    def __init__(self, output_size, tolabel=False, antialias=True):
+        super().__init__()
+        assert isinstance(output_size, tuple)
+        self.output_size = output_size
+        self.tolabel = tolabel
+        self.antialias = antialias
+
+    def __call__(self, sample_batch):
+        image, label = float_image(sample_batch['image']), sample_batch['label']
+        h, w = image.shape[-2:]
+        h_new, w_new = self.output_size
+        sample_batch['image'] = F.interpolate(image, size=(h_new,w_new), mode='bilinear', align_corners=False, antialias=self.antialias)
+        if self.tolabel:
+            sample_batch['label'] = label * label.new_tensor([w_new/w, h_new/h])
+        return sample_batch
+
+class BatchToGray(object):
+    '''
+    Batched version of "ToGray": the channels are taken as consecutive RGB triplets,
+    each of them becomes one gray channel (Bx3KxHxW -> BxKxHxW).
+    For RGB the weight could be (0.299R, 0.587G, 0.114B)
+    '''
+    def __init__(self, weight=None):
+        super().__init__()
+        weight = (1,1,1) if weight is None else weight
+        assert (len(weight)==3)
+        self.weight = torch.tensor(weight, dtype=torch.float32) / sum(weight)
+
+    def __call__(self, sample_batch):
+        image = float_image(sample_batch['image'])
+        B, C, H, W = image.shape
+        if C == 1:
+            return sample_batch
+        if C % 3:
+            raise ValueError(f'The number of channels ({C}) is not a multiple of 3.')
+        weight = self.weight.to(device=image.device, dtype=image.dtype)
+        sample_batch['image'] = torch.einsum('bkchw,c->bkhw', image.view(B, C//3, 3, H, W), weight)
+        return sample_batch
+
+class BatchMaxNormalize(object):
+    '''
+    Batched version of "MaxNormalize": divide each channel by its maximal pixel value, and the label by the maximal label.
+    Both can be a number or a sequence (per channel / per axis).
+    '''
+    def __init__(self, max_pixel=255, max_label=10):
+        super().__init__()
+        self.mp = max_pixel
+        self.ml = max_label
+
+    def __call__(self, sample_batch):
+        image, label = float_image(sample_batch['image']), sample_batch['label']
+        mp = torch.as_tensor(self.mp, dtype=image.dtype, device=image.device)
+        sample_batch['image'] = image / mp.view(1,-1,1,1) if mp.dim() else image / mp
+        if self.ml is not None:
+            sample_batch['label'] = label / torch.as_tensor(self.ml, dtype=label.dtype, device=label.device)
+        return sample_batch
@@ -1,19 +1,46 @@
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 import torch
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, Subset, random_split
+from torch.utils.data import Sampler, RandomSampler, SequentialSampler
 
 from skimage import io, transform
 
+from data_handle.frame_cache import FrameLRUCache, to_uint8
+from data_handle.heatmap import gaussian_maps
+from data_handle.sid_raster import SIDRasterizer, world2pixel, pixel_scale
+from data_handle.agent_crop import crop_stack
+from data_handle.image_stack import alloc_image_stack, channel_view
+from data_handle.sample_index import SampleIndex, file_signature
+
 
 class DataHandler():
-    def __init__(self, dataset, batch_size=64, shuffle=True, validation_prop=0.2, validation_cache=64):
+    def __init__(self, dataset, batch_size=64, shuffle=True, validation_prop=0.2, validation_cache=64,
+                 num_workers=0, pin_memory=None, persistent_workers=True, prefetch_factor=2, batch_transform=None, read_ahead=0, scalar_T=None):
+        '''
+        Args:
+            num_workers: Number of loading processes for the training loader, 0 to load in the main process.
+                         If 'auto', it is tuned by the number of available CPU cores ("auto_num_workers"),
+                         the main script then needs an "if __name__ == '__main__'" guard (spawn start method).
+                         The validation loader gets a quarter of them (at least 1).
+            read_ahead: Number of upcoming samples whose frames are read in advance by the I/O threads of the dataset
+                        (only with num_workers=0 and a dataset with "io_threads>0", see "ReadAheadSampler").
+            pin_memory: Pin the batches in page-locked memory. If None, only when CUDA is available.
+            persistent_workers: Keep the workers alive between epochs (only for num_workers>0).
+            prefetch_factor: Number of batches loaded in advance by each worker (only for num_workers>0).
+            batch_transform: Applied to each collated batch (dict) before returning it, see "batch_transform".
+            scalar_T: Return the network input as (image, T) (see "T_channel='scalar'" of the datasets).
+                      If None, it follows "dataset.with_T".
+        '''
         self.__val_p = validation_prop
         self.dataset = dataset
+        self.batch_transform = batch_transform
+        self.scalar_T = (getattr(dataset, 'with_T', False) == 'scalar') if scalar_T is None else scalar_T
         if 0<validation_prop<1:
             self.split_dataset()
         else:
@@ -21,13 +48,40 @@ class DataHandler():
             self.dataset_val = []
             self.dl_val = []
 
-        self.dl = DataLoader(self.dataset_train, batch_size, shuffle) # create the dataloader from the dataset
+        if num_workers == 'auto':
+            num_workers = self.auto_num_workers()
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        self.num_workers = num_workers
+        self.loader_kwargs = {'pin_memory':pin_memory, 'persistent_workers':persistent_workers, 'prefetch_factor':prefetch_factor}
+
+        if (read_ahead > 0) and (num_workers == 0):
+            sampler = RandomSampler(self.dataset_train) if shuffle else SequentialSampler(self.dataset_train)
+            sampler = ReadAheadSampler(sampler, self.dataset_train, read_ahead)
+            self.dl = DataLoader(self.dataset_train, batch_size, sampler=sampler, **self.return_loader_kwargs(num_workers))
+        else:
+            self.dl = DataLoader(self.dataset_train, batch_size, shuffle, **self.return_loader_kwargs(num_workers)) # create the dataloader from the dataset
         self.__iter = iter(self.dl)
 
         if self.dataset_val:
-            self.dl_val = DataLoader(self.dataset_val, batch_size=validation_cache, shuffle=shuffle)
+            self.dl_val = DataLoader(self.dataset_val, batch_size=validation_cache, shuffle=shuffle, **self.return_loader_kwargs(max(num_workers//4, min(num_workers,1))))
             self.__iter_val = iter(self.dl_val)
 
+    @staticmethod
+    def auto_num_workers(max_workers=16):
+        try:
+            ncpu = len(os.sched_getaffinity(0)) # cores available to this process
+        except AttributeError:
+            ncpu = os.cpu_count() or 1
+        return max(min(ncpu-1, max_workers), 0) # leave one core for the main process
+
+    def return_loader_kwargs(self, num_workers):
+        kwargs = {'num_workers':num_workers, 'pin_memory':self.loader_kwargs['pin_memory']}
+        if num_workers > 0:
+            kwargs['persistent_workers'] = self.loader_kwargs['persistent_workers']
+            kwargs['prefetch_factor'] = self.loader_kwargs['prefetch_factor']
+        return kwargs
+
     def split_dataset(self):
         ntraining = int(self.return_length_ds(whole_dataset=True) * (1-self.__val_p))
         nval = self.return_length_ds(whole_dataset=True) - ntraining
@@ -39,7 +93,9 @@ class DataHandler():
         except StopIteration:
             self.reset_iter()
             sample_batch = next(self.__iter)
-        return sample_batch['image'], sample_batch['label']
+        if self.batch_transform is not None:
+            sample_batch = self.batch_transform(sample_batch)
+        return self.return_input(sample_batch), sample_batch['label']
 
     def return_val(self):
         try:
@@ -47,11 +103,17 @@ class DataHandler():
         except StopIteration:
             self.__iter_val = iter(self.dl_val)
             sample_batch = next(self.__iter_val)
-        image, label = sample_batch['image'], sample_batch['label']
-        if len(image.shape)==3:
-            image = image.unsqueeze(0)
-            label = label.unsqueeze(0)
-        return image, label
+        if self.batch_transform is not None:
+            sample_batch = self.batch_transform(sample_batch)
+        if len(sample_batch['image'].shape)==3:
+            sample_batch = {k:v.unsqueeze(0) for k,v in sample_batch.items() if k in ['image', 'label', 'T']}
+        return self.return_input(sample_batch), sample_batch['label']
+
+    def return_input(self, sample_batch):
+        # The network input, (image, T) if the horizon is a scalar input.
+        if self.scalar_T:
+            return sample_batch['image'], sample_batch['T']
+        return sample_batch['image']
 
     def reset_iter(self):
         self.__iter = iter(self.dl)
@@ -66,74 +128,195 @@ class DataHandler():
         return len(self.dl) # the number of batches, only for training dataset
 
 
+class ReadAheadSampler(Sampler):
+    def __init__(self, sampler, dataset, read_ahead):
+        '''
+        Args:
+            sampler: The sampler to wrap (indices into "dataset").
+            dataset: A dataset with "prefetch" (e.g. "ImageStackDataset(io_threads>0)"), or a subset of it.
+            read_ahead: Number of upcoming indices passed to "prefetch".
+        Notes:
+            The reads are issued in the process iterating the sampler, so only useful with num_workers=0.
+            With workers, "ImageStackDataset.__getitems__" already reads a whole batch concurrently.
+        '''
+        self.sampler = sampler
+        self.dataset = dataset
+        self.read_ahead = read_ahead
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        for i, idx in enumerate(indices):
+            self.prefetch(indices[i:i+1+self.read_ahead])
+            yield idx
+
+    def prefetch(self, indices):
+        dataset = self.dataset
+        while isinstance(dataset, Subset): # map to the indices of the full dataset
+            indices = [dataset.indices[i] for i in indices]
+            dataset = dataset.dataset
+        dataset.prefetch(indices)
+
+
 class ImageStackDataset(Dataset):
-    def __init__(self, csv_path, root_dir, channel_per_image, transform=None, T_channel=False):
+    def __init__(self, csv_path, root_dir, channel_per_image, transform=None, T_channel=False, cache_bytes=0,
+                 index_path=None, save_index=True, compact=False, channels_first=False, io_threads=0, read_ahead=None, render_obj=False, crop_size=None, crop_pad=255, extent=(0,10,0,10), dots_per_inch=None):
         '''
         Args:
             csv_path: Path to the CSV file with dataset info.
             root_dir: Directory with all image folders.
                       root_dir - obj_folder - obj & env
+            T_channel: If true, the horizon T is appended as a constant image channel.
+                       If 'scalar', it is only returned as sample['T'] (for the networks with "T_embed").
+            cache_bytes: Memory budget of the decoded-frame cache shared by all workers, 0 to disable.
+            index_path: Path to the NPZ file of the columnar sample index (see "sample_index").
+                        If None, it is next to the CSV file.
+            save_index: Save the index if it is (re)built from the CSV file.
+            compact: If true, the image stack stays uint8 (frames and T channel), the conversion to float is done per batch.
+                     Transforms must keep the dtype (e.g. "ToTensor").
+            channels_first: If true, the image stack is C x H x W (use "ToTensor(channels_first=True)").
+            io_threads: Number of threads (per process) reading the frames concurrently, 0 to read them one by one.
+                        All channels of a sample (or of a batch, see "__getitems__") are submitted at once.
+            read_ahead: Maximal number of samples read in advance by "prefetch". If None, 2*io_threads.
+            render_obj: If true (only cpi=2), the object channels are rendered from the positions in the image names
+                        (see "sid_raster") instead of being read, the object images are not needed.
+            crop_size: If given (h, w), the image stack is cropped around the current position of the agent
+                       and the label is relative to it (see "agent_crop"), sample['centre'] is the position.
+            crop_pad: Pixel value outside of the image in the crop, the default is free space (white).
+            extent: The area (x_min, x_max, y_min, y_max) in meters covered by the images (for "crop_size" and "render_obj").
+            dots_per_inch: Resolution of the matplotlib images, as in "utils_data.save_SID_data" (for "crop_size" and "render_obj").
         '''
         super().__init__()
-        self.info_frame = pd.read_csv(csv_path)
         self.root_dir = root_dir
         self.tr = transform
         self.with_T = T_channel
+        self.T_plane = (T_channel is True) # T as a constant image channel
         self.cpi = channel_per_image
-
-        self.nc = len(list(self.info_frame))-4 # number of image channels in total
+        self.io_threads = io_threads
+        self.read_ahead = 2*io_threads if read_ahead is None else read_ahead
+        self._pool = None
+        self._pool_pid = None
+        self._pending = {} # idx: futures of the frames read in advance
+        self.compact = compact
+        self.channels_first = channels_first
+        self.crop_size = crop_size
+        self.crop_pad = crop_pad
+        self.extent = extent
+
+        if index_path is None:
+            index_path = os.path.splitext(csv_path)[0] + '_index.npz'
+        signature = {**file_signature(csv_path), 'root_dir':root_dir, 'cpi':channel_per_image}
+        self.index = SampleIndex.load(index_path, signature)
+        if self.index is None:
+            info_frame = pd.read_csv(csv_path)
+            self.index = SampleIndex.from_info_frame(info_frame, channel_per_image, self.get_img_path, signature)
+            if save_index:
+                self.index.save(index_path)
+
+        self.nc = self.index.frame_ids.shape[1] # number of image channels in total
         self.img_shape = self.check_img_shape()
+        self.scale = pixel_scale(self.img_shape, extent, dots_per_inch) # pixels per meter, as in "SIDRasterizer"
+        self.obj_raster = None
+        if render_obj:
+            if self.cpi != 2:
+                raise ValueError('Object channels can only be rendered with cpi=2.')
+            self.obj_raster = SIDRasterizer(self.img_shape, extent=extent, target_size=0.5, dots_per_inch=dots_per_inch) # as in "utils_data.save_SID_data"
+
+        self.cache = None
+        if cache_bytes > 0:
+            self.cache = FrameLRUCache(self.index.paths.tolist(), self.img_shape, cache_bytes,
+                                       dtype=np.uint8 if self.compact else self.frame_dtype)
 
     def __len__(self):
-        return len(self.info_frame)
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None # threads are not shared with the workers
+        state['_pending'] = {}
+        return state
+
+    @property
+    def pool(self):
+        if (self._pool is None) or (self._pool_pid != os.getpid()):
+            self._pool = ThreadPoolExecutor(max_workers=self.io_threads)
+            self._pool_pid = os.getpid()
+            self._pending = {}
+        return self._pool
 
     def __getitem__(self,idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        input_img = np.empty(shape=[self.img_shape[0],self.img_shape[1],0])
-        info = self.info_frame.iloc[idx]
-        self.T = info['T']
-        index = info['index']
-        traj = []
-        for i in range(self.nc):
-            img_name = info['f{}'.format(i)]
-            obj_id = img_name.split('_')[0]
-
-            if self.cpi == 1:
-                img_path = os.path.join(self.root_dir, obj_id, img_name)
-                this_x = float(img_name[:-4].split('_')[2])
-                this_y = float(img_name[:-4].split('_')[3])
-                traj.append([this_x,this_y])
-            elif self.cpi == 2:
-                if len(img_name.split('_'))==5:
-                    img_path = os.path.join(self.root_dir, obj_id, 'obj', img_name)
-                    time_step = int(img_name[:-4].split('_')[1])
-                    this_x = float(img_name[:-4].split('_')[2])
-                    this_y = float(img_name[:-4].split('_')[3])
-                    traj.append([this_x,this_y])
-                else:
-                    img_path = os.path.join(self.root_dir, obj_id, 'env', img_name)
-
-            image = self.togray(io.imread(img_path))
-            input_img = np.concatenate((input_img, image[:,:,np.newaxis]), axis=2)
-
-        if self.with_T:
-            T_channel = np.ones(shape=[self.img_shape[0],self.img_shape[1],1])*self.T # T_channel
-            input_img = np.concatenate((input_img, T_channel), axis=2)                # T_channel
-
-        label = {'x':info['x'], 'y':info['y']}
+        if self.io_threads > 0:
+            frames = [f.result() for f in self.submit_frames(idx)]
+        else:
+            frames = [self.load_channel(idx, i, frame_id) for i, frame_id in enumerate(self.index.frame_ids[idx])]
+        return self.stack_sample(idx, frames)
+
+    def __getitems__(self, indices):
+        # Used by the DataLoader to fetch a batch, all frames of the batch are submitted before waiting.
+        if self.io_threads == 0:
+            return [self[idx] for idx in indices]
+        futures = [self.submit_frames(idx) for idx in indices]
+        return [self.stack_sample(idx, [f.result() for f in fs]) for idx, fs in zip(indices, futures)]
+
+    def submit_frames(self, idx):
+        # Return the futures of all channels of a sample (in order), reuse those read in advance.
+        futures = self._pending.pop(idx, None)
+        if futures is None:
+            futures = [self.pool.submit(self.load_channel, idx, i, frame_id) for i, frame_id in enumerate(self.index.frame_ids[idx])]
+        return futures
+
+    def prefetch(self, indices):
+        # Start reading the frames of the upcoming samples (bounded by "read_ahead").
+        if self.io_threads == 0:
+            return
+        for idx in indices:
+            if len(self._pending) >= self.read_ahead:
+                break
+            if idx not in self._pending:
+                self._pending[idx] = self.submit_frames(idx)
+
+    def stack_sample(self, idx, frames):
+        self.T = self.index.T[idx]
+        index = self.index.index[idx]
+        input_img, channels = alloc_image_stack(self.img_shape, self.nc+int(self.T_plane),
+                                                np.uint8 if self.compact else np.float64, self.channels_first)
+        for i, image in enumerate(frames):
+            channels[i] = to_uint8(image) if self.compact else image
+
+        label = {'x':self.index.label[idx,0], 'y':self.index.label[idx,1]}
+        if self.crop_size is not None:
+            centre = self.index.traj[idx,-1] # current position
+            input_img, _ = crop_stack(input_img, world2pixel(centre, self.img_shape, self.extent, self.scale), self.crop_size, self.channels_first, self.crop_pad)
+            label = {'x':label['x']-centre[0], 'y':label['y']-centre[1]}
+
+        if self.T_plane: # after cropping, the whole plane is T
+            channel_view(input_img, self.channels_first)[-1] = self.T # T_channel
         sample = {'image':input_img, 'label':label}
 
         if self.tr:
             sample = self.tr(sample)
 
         sample['index'] = index
-        sample['traj'] = traj
-        sample['time'] = time_step
+        if self.with_T == 'scalar':
+            sample['T'] = self.T
+        sample['traj'] = self.index.traj[idx].tolist()
+        if self.crop_size is not None:
+            sample['centre'] = self.index.traj[idx,-1]
+        sample['time'] = self.index.time[idx]
 
         return sample
 
+    def load_channel(self, idx, i, frame_id):
+        # Channel i of sample idx, the object channels are rendered if "render_obj".
+        if (self.obj_raster is not None) and (i%2 == 0):
+            return self.obj_raster.render_obj(self.index.traj[idx, i//2])
+        return self.read_frame(self.index.paths[frame_id])
+
     def togray(self, image):
         if (len(image.shape)==2):
             return image
@@ -144,87 +327,140 @@ class ImageStackDataset(Dataset):
             img = image[:,:,0]/3 + image[:,:,1]/3 + image[:,:,2]/3
             return img
 
-    def check_img_shape(self):
-        info = self.info_frame.iloc[0]
-        img_name = info['f0']
-        obj_id = img_name.split('_')[0]
+    def read_frame(self, img_path):
+        if self.cache is not None:
+            return self.cache.get(img_path, lambda: self.togray(io.imread(img_path)))
+        return self.togray(io.imread(img_path))
 
+    def get_img_path(self, img_name):
+        obj_id = img_name.split('_')[0]
         if self.cpi == 1:
             img_path = os.path.join(self.root_dir, obj_id, img_name)
         elif self.cpi == 2:
-            img_path = os.path.join(self.root_dir, obj_id, 'obj', img_name)
+            if len(img_name.split('_'))==5:
+                img_path = os.path.join(self.root_dir, obj_id, 'obj', img_name)
+            else:
+                img_path = os.path.join(self.root_dir, obj_id, 'env', img_name)
+        return img_path
 
+    def check_img_shape(self):
+        img_path = self.index.paths[self.index.frame_ids[0,-1]] # env image if cpi=2
         image = self.togray(io.imread(img_path))
+        self.frame_dtype = image.dtype # decoded dtype (uint8, or float if converted from RGB)
         return image.shape
 
 class ImageStackDatasetSDD(Dataset):
-    def __init__(self, csv_path, root_dir, ext='.jpg', transform=None, T_channel=False):
+    def __init__(self, csv_path, root_dir, ext='.jpg', transform=None, T_channel=False, cache_bytes=0,
+                 defer_obj_maps=False, obj_truncate=None, compact=False, channels_first=False, crop_size=None, crop_pad=255,
+                 index_path=None, save_index=True):
         '''
         Args:
             csv_path: Path to the CSV file with dataset info.
             root_dir: Directory with all image folders.
                       root_dir - video_folder - imgs
+            T_channel: If true, the horizon T is appended as a constant image channel.
+                       If 'scalar', it is only returned as sample['T'] (for the networks with "T_embed").
+            cache_bytes: Memory budget of the decoded-frame cache shared by all workers, 0 to disable.
+            defer_obj_maps: If true, the object heatmaps are not rendered here, but after collation
+                            by "batch_transform.ObjectHeatmaps" from sample['obj_coords'] (in pixels).
+                            With "crop_size", sample['crop_origin'] and sample['frame_shape'] are added for them.
+            obj_truncate: Radius (in sigmas) of the rendered heatmap patch, None for the whole map.
+            compact: If true, the image stack stays uint8 (frames and T channel, only with deferred heatmaps), the conversion to float is done per batch.
+                     Transforms must keep the dtype (e.g. "ToTensor").
+            channels_first: If true, the image stack is C x H x W (use "ToTensor(channels_first=True)").
+            crop_size: If given (h, w), the image stack is cropped around the current position of the agent
+                       and the label is relative to it (see "agent_crop"), sample['centre'] is the position.
+            crop_pad: Pixel value of the frames outside of the image in the crop (the heatmaps are padded with 0).
+            index_path: Path to the NPZ file of the columnar sample index (see "sample_index").
+                        If None, it is next to the CSV file.
+            save_index: Save the index if it is (re)built from the CSV file.
         '''
         super().__init__()
-        self.info_frame = pd.read_csv(csv_path)
         self.root_dir = root_dir
         self.tr = transform
         self.with_T = T_channel
+        self.T_plane = (T_channel is True) # T as a constant image channel
         self.ext = ext
-
-        self.nc = len(list(self.info_frame))-5 # number of image channels in half
+        self.defer_obj_maps = defer_obj_maps
+        self.obj_sigmas = [20,20]
+        self.obj_truncate = obj_truncate
+        self.compact = compact
+        self.channels_first = channels_first
+        self.crop_size = crop_size
+        self.crop_pad = crop_pad
+        if compact & (not defer_obj_maps):
+            raise ValueError('The compact mode needs deferred object heatmaps (defer_obj_maps=True).')
+
+        if index_path is None:
+            index_path = os.path.splitext(csv_path)[0] + '_index.npz'
+        signature = {**file_signature(csv_path), 'root_dir':root_dir, 'ext':ext}
+        self.index = SampleIndex.load(index_path, signature)
+        if self.index is None:
+            info_frame = pd.read_csv(csv_path)
+            self.index = SampleIndex.from_sdd_info_frame(info_frame, len(list(info_frame))-5, self.get_img_path, signature)
+            if save_index:
+                self.index.save(index_path)
+
+        self.nc = self.index.frame_ids.shape[1] # number of image channels in half
         self.img_shape = self.check_img_shape()
+        self.obj_coords = self.index.traj * self.pixel_scale()[:,np.newaxis,:] # N x nc x 2, positions in the frames (pixels)
+
+        self.cache = None
+        if cache_bytes > 0:
+            self.cache = FrameLRUCache(self.index.paths.tolist(), self.img_shape, cache_bytes,
+                                       dtype=np.uint8 if self.compact else self.frame_dtype)
 
         # print(self.img_shape)
 
     def __len__(self):
-        return len(self.info_frame)
+        return len(self.index)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        input_img = np.empty(shape=[self.img_shape[0],self.img_shape[1],0])
-        info = self.info_frame.iloc[idx]
-        T = info['T']
-        index = info['index']
-        traj = []
-        for i in range(self.nc):
-            img_name = info[f't{i}'].split('_')[0] + self.ext
-            video_idx = info['index']
-
-            img_path = os.path.join(self.root_dir, video_idx, img_name)
-
-            csv_name = glob.glob(os.path.join(self.root_dir, video_idx, '*.csv'))
-            original_scale = os.path.basename(csv_name[0]).split('.')[0]
-            original_scale = (int(original_scale.split('_')[0]), int(original_scale.split('_')[1])) # HxW
-
-            time_step = int(info[f't{i}'].split('_')[0])
-            this_x = float(info[f't{i}'].split('_')[1])
-            this_y = float(info[f't{i}'].split('_')[2])
-            traj.append([this_x,this_y])
-
-            image = self.togray(io.imread(img_path))
-            input_img = np.concatenate((input_img, image[:,:,np.newaxis]), axis=2)
-
-            white_canvas = np.zeros_like(image)
-            obj_coords = self.rescale_label((this_x, this_y), original_scale)
-            obj_map = self.np_gaudist_map(obj_coords, white_canvas, sigmas=[20,20])
-            input_img = np.concatenate((input_img, obj_map[:,:,np.newaxis]), axis=2)
-
-        if self.with_T:
-            T_channel = np.ones(shape=[self.img_shape[0],self.img_shape[1],1])*T # T_channel
-            input_img = np.concatenate((input_img, T_channel), axis=2)           # T_channel
-
-        label = {'x':info['x'], 'y':info['y']}
+        self.T = self.index.T[idx]
+        index = self.index.index[idx]
+        traj = self.index.traj[idx]
+        obj_coords = self.obj_coords[idx]
+        step = 1 if self.defer_obj_maps else 2 # frame (and heatmap) per position
+        input_img, channels = alloc_image_stack(self.img_shape, step*self.nc+int(self.T_plane),
+                                                np.uint8 if self.compact else np.float64, self.channels_first)
+        for i, frame_id in enumerate(self.index.frame_ids[idx]):
+            image = self.read_frame(self.index.paths[frame_id])
+            channels[step*i] = to_uint8(image) if self.compact else image
+
+        if not self.defer_obj_maps:
+            channels[1:2*self.nc:2] = gaussian_maps(obj_coords[np.newaxis,:], self.img_shape, self.obj_sigmas, self.obj_truncate)[0]
+
+        label = {'x':self.index.label[idx,0], 'y':self.index.label[idx,1]}
+        if self.crop_size is not None:
+            centre = traj[-1] # current position
+            pad = np.zeros(len(channels)) # the heatmaps (and T) are padded with 0
+            pad[0:step*self.nc:step] = self.crop_pad
+            input_img, origin = crop_stack(input_img, obj_coords[-1], self.crop_size, self.channels_first, pad)
+            obj_coords = obj_coords - origin # in the crop
+            label = {'x':label['x']-centre[0], 'y':label['y']-centre[1]}
+
+        if self.T_plane: # after cropping, the whole plane is T
+            channel_view(input_img, self.channels_first)[-1] = self.T # T_channel
         sample = {'image':input_img, 'label':label}
 
         if self.tr:
             sample = self.tr(sample)
 
         sample['index'] = index
-        sample['traj'] = traj
-        sample['time'] = time_step
+        if self.with_T == 'scalar':
+            sample['T'] = self.T
+        sample['traj'] = traj.tolist()
+        if self.crop_size is not None:
+            sample['centre'] = traj[-1]
+        if self.defer_obj_maps:
+            sample['obj_coords'] = np.array(obj_coords)
+            if self.crop_size is not None: # for the heatmaps of "batch_transform.ObjectHeatmaps"
+                sample['crop_origin'] = origin
+                sample['frame_shape'] = np.array(self.img_shape)
+        sample['time'] = self.index.time[idx]
 
         return sample
 
@@ -247,7 +483,7 @@ class ImageStackDatasetSDD(Dataset):
             return z/z.max()
 
     def rescale_label(self, label, original_scale): # x,y & HxW
-        current_scale = self.check_img_shape()
+        current_scale = self.img_shape
         rescale = (current_scale[0]/original_scale[0] , current_scale[1]/original_scale[1])
         return (label[0]*rescale[1], label[1]*rescale[0])
 
@@ -261,12 +497,29 @@ class ImageStackDatasetSDD(Dataset):
             img = image[:,:,0]/3 + image[:,:,1]/3 + image[:,:,2]/3
             return img
 
+    def read_frame(self, img_path):
+        if self.cache is not None:
+            return self.cache.get(img_path, lambda: self.togray(io.imread(img_path)))
+        return self.togray(io.imread(img_path))
+
+    def pixel_scale(self):
+        # Scale (x, y) of each sample from the original video (HxW in the name of the video's CSV file) to the frames.
+        scales = {}
+        for video_idx in np.unique(self.index.index):
+            csv_name = glob.glob(os.path.join(self.root_dir, video_idx, '*.csv'))
+            original_scale = os.path.basename(csv_name[0]).split('.')[0]
+            original_scale = (int(original_scale.split('_')[0]), int(original_scale.split('_')[1])) # HxW
+            scales[video_idx] = (self.img_shape[1]/original_scale[1], self.img_shape[0]/original_scale[0])
+        return np.array([scales[video_idx] for video_idx in self.index.index])
+
+    def get_img_path(self, video_idx, t_info):
+        img_name = t_info.split('_')[0] + self.ext
+        return os.path.join(self.root_dir, video_idx, img_name)
+
     def check_img_shape(self):
-        info = self.info_frame.iloc[0]
-        img_name = info['t0'].split('_')[0] + self.ext
-        video_folder = info['index']
-        img_path = os.path.join(self.root_dir, video_folder, img_name)
+        img_path = self.index.paths[self.index.frame_ids[0,0]]
         image = self.togray(io.imread(img_path))
+        self.frame_dtype = image.dtype # decoded dtype (uint8, or float if converted from RGB)
         return image.shape
 
 
@@ -323,12 +576,16 @@ class DelAlpha(object):
 
 class ToTensor(object):
     """Convert ndarrays in sample to Tensors."""
+    def __init__(self, channels_first=False):
+        super().__init__()
+        self.channels_first = channels_first # the image is already C x H x W
 
     def __call__(self, sample):
         image, label = sample['image'], sample['label']
         label = np.array([label['x'],label['y']])
         # swap color axis, numpy: H x W x C -> torch: C X H X W
-        image = image.transpose((2, 0, 1))
+        if not self.channels_first:
+            image = image.transpose((2, 0, 1))
         return {'image': torch.from_numpy(image),
                 'label': torch.from_numpy(label)}
 
@@ -340,12 +597,11 @@ class MaxNormalize(object):
 
     def __call__(self, sample):
         image, label = sample['image'], sample['label']
-        if not isinstance(self.mp, (tuple,list)):
-            self.mp = [self.mp]*image.shape[2]
+        mp = self.mp if isinstance(self.mp, (tuple,list)) else [self.mp]*image.shape[2]
         for i in range(image.shape[2]):
-            image[:,:,:i] = image[:,:,:i]/self.mp[i]
+            image[:,:,i] = image[:,:,i]/mp[i]
         if self.ml is not None:
-            if self.ml is tuple:
+            if isinstance(self.ml, tuple):
                 label['x'], label['y'] = label['x']/self.ml[0], label['y']/self.ml[1]
             else:
                 label['x'], label['y'] = label['x']/self.ml, label['y']/self.ml
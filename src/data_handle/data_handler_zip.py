@@ -4,17 +4,47 @@ import numpy as np
 import pandas as pd
 
 import torch
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Subset, random_split
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
 
 from skimage import io, transform
 
 import zipfile
 
+from data_handle.frame_cache import FrameStore, FrameLRUCache, archive_signature, to_uint8
+from data_handle.sample_index import SampleIndex
+from data_handle.heatmap import gaussian_maps
+from data_handle.sid_raster import SIDRasterizer, world2pixel, pixel_scale
+from data_handle.agent_crop import crop_stack
+from data_handle.image_stack import alloc_image_stack, channel_view
+
 
 class DataHandler():
-    def __init__(self, dataset, batch_size=64, shuffle=True, validation_prop=0.2, validation_cache=64):
+    def __init__(self, dataset, batch_size=64, shuffle=True, validation_prop=0.2, validation_cache=64,
+                 num_workers=0, pin_memory=None, persistent_workers=True, prefetch_factor=2, batch_transform=None, batched=False, scalar_T=None):
+        '''
+        Args:
+            num_workers: Number of loading processes for the training loader, 0 to load in the main process.
+                         If 'auto', it is tuned by the number of available CPU cores ("auto_num_workers"),
+                         the main script then needs an "if __name__ == '__main__'" guard (spawn start method).
+                         The validation loader gets a quarter of them (at least 1).
+            pin_memory: Pin the batches in page-locked memory. If None, only when CUDA is available.
+            persistent_workers: Keep the workers alive between epochs (only for num_workers>0).
+            prefetch_factor: Number of batches loaded in advance by each worker (only for num_workers>0).
+            batch_transform: Applied to each collated batch (dict) before returning it, see "batch_transform".
+            batched: Load whole batches with "dataset.get_batch" (see "BatchedDataset") instead of
+                     per-sample "__getitem__" and the default collate.
+            scalar_T: Return the network input as (image, T) (see "T_channel='scalar'" of the datasets).
+                      If None, it follows "dataset.with_T".
+        '''
         self.__val_p = validation_prop
         self.dataset = dataset
+        self.batch_transform = batch_transform
+        self.scalar_T = (getattr(dataset, 'with_T', False) == 'scalar') if scalar_T is None else scalar_T
+        self.streaming = isinstance(dataset, IterableDataset) # e.g. "shard_store.ShardedIterableDataset"
+        self.__epoch = 0
+        if self.streaming & (0<validation_prop<1):
+            raise ValueError('A streaming dataset cannot be split, set validation_prop=0 and use a separate validation set.')
         if 0<validation_prop<1:
             self.split_dataset()
         else:
@@ -22,13 +52,47 @@ class DataHandler():
             self.dataset_val = []
             self.dl_val = []
 
-        self.dl = DataLoader(self.dataset_train, batch_size, shuffle) # create the dataloader from the dataset
+        if num_workers == 'auto':
+            num_workers = self.auto_num_workers()
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        self.num_workers = num_workers
+        self.loader_kwargs = {'pin_memory':pin_memory, 'persistent_workers':persistent_workers, 'prefetch_factor':prefetch_factor}
+
+        self.dl = self.create_loader(self.dataset_train, batch_size, shuffle, num_workers, batched) # create the dataloader from the dataset
         self.__iter = iter(self.dl)
 
         if self.dataset_val:
-            self.dl_val = DataLoader(self.dataset_val, batch_size=validation_cache, shuffle=shuffle)
+            self.dl_val = self.create_loader(self.dataset_val, validation_cache, shuffle, max(num_workers//4, min(num_workers,1)), batched)
             self.__iter_val = iter(self.dl_val)
 
+    def create_loader(self, dataset, batch_size, shuffle, num_workers, batched=False):
+        if self.streaming: # shuffled by the dataset itself, new workers each epoch to pass the epoch on
+            kwargs = self.return_loader_kwargs(num_workers)
+            if num_workers > 0:
+                kwargs['persistent_workers'] = False
+            return DataLoader(dataset, batch_size, **kwargs)
+        if not batched:
+            return DataLoader(dataset, batch_size, shuffle, **self.return_loader_kwargs(num_workers))
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        sampler = BatchSampler(sampler, batch_size, drop_last=False) # each item is a list of indices
+        return DataLoader(BatchedDataset(dataset), batch_size=None, sampler=sampler, **self.return_loader_kwargs(num_workers))
+
+    @staticmethod
+    def auto_num_workers(max_workers=16):
+        try:
+            ncpu = len(os.sched_getaffinity(0)) # cores available to this process
+        except AttributeError:
+            ncpu = os.cpu_count() or 1
+        return max(min(ncpu-1, max_workers), 0) # leave one core for the main process
+
+    def return_loader_kwargs(self, num_workers):
+        kwargs = {'num_workers':num_workers, 'pin_memory':self.loader_kwargs['pin_memory']}
+        if num_workers > 0:
+            kwargs['persistent_workers'] = self.loader_kwargs['persistent_workers']
+            kwargs['prefetch_factor'] = self.loader_kwargs['prefetch_factor']
+        return kwargs
+
     def split_dataset(self):
         ntraining = int(self.return_length_ds(whole_dataset=True) * (1-self.__val_p))
         nval = self.return_length_ds(whole_dataset=True) - ntraining
@@ -40,7 +104,9 @@ class DataHandler():
         except StopIteration:
             self.reset_iter()
             sample_batch = next(self.__iter)
-        return sample_batch['image'], sample_batch['label']
+        if self.batch_transform is not None:
+            sample_batch = self.batch_transform(sample_batch)
+        return self.return_input(sample_batch), sample_batch['label']
 
     def return_val(self):
         try:
@@ -48,13 +114,22 @@ class DataHandler():
         except StopIteration:
             self.__iter_val = iter(self.dl_val)
             sample_batch = next(self.__iter_val)
-        image, label = sample_batch['image'], sample_batch['label']
-        if len(image.shape)==3:
-            image = image.unsqueeze(0)
-            label = label.unsqueeze(0)
-        return image, label
+        if self.batch_transform is not None:
+            sample_batch = self.batch_transform(sample_batch)
+        if len(sample_batch['image'].shape)==3:
+            sample_batch = {k:v.unsqueeze(0) for k,v in sample_batch.items() if k in ['image', 'label', 'T']}
+        return self.return_input(sample_batch), sample_batch['label']
+
+    def return_input(self, sample_batch):
+        # The network input, (image, T) if the horizon is a scalar input.
+        if self.scalar_T:
+            return sample_batch['image'], sample_batch['T']
+        return sample_batch['image']
 
     def reset_iter(self):
+        if self.streaming:
+            self.__epoch += 1
+            self.dataset.set_epoch(self.__epoch)
         self.__iter = iter(self.dl)
 
     def return_length_ds(self, whole_dataset=False):
@@ -67,77 +142,203 @@ class DataHandler():
         return len(self.dl) # the number of batches, only for training dataset
 
 
+class BatchedDataset(Dataset):
+    '''
+    Wrap a dataset (or a subset of it) with "get_batch(indices)", so that a DataLoader with
+    a BatchSampler and "batch_size=None" gets a whole batch per item without collating.
+    '''
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        dataset = self.dataset
+        while isinstance(dataset, Subset): # e.g. from "random_split"
+            indices = [dataset.indices[i] for i in indices]
+            dataset = dataset.dataset
+        return dataset.get_batch(indices)
+
+
 class ImageStackDataset(Dataset):
-    def __init__(self, zip_path, csv_path, root_dir, channel_per_image, transform=None, T_channel=False):
+    def __init__(self, zip_path, csv_path, root_dir, channel_per_image, transform=None, T_channel=False, cache_dir=None, cache_bytes=0,
+                 index_path=None, save_index=True, compact=False, channels_first=False, render_obj=False, crop_size=None, crop_pad=255, extent=(0,10,0,10), dots_per_inch=None):
         '''
         Args:
             zip_path: Path to the ZIP file with everything
             csv_path: Path to the CSV file with dataset info.
             root_dir: Directory with all image folders.
                       root_dir - obj_folder - obj & env
+            T_channel: If true, the horizon T is appended as a constant image channel.
+                       If 'scalar', it is only returned as sample['T'] (for the networks with "T_embed").
+            cache_dir: Directory of the pre-decoded frame store (see "frame_cache").
+                       If given, all frames are decoded once and then read from the store.
+            cache_bytes: Memory budget of the decoded-frame cache shared by all workers, 0 to disable.
+                         Not used together with the frame store.
+            index_path: Path to the NPZ file of the columnar sample index (see "sample_index").
+                        If None, it is next to the ZIP file.
+            save_index: Save the index if it is (re)built from the CSV file.
+            compact: If true, the image stack stays uint8 (frames and T channel), the conversion to float is done per batch.
+                     Transforms must keep the dtype (e.g. "ToTensor").
+            channels_first: If true, the image stack is C x H x W (use "ToTensor(channels_first=True)").
+            render_obj: If true (only cpi=2), the object channels are rendered from the positions in the image names
+                        (see "sid_raster") instead of being read, the object images are not needed.
+            crop_size: If given (h, w), the image stack is cropped around the current position of the agent
+                       and the label is relative to it (see "agent_crop"), sample['centre'] is the position.
+            crop_pad: Pixel value outside of the image in the crop, the default is free space (white).
+            extent: The area (x_min, x_max, y_min, y_max) in meters covered by the images (for "crop_size" and "render_obj").
+            dots_per_inch: Resolution of the matplotlib images, as in "utils_data.save_SID_data" (for "crop_size" and "render_obj").
         '''
         super().__init__()
-        self.archive = zipfile.ZipFile(zip_path, 'r')
+        self.zip_path = zip_path
+        self._archive = None # opened lazily in each process, see "archive"
 
-        self.info_frame = pd.read_csv(self.archive.open(csv_path))
         self.root_dir = root_dir
         self.tr = transform
         self.with_T = T_channel
+        self.T_plane = (T_channel is True) # T as a constant image channel
         self.cpi = channel_per_image
-
-        self.nc = len(list(self.info_frame))-4 # number of image channels in total
+        self.render_obj = render_obj
+        self.compact = compact
+        self.channels_first = channels_first
+        self.crop_size = crop_size
+        self.crop_pad = crop_pad
+        self.extent = extent
+
+        if index_path is None:
+            index_path = os.path.splitext(zip_path)[0] + '_index.npz'
+        signature = archive_signature(zip_path, csv_path, self.archive, root_dir, channel_per_image)
+        self.index = SampleIndex.load(index_path, signature)
+        if self.index is None:
+            info_frame = pd.read_csv(self.archive.open(csv_path))
+            self.index = SampleIndex.from_info_frame(info_frame, channel_per_image, self.get_img_path, signature)
+            if save_index:
+                self.index.save(index_path)
+
+        self.nc = self.index.frame_ids.shape[1] # number of image channels in total
         self.img_shape = self.check_img_shape()
+        self.scale = pixel_scale(self.img_shape, extent, dots_per_inch) # pixels per meter, as in "SIDRasterizer"
+        self.obj_raster = None
+        if render_obj:
+            if self.cpi != 2:
+                raise ValueError('Object channels can only be rendered with cpi=2.')
+            self.obj_raster = SIDRasterizer(self.img_shape, extent=extent, target_size=0.5, dots_per_inch=dots_per_inch) # as in "utils_data.save_SID_data"
+
+        self.store = None
+        self.cache = None
+        if cache_dir is not None:
+            signature = {**signature, 'render_obj':render_obj}
+            frame_ids = self.index.frame_ids[:,1::2] if render_obj else self.index.frame_ids # only the frames which are read
+            self.store = FrameStore.open(cache_dir, self.archive, self.index.paths[np.unique(frame_ids)].tolist(), signature, self.togray,
+                                         dtype=np.uint8 if self.compact else self.frame_dtype)
+        elif cache_bytes > 0:
+            self.cache = FrameLRUCache(self.index.paths.tolist(), self.img_shape, cache_bytes,
+                                       dtype=np.uint8 if self.compact else self.frame_dtype)
+        if self.store is not None:
+            self.store_ids = np.full(len(self.index.paths), -1) # frame id -> offset in the store (-1 for the rendered object frames)
+            for frame_id in np.unique(frame_ids):
+                img_path = self.index.paths[frame_id]
+                if img_path not in self.store:
+                    raise KeyError(f'The frame {img_path} is not in the frame store {cache_dir}.')
+                self.store_ids[frame_id] = self.store.offsets[img_path]
+
+    @property
+    def archive(self):
+        # A ZipFile handle must not be shared between processes, so every DataLoader worker reopens its own.
+        if (self._archive is None) or (self._archive_pid != os.getpid()):
+            self._archive = zipfile.ZipFile(self.zip_path, 'r')
+            self._archive_pid = os.getpid()
+        return self._archive
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_archive'] = None
+        return state
 
     def __len__(self):
-        return len(self.info_frame)
+        return len(self.index)
 
     def __getitem__(self,idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        input_img = np.empty(shape=[self.img_shape[0],self.img_shape[1],0])
-        info = self.info_frame.iloc[idx]
-        self.T = info['T']
-        index = info['index']
-        traj = []
-        for i in range(self.nc):
-            img_name = info['f{}'.format(i)]
-            obj_id = img_name.split('_')[0]
-
-            if self.cpi == 1:
-                img_path = os.path.join(self.root_dir, obj_id, img_name)
-                this_x = float(img_name[:-4].split('_')[2])
-                this_y = float(img_name[:-4].split('_')[3])
-                traj.append([this_x,this_y])
-            elif self.cpi == 2:
-                if len(img_name.split('_'))==5:
-                    img_path = os.path.join(self.root_dir, obj_id, 'obj', img_name)
-                    time_step = int(img_name[:-4].split('_')[1])
-                    this_x = float(img_name[:-4].split('_')[2])
-                    this_y = float(img_name[:-4].split('_')[3])
-                    traj.append([this_x,this_y])
-                else:
-                    img_path = os.path.join(self.root_dir, obj_id, 'env', img_name)
-
-            image = self.togray(io.imread(self.archive.open(img_path)))
-            input_img = np.concatenate((input_img, image[:,:,np.newaxis]), axis=2)
-
-        if self.with_T:
-            T_channel = np.ones(shape=[self.img_shape[0],self.img_shape[1],1])*self.T # T_channel
-            input_img = np.concatenate((input_img, T_channel), axis=2)           # T_channel
-
-        label = {'x':info['x'], 'y':info['y']}
+        self.T = self.index.T[idx]
+        index = self.index.index[idx]
+        input_img, channels = alloc_image_stack(self.img_shape, self.nc+int(self.T_plane),
+                                                np.uint8 if self.compact else np.float64, self.channels_first)
+        for i, frame_id in enumerate(self.index.frame_ids[idx]):
+            image = self.load_channel(idx, i, frame_id)
+            channels[i] = to_uint8(image) if self.compact else image
+
+        label = {'x':self.index.label[idx,0], 'y':self.index.label[idx,1]}
+        if self.crop_size is not None:
+            centre = self.index.traj[idx,-1] # current position
+            input_img, _ = crop_stack(input_img, world2pixel(centre, self.img_shape, self.extent, self.scale), self.crop_size, self.channels_first, self.crop_pad)
+            label = {'x':label['x']-centre[0], 'y':label['y']-centre[1]}
+
+        if self.T_plane: # after cropping, the whole plane is T
+            channel_view(input_img, self.channels_first)[-1] = self.T # T_channel
         sample = {'image':input_img, 'label':label}
 
         if self.tr:
             sample = self.tr(sample)
 
         sample['index'] = index
-        sample['traj'] = traj
-        sample['time'] = time_step
+        if self.with_T == 'scalar':
+            sample['T'] = self.T
+        sample['traj'] = self.index.traj[idx].tolist()
+        if self.crop_size is not None:
+            sample['centre'] = self.index.traj[idx,-1]
+        sample['time'] = self.index.time[idx]
 
         return sample
 
+    def get_batch(self, indices):
+        '''
+        Description:
+            Load a whole batch at once. With the frame store, the frames are gathered by one fancy indexing.
+            The per-sample transform is not applied (use "DataHandler(batch_transform=...)").
+        Return:
+            batch <dict> - 'image' (BxCxHxW), 'label' (Bx2), 'traj' (Bx(past+1)x2), 'index' (B), 'time' (B), 'T' (B)
+                           (and 'centre' (Bx2) with "crop_size")
+        '''
+        indices = np.asarray(indices)
+        frame_ids = self.index.frame_ids[indices] # B x nc
+        dtype = np.uint8 if self.compact else np.float64
+        image = np.empty(shape=[len(indices), self.nc+int(self.T_plane), self.img_shape[0], self.img_shape[1]], dtype=dtype)
+        if self.store is not None:
+            read = slice(1, self.nc, 2) if self.render_obj else slice(0, self.nc) # rendered object channels are not in the store
+            image[:,read] = self.store.frames[self.store_ids[frame_ids[:,read]]]
+            if self.render_obj:
+                for i, j in np.ndindex(len(indices), self.nc//2):
+                    image[i,2*j] = self.obj_raster.render_obj(self.index.traj[indices[i], j])
+        else:
+            for i, j in np.ndindex(frame_ids.shape):
+                frame = self.load_channel(indices[i], j, frame_ids[i,j])
+                image[i,j] = to_uint8(frame) if self.compact else frame
+        batch = {'label': torch.from_numpy(self.index.label[indices]),
+                 'traj':  torch.from_numpy(self.index.traj[indices]),
+                 'index': torch.from_numpy(self.index.index[indices]),
+                 'time':  torch.from_numpy(self.index.time[indices]),
+                 'T':     torch.from_numpy(self.index.T[indices])}
+        if self.crop_size is not None:
+            centres = self.index.traj[indices,-1] # current positions
+            image = np.stack([crop_stack(img, world2pixel(c, self.img_shape, self.extent, self.scale), self.crop_size, True, self.crop_pad)[0] for img, c in zip(image, centres)])
+            batch['label'] = torch.from_numpy(self.index.label[indices] - centres)
+            batch['centre'] = torch.from_numpy(centres)
+        if self.T_plane: # after cropping, the whole plane is T
+            image[:,-1] = self.index.T[indices][:,np.newaxis,np.newaxis] # T_channel
+        batch['image'] = torch.from_numpy(image)
+        return batch
+
+    def load_channel(self, idx, i, frame_id):
+        # Channel i of sample idx, the object channels are rendered if "render_obj".
+        if (self.obj_raster is not None) and (i%2 == 0):
+            return self.obj_raster.render_obj(self.index.traj[idx, i//2])
+        return self.read_frame(self.index.paths[frame_id])
+
     def togray(self, image):
         if (len(image.shape)==2):
             return image
@@ -148,87 +349,156 @@ class ImageStackDataset(Dataset):
             img = image[:,:,0]/3 + image[:,:,1]/3 + image[:,:,2]/3
             return img
 
-    def check_img_shape(self):
-        info = self.info_frame.iloc[0]
-        img_name = info['f0']
-        obj_id = img_name.split('_')[0]
+    def read_frame(self, img_path):
+        if self.store is not None:
+            return self.store[img_path]
+        elif self.cache is not None:
+            return self.cache.get(img_path, lambda: self.togray(io.imread(self.archive.open(img_path))))
+        return self.togray(io.imread(self.archive.open(img_path)))
 
+    def get_img_path(self, img_name):
+        obj_id = img_name.split('_')[0]
         if self.cpi == 1:
             img_path = os.path.join(self.root_dir, obj_id, img_name)
         elif self.cpi == 2:
-            img_path = os.path.join(self.root_dir, obj_id, 'obj', img_name)
+            if len(img_name.split('_'))==5:
+                img_path = os.path.join(self.root_dir, obj_id, 'obj', img_name)
+            else:
+                img_path = os.path.join(self.root_dir, obj_id, 'env', img_name)
+        return img_path
 
+    def check_img_shape(self):
+        img_path = self.index.paths[self.index.frame_ids[0,-1]] # env image if cpi=2
         image = self.togray(io.imread(self.archive.open(img_path)))
+        self.frame_dtype = image.dtype # decoded dtype (uint8, or float if converted from RGB)
         return image.shape
 
 class ImageStackDatasetSDD(Dataset):
-    def __init__(self, zip_path, csv_path, root_dir, ext='.jpg', transform=None, T_channel=False):
+    def __init__(self, zip_path, csv_path, root_dir, ext='.jpg', transform=None, T_channel=False, cache_bytes=0,
+                 defer_obj_maps=False, obj_truncate=None, compact=False, channels_first=False, crop_size=None, crop_pad=255,
+                 index_path=None, save_index=True):
         '''
         Args:
             zip_path: Path (absolute) to the ZIP file with everything
             csv_path: Path (relative) to the CSV file with dataset info.
             root_dir: Directory (relative) with all image folders.
                       root_dir - obj_folder - obj & other
+            T_channel: If true, the horizon T is appended as a constant image channel.
+                       If 'scalar', it is only returned as sample['T'] (for the networks with "T_embed").
+            cache_bytes: Memory budget of the decoded-frame cache shared by all workers, 0 to disable.
+            defer_obj_maps: If true, the object heatmaps are not rendered here, but after collation
+                            by "batch_transform.ObjectHeatmaps" from sample['obj_coords'] (in pixels).
+                            With "crop_size", sample['crop_origin'] and sample['frame_shape'] are added for them.
+            obj_truncate: Radius (in sigmas) of the rendered heatmap patch, None for the whole map.
+            compact: If true, the image stack stays uint8 (frames and T channel, only with deferred heatmaps), the conversion to float is done per batch.
+                     Transforms must keep the dtype (e.g. "ToTensor").
+            channels_first: If true, the image stack is C x H x W (use "ToTensor(channels_first=True)").
+            crop_size: If given (h, w), the image stack is cropped around the current position of the agent
+                       and the label is relative to it (see "agent_crop"), sample['centre'] is the position.
+            crop_pad: Pixel value of the frames outside of the image in the crop (the heatmaps are padded with 0).
+            index_path: Path to the NPZ file of the columnar sample index (see "sample_index").
+                        If None, it is next to the ZIP file.
+            save_index: Save the index if it is (re)built from the CSV file.
         '''
         super().__init__()
-        self.archive = zipfile.ZipFile(zip_path, 'r')
+        self.zip_path = zip_path
+        self._archive = None # opened lazily in each process, see "archive"
 
-        self.info_frame = pd.read_csv(self.archive.open(csv_path))
         self.root_dir = root_dir
         self.tr = transform
         self.with_T = T_channel
+        self.T_plane = (T_channel is True) # T as a constant image channel
         self.ext = ext
-
-        self.nc = len(list(self.info_frame))-5 # number of image channels in half
+        self.defer_obj_maps = defer_obj_maps
+        self.obj_sigmas = [20,20]
+        self.obj_truncate = obj_truncate
+        self.compact = compact
+        self.channels_first = channels_first
+        self.crop_size = crop_size
+        self.crop_pad = crop_pad
+        if compact & (not defer_obj_maps):
+            raise ValueError('The compact mode needs deferred object heatmaps (defer_obj_maps=True).')
+
+        if index_path is None:
+            index_path = os.path.splitext(zip_path)[0] + '_index.npz'
+        signature = {**archive_signature(zip_path, csv_path, self.archive, root_dir), 'ext':ext}
+        self.index = SampleIndex.load(index_path, signature)
+        if self.index is None:
+            info_frame = pd.read_csv(self.archive.open(csv_path))
+            self.index = SampleIndex.from_sdd_info_frame(info_frame, len(list(info_frame))-5, self.get_img_path, signature)
+            if save_index:
+                self.index.save(index_path)
+
+        self.nc = self.index.frame_ids.shape[1] # number of image channels in half
         self.img_shape = self.check_img_shape()
+        self.obj_coords = self.index.traj * self.pixel_scale()[:,np.newaxis,:] # N x nc x 2, positions in the frames (pixels)
+
+        self.cache = None
+        if cache_bytes > 0:
+            self.cache = FrameLRUCache(self.index.paths.tolist(), self.img_shape, cache_bytes,
+                                       dtype=np.uint8 if self.compact else self.frame_dtype)
+
+    @property
+    def archive(self):
+        # A ZipFile handle must not be shared between processes, so every DataLoader worker reopens its own.
+        if (self._archive is None) or (self._archive_pid != os.getpid()):
+            self._archive = zipfile.ZipFile(self.zip_path, 'r')
+            self._archive_pid = os.getpid()
+        return self._archive
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_archive'] = None
+        return state
 
     def __len__(self):
-        return len(self.info_frame)
+        return len(self.index)
 
     def __getitem__(self,idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        input_img = np.empty(shape=[self.img_shape[0],self.img_shape[1],0])
-        info = self.info_frame.iloc[idx]
-        self.T = info['T']
-        index = info['index']
-        traj = []
-        for i in range(self.nc):
-            img_name = info[f't{i}'].split('_')[0] + self.ext
-            video_idx = info['index']
-
-            img_path = os.path.join(self.root_dir, video_idx, img_name)
-
-            csv_name = [x for x in self.archive.namelist() if ((video_idx in x)&('csv' in x))]
-            original_scale = os.path.basename(csv_name[0]).split('.')[0]
-            original_scale = (int(original_scale.split('_')[0]), int(original_scale.split('_')[1])) # HxW
-
-            time_step = int(info[f't{i}'].split('_')[0])
-            this_x = float(info[f't{i}'].split('_')[1])
-            this_y = float(info[f't{i}'].split('_')[2])
-            traj.append([this_x,this_y])
-
-            image = self.togray(io.imread(self.archive.open(img_path)))
-            input_img = np.concatenate((input_img, image[:,:,np.newaxis]), axis=2)
-
-            white_canvas = np.zeros_like(image)
-            obj_coords = self.rescale_label((this_x, this_y), original_scale)
-            obj_map = self.np_gaudist_map(obj_coords, white_canvas, sigmas=[20,20])
-            input_img = np.concatenate((input_img, obj_map[:,:,np.newaxis]), axis=2)
-
-        if self.with_T:
-            T_channel = np.ones(shape=[self.img_shape[0],self.img_shape[1],1])*T # T_channel
-            input_img = np.concatenate((input_img, T_channel), axis=2)           # T_channel
-
-        label = {'x':info['x'], 'y':info['y']}
+        self.T = self.index.T[idx]
+        index = self.index.index[idx]
+        traj = self.index.traj[idx]
+        obj_coords = self.obj_coords[idx]
+        step = 1 if self.defer_obj_maps else 2 # frame (and heatmap) per position
+        input_img, channels = alloc_image_stack(self.img_shape, step*self.nc+int(self.T_plane),
+                                                np.uint8 if self.compact else np.float64, self.channels_first)
+        for i, frame_id in enumerate(self.index.frame_ids[idx]):
+            image = self.read_frame(self.index.paths[frame_id])
+            channels[step*i] = to_uint8(image) if self.compact else image
+
+        if not self.defer_obj_maps:
+            channels[1:2*self.nc:2] = gaussian_maps(obj_coords[np.newaxis,:], self.img_shape, self.obj_sigmas, self.obj_truncate)[0]
+
+        label = {'x':self.index.label[idx,0], 'y':self.index.label[idx,1]}
+        if self.crop_size is not None:
+            centre = traj[-1] # current position
+            pad = np.zeros(len(channels)) # the heatmaps (and T) are padded with 0
+            pad[0:step*self.nc:step] = self.crop_pad
+            input_img, origin = crop_stack(input_img, obj_coords[-1], self.crop_size, self.channels_first, pad)
+            obj_coords = obj_coords - origin # in the crop
+            label = {'x':label['x']-centre[0], 'y':label['y']-centre[1]}
+
+        if self.T_plane: # after cropping, the whole plane is T
+            channel_view(input_img, self.channels_first)[-1] = self.T # T_channel
         sample = {'image':input_img, 'label':label}
 
         if self.tr:
             sample = self.tr(sample)
 
         sample['index'] = index
-        sample['traj'] = traj
+        if self.with_T == 'scalar':
+            sample['T'] = self.T
+        sample['traj'] = traj.tolist()
+        if self.crop_size is not None:
+            sample['centre'] = traj[-1]
+        if self.defer_obj_maps:
+            sample['obj_coords'] = np.array(obj_coords)
+            if self.crop_size is not None: # for the heatmaps of "batch_transform.ObjectHeatmaps"
+                sample['crop_origin'] = origin
+                sample['frame_shape'] = np.array(self.img_shape)
 
         return sample
 
@@ -251,7 +521,7 @@ class ImageStackDatasetSDD(Dataset):
             return z/z.max()
 
     def rescale_label(self, label, original_scale): # x,y & HxW
-        current_scale = self.check_img_shape()
+        current_scale = self.img_shape
         rescale = (current_scale[0]/original_scale[0] , current_scale[1]/original_scale[1])
         return (label[0]*rescale[1], label[1]*rescale[0])
 
@@ -265,12 +535,30 @@ class ImageStackDatasetSDD(Dataset):
             img = image[:,:,0]/3 + image[:,:,1]/3 + image[:,:,2]/3
             return img
 
+    def read_frame(self, img_path):
+        if self.cache is not None:
+            return self.cache.get(img_path, lambda: self.togray(io.imread(self.archive.open(img_path))))
+        return self.togray(io.imread(self.archive.open(img_path)))
+
+    def pixel_scale(self):
+        # Scale (x, y) of each sample from the original video (HxW in the name of the video's CSV file) to the frames.
+        names = self.archive.namelist()
+        scales = {}
+        for video_idx in np.unique(self.index.index):
+            csv_name = [x for x in names if ((video_idx in x)&('csv' in x))]
+            original_scale = os.path.basename(csv_name[0]).split('.')[0]
+            original_scale = (int(original_scale.split('_')[0]), int(original_scale.split('_')[1])) # HxW
+            scales[video_idx] = (self.img_shape[1]/original_scale[1], self.img_shape[0]/original_scale[0])
+        return np.array([scales[video_idx] for video_idx in self.index.index])
+
+    def get_img_path(self, video_idx, t_info):
+        img_name = t_info.split('_')[0] + self.ext
+        return os.path.join(self.root_dir, video_idx, img_name)
+
     def check_img_shape(self):
-        info = self.info_frame.iloc[0]
-        img_name = info['t0'].split('_')[0] + self.ext
-        video_folder = info['index']
-        img_path = os.path.join(self.root_dir, video_folder, img_name)
+        img_path = self.index.paths[self.index.frame_ids[0,0]]
         image = self.togray(io.imread(self.archive.open(img_path)))
+        self.frame_dtype = image.dtype # decoded dtype (uint8, or float if converted from RGB)
         return image.shape
 
 
@@ -327,12 +615,16 @@ class DelAlpha(object):
 
 class ToTensor(object):
     """Convert ndarrays in sample to Tensors."""
+    def __init__(self, channels_first=False):
+        super().__init__()
+        self.channels_first = channels_first # the image is already C x H x W
 
     def __call__(self, sample):
         image, label = sample['image'], sample['label']
         label = np.array([label['x'],label['y']])
         # swap color axis, numpy: H x W x C -> torch: C X H X W
-        image = image.transpose((2, 0, 1))
+        if not self.channels_first:
+            image = image.transpose((2, 0, 1))
         return {'image': torch.from_numpy(image),
                 'label': torch.from_numpy(label)}
 
@@ -344,12 +636,11 @@ class MaxNormalize(object):
 
     def __call__(self, sample):
         image, label = sample['image'], sample['label']
-        if not isinstance(self.mp, (tuple,list)):
-            self.mp = [self.mp]*image.shape[2]
+        mp = self.mp if isinstance(self.mp, (tuple,list)) else [self.mp]*image.shape[2]
         for i in range(image.shape[2]):
-            image[:,:,:i] = image[:,:,:i]/self.mp[i]
+            image[:,:,i] = image[:,:,i]/mp[i]
         if self.ml is not None:
-            if self.ml is tuple:
+            if isinstance(self.ml, tuple):
                 label['x'], label['y'] = label['x']/self.ml[0], label['y']/self.ml[1]
             else:
                 label['x'], label['y'] = label['x']/self.ml, label['y']/self.ml
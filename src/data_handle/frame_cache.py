@@ -0,0 +1,260 @@
+import os
+import json
+import hashlib
+import multiprocessing as mp
+
+import numpy as np
+
+from skimage import io
+
+'''
+Pre-decoded frame store for ZIP-based datasets.
+
+All frames referenced by the dataset are decoded once (grayscale, uint8 or the decoded dtype) and written
+into one memory-mapped array, one contiguous HxW block per frame.
+An index maps the image path (inside the archive) to the block offset.
+Frames are content-addressed: byte-identical images (e.g. SID env frames) share one block,
+so they are decoded, stored and kept in the page cache only once.
+
+Store folder:
+    store_dir - frames.npy (UxHxW, U unique frames)
+              - index.json (signature, frame shape, image paths, block of each path)
+
+Decoded-frame cache (FrameLRUCache):
+    A bounded in-memory cache of decoded frames, shared by all DataLoader workers.
+    Samples are overlapping windows, so every frame is used by many samples.
+    Frames are kept in the dtype the dataset would return, so the cache does not change the samples.
+'''
+
+def to_uint8(image):
+    # Decoded gray frames are float if converted from RGB(A), round them back to uint8.
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+def archive_signature(zip_path, csv_path, archive=None, root_dir=None, channel_per_image=None):
+    # The store is invalid if the ZIP file or the CSV inside it changes, or if the images are read from another folder or layout.
+    stat = os.stat(zip_path)
+    signature = {'zip_path':os.path.abspath(zip_path), 'zip_size':stat.st_size, 'zip_mtime':stat.st_mtime, 'csv_path':csv_path,
+                 'root_dir':root_dir, 'cpi':channel_per_image}
+    if archive is not None:
+        signature['csv_crc'] = archive.getinfo(csv_path).CRC
+    return signature
+
+
+class FrameStore():
+    def __init__(self, store_dir, mode='r'):
+        '''
+        Args:
+            store_dir: Directory of the store (see the module description).
+            mode: Mode of the memory map, 'r' for reading only.
+        '''
+        with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.store_dir = store_dir
+        self.mode = mode
+        self.signature = index['signature']
+        self.frame_shape = tuple(index['shape'])
+        self.paths = index['paths']
+        self.offsets = dict(zip(self.paths, index.get('slots', range(len(self.paths))))) # path -> block
+        self.frames = np.load(os.path.join(store_dir, 'frames.npy'), mmap_mode=mode)
+
+    def __getstate__(self):
+        # Do not pickle the memory map (e.g. for spawned DataLoader workers), reopen it instead.
+        state = self.__dict__.copy()
+        state['frames'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.frames = np.load(os.path.join(self.store_dir, 'frames.npy'), mmap_mode=self.mode)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, img_path):
+        return img_path in self.offsets
+
+    def __getitem__(self, img_path):
+        return self.frames[self.offsets[img_path]] # zero-copy view into the memory map
+
+    def stats(self):
+        # Savings of the deduplication (storage and decodes).
+        frame_bytes = int(np.prod(self.frame_shape)) * self.frames.dtype.itemsize
+        num_unique = len(self.frames)
+        return {'frames':len(self.paths), 'unique_frames':num_unique, 'store_MB':num_unique*frame_bytes/1024**2,
+                'saved_MB':(len(self.paths)-num_unique)*frame_bytes/1024**2, 'saved_decodes':len(self.paths)-num_unique}
+
+    @staticmethod
+    def is_valid(store_dir, signature):
+        try:
+            with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not os.path.exists(os.path.join(store_dir, 'frames.npy')):
+            return False
+        return (index['signature'] == signature) and ('slots' in index) # stores without deduplication are rebuilt
+
+    @classmethod
+    def materialize(cls, store_dir, archive, img_paths, signature, togray, dtype=np.uint8, verbose=True):
+        '''
+        Description:
+            Decode every unique frame in "img_paths" from the "archive" and write them into the store.
+            Images are grouped by a hash of their bytes, only the first image of each group is decoded.
+        Arguments:
+            archive   <ZipFile>  - The archive containing all images.
+            img_paths <list>     - Paths (in the archive) of all referenced images.
+            signature <dict>     - See "archive_signature".
+            togray    <function> - Convert a decoded image to a 2D grayscale image.
+            dtype                - Dtype of the stored frames, the decoded dtype (lossless) or uint8 for compact datasets (rounded by "to_uint8").
+        '''
+        os.makedirs(store_dir, exist_ok=True)
+        if os.path.exists(os.path.join(store_dir, 'index.json')):
+            os.remove(os.path.join(store_dir, 'index.json'))
+        img_paths = list(dict.fromkeys(img_paths)) # unique, keep order
+
+        blocks = {} # content hash -> block
+        slots = []
+        unique_paths = []
+        for i, img_path in enumerate(img_paths):
+            if verbose & ((i%1000==0) | (i==len(img_paths)-1)):
+                print(f'\rHash frames: {i+1}/{len(img_paths)}', end='    ')
+            digest = hashlib.blake2b(archive.read(img_path), digest_size=16).digest()
+            if digest not in blocks:
+                blocks[digest] = len(unique_paths)
+                unique_paths.append(img_path)
+            slots.append(blocks[digest])
+        if verbose:
+            print()
+
+        first = togray(io.imread(archive.open(unique_paths[0])))
+        frames = np.lib.format.open_memmap(os.path.join(store_dir, 'frames.npy'), mode='w+',
+                                           dtype=dtype, shape=(len(unique_paths),)+first.shape)
+        for i, img_path in enumerate(unique_paths):
+            if verbose & ((i%1000==0) | (i==len(unique_paths)-1)):
+                print(f'\rMaterialize frames: {i+1}/{len(unique_paths)} (unique of {len(img_paths)})', end='    ')
+            image = togray(io.imread(archive.open(img_path)))
+            frames[i] = to_uint8(image) if frames.dtype == np.uint8 else image
+        frames.flush()
+        del frames
+        if verbose:
+            print()
+        # The index is written last, so an interrupted run leaves an invalid store.
+        with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+            json.dump({'signature':signature, 'shape':list(first.shape), 'paths':img_paths, 'slots':slots}, f)
+        return cls(store_dir)
+
+    @classmethod
+    def open(cls, store_dir, archive, img_paths, signature, togray, dtype=np.uint8, verbose=True):
+        # Load the store if it is up to date, otherwise (re)build it.
+        signature = {**signature, 'dtype':np.dtype(dtype).str}
+        if cls.is_valid(store_dir, signature):
+            return cls(store_dir)
+        return cls.materialize(store_dir, archive, img_paths, signature, togray, dtype, verbose=verbose)
+
+
+class FrameLRUCache():
+    """
+    A decoded-frame cache in shared memory with a fixed budget of bytes.
+
+    All frames have the same shape and dtype and are stored in a slab of slots.
+    Eviction follows the CLOCK algorithm (an approximation of LRU which needs no shared linked list).
+    The slab, the tables and the counters live in shared memory created before the workers start,
+    so all DataLoader workers read and fill the same cache.
+
+    Arguments:
+        img_paths (list): Paths (keys) of all frames which may be cached.
+        frame_shape (tuple): Shape of one grayscale frame (HxW).
+        capacity_bytes (int): Memory budget of the slab.
+        dtype: Dtype of the cached frames, the decoded dtype (lossless) or uint8 for compact datasets (rounded by "to_uint8").
+    """
+    def __init__(self, img_paths, frame_shape, capacity_bytes, dtype=np.uint8):
+        self.keys = {p:i for i,p in enumerate(dict.fromkeys(img_paths))}
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.num_slots = min(max(int(capacity_bytes//frame_bytes), 1), len(self.keys))
+
+        self._raw_slab = mp.RawArray('B', self.num_slots*frame_bytes)
+        self._raw_slot_of = mp.RawArray('q', len(self.keys)) # key -> slot
+        self._raw_key_of  = mp.RawArray('q', self.num_slots) # slot -> key
+        self._raw_ref     = mp.RawArray('B', self.num_slots) # reference bits
+        self._raw_counter = mp.RawArray('q', 4)              # hits, misses, evictions, hand
+        self.lock = mp.Lock()
+        self._attach()
+        self.slot_of[:] = -1
+        self.key_of[:] = -1
+
+    def _attach(self):
+        self.slab    = np.frombuffer(self._raw_slab, dtype=self.dtype).reshape((self.num_slots,)+self.frame_shape)
+        self.slot_of = np.frombuffer(self._raw_slot_of, dtype=np.int64)
+        self.key_of  = np.frombuffer(self._raw_key_of, dtype=np.int64)
+        self.ref     = np.frombuffer(self._raw_ref, dtype=np.uint8)
+        self.counter = np.frombuffer(self._raw_counter, dtype=np.int64)
+
+    def __getstate__(self):
+        # Shared arrays can be passed to (spawned) workers, the numpy views are rebuilt there.
+        state = self.__dict__.copy()
+        for name in ['slab', 'slot_of', 'key_of', 'ref', 'counter']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def __contains__(self, img_path):
+        return (img_path in self.keys) and (self.slot_of[self.keys[img_path]] >= 0)
+
+    def get(self, img_path, loader):
+        '''
+        Description:
+            Return the cached frame of "img_path", or call "loader" to decode it and cache the result.
+        Arguments:
+            loader <function> - Return the decoded grayscale frame.
+        '''
+        key = self.keys.get(img_path)
+        if key is None:
+            return loader()
+        with self.lock:
+            slot = self.slot_of[key]
+            if slot >= 0:
+                self.ref[slot] = 1
+                self.counter[0] += 1
+                return self.slab[slot].copy() # the slot may be evicted after releasing the lock
+            self.counter[1] += 1
+
+        frame = loader() # decode outside the lock
+        frame = to_uint8(frame) if self.dtype == np.uint8 else frame.astype(self.dtype, copy=False)
+        with self.lock:
+            if self.slot_of[key] < 0: # another worker may have inserted it meanwhile
+                slot = self._evict()
+                self.slab[slot] = frame
+                self.ref[slot] = 1
+                self.key_of[slot] = key
+                self.slot_of[key] = slot
+        return frame
+
+    def _evict(self):
+        # CLOCK: skip (and clear) recently referenced slots, take the first one without reference.
+        hand = self.counter[3]
+        while self.ref[hand]:
+            self.ref[hand] = 0
+            hand = (hand+1) % self.num_slots
+        old_key = self.key_of[hand]
+        if old_key >= 0:
+            self.slot_of[old_key] = -1
+            self.counter[2] += 1
+        self.counter[3] = (hand+1) % self.num_slots
+        return hand
+
+    def stats(self):
+        hits, misses, evictions = [int(x) for x in self.counter[:3]]
+        return {'hits':hits, 'misses':misses, 'evictions':evictions,
+                'hit_rate':hits/max(hits+misses,1),
+                'cached_frames':int(np.sum(self.key_of>=0)), 'capacity_frames':self.num_slots}
+
+    def reset_stats(self):
+        with self.lock:
+            self.counter[:3] = 0
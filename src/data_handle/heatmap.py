@@ -0,0 +1,86 @@
+import numpy as np
+
+import torch
+
+'''
+Rasterizer of normalized Gaussian object heatmaps (see "ImageStackDatasetSDD.np_gaudist_map").
+
+Without correlation (rho=0) the 2D Gaussian is the outer product of two 1D kernels,
+and its maximum is the product of their maxima. So each map is rendered as
+    map = (gy/max(gy)) x (gx/max(gx))
+for all objects of a batch in one call.
+If "truncate" (in sigmas) is given, the kernels are zero beyond this radius, and
+the numpy path only writes the local patch around each object.
+'''
+
+_grid_cache = {}
+
+def _grid(length):
+    if length not in _grid_cache:
+        _grid_cache[length] = np.arange(length, dtype=np.float64)
+    return _grid_cache[length]
+
+def _kernels(centres, shape, sigmas):
+    x, y = _grid(shape[1]), _grid(shape[0])
+    gx = np.exp(-(x-centres[...,0:1])**2 / (2*sigmas[0]**2)) # ...xW
+    gy = np.exp(-(y-centres[...,1:2])**2 / (2*sigmas[1]**2)) # ...xH
+    return gx/gx.max(axis=-1, keepdims=True), gy/gy.max(axis=-1, keepdims=True)
+
+def gaussian_maps(centres, shape, sigmas=(20,20), truncate=None, dtype=np.float64):
+    '''
+    Description:
+        Render normalized Gaussian heatmaps in numpy.
+    Arguments:
+        centres  (BxKx2) - Object positions (x, y) in pixels.
+        shape    (HxW)   - Size of the maps.
+        sigmas   (2)     - Standard deviations (x, y) in pixels.
+        truncate <float> - Radius (in sigmas) of the local patch, None for the whole map.
+    Return:
+        maps (BxKxHxW)
+    '''
+    centres = np.asarray(centres, dtype=np.float64)
+    gx, gy = _kernels(centres, shape, sigmas)
+    if truncate is None:
+        return (gy[...,:,np.newaxis] * gx[...,np.newaxis,:]).astype(dtype)
+
+    maps = np.zeros(centres.shape[:-1]+tuple(shape), dtype=dtype)
+    rx, ry = truncate*sigmas[0], truncate*sigmas[1]
+    for b, k in np.ndindex(centres.shape[:-1]):
+        cx, cy = centres[b,k]
+        x0, x1 = max(int(np.ceil(cx-rx)), 0), min(int(np.floor(cx+rx))+1, shape[1])
+        y0, y1 = max(int(np.ceil(cy-ry)), 0), min(int(np.floor(cy+ry))+1, shape[0])
+        if (x0<x1) & (y0<y1):
+            maps[b,k,y0:y1,x0:x1] = np.outer(gy[b,k,y0:y1], gx[b,k,x0:x1])
+    return maps
+
+def gaussian_maps_torch(centres, shape, sigmas=(20,20), truncate=None, origin=None, frame_shape=None):
+    '''
+    Description:
+        Render normalized Gaussian heatmaps in torch (on the device of "centres").
+    Arguments:
+        (same as "gaussian_maps")
+        origin      (Bx2) - If given, the maps are a window (e.g. an agent crop) at this position (x, y) of the frames,
+                            and "centres" are in the frames. The maps are normalized over the frames and 0 outside of them,
+                            the same as the window of the full-frame maps.
+        frame_shape (HxW) - Size of the frames (with "origin").
+    Return:
+        maps (BxKxHxW)
+    '''
+    x = torch.arange(shape[1], device=centres.device, dtype=centres.dtype)
+    y = torch.arange(shape[0], device=centres.device, dtype=centres.dtype)
+    if origin is None:
+        origin, frame_shape = centres.new_zeros(centres.shape[0], 2), shape
+    origin = origin.to(centres).view(-1, 1, 2)
+    x = x + origin[...,0:1] # Bx1xW, in the frames
+    y = y + origin[...,1:2] # Bx1xH
+    dx = x - centres[...,0:1] # BxKxW
+    dy = y - centres[...,1:2] # BxKxH
+    # the maximum over the pixels of the frames is at the nearest pixel to the centre
+    nx = centres[...,0:1].round().clamp(0, frame_shape[1]-1) - centres[...,0:1]
+    ny = centres[...,1:2].round().clamp(0, frame_shape[0]-1) - centres[...,1:2]
+    gx = torch.exp(-(dx**2-nx**2) / (2*sigmas[0]**2)) * ((x>=0) & (x<frame_shape[1]))
+    gy = torch.exp(-(dy**2-ny**2) / (2*sigmas[1]**2)) * ((y>=0) & (y<frame_shape[0]))
+    if truncate is not None:
+        gx = gx * (dx.abs() <= truncate*sigmas[0])
+        gy = gy * (dy.abs() <= truncate*sigmas[1])
+    return gy.unsqueeze(-1) * gx.unsqueeze(-2)
@@ -0,0 +1,17 @@
+import numpy as np
+
+'''
+Layout of the stacked input images (shared by "data_handler" and "data_handler_zip").
+'''
+
+def alloc_image_stack(img_shape, num_channels, dtype, channels_first=False):
+    # Allocate the image stack in its final layout, channels are written into "channels" (always C x H x W).
+    if channels_first:
+        input_img = np.empty(shape=[num_channels,img_shape[0],img_shape[1]], dtype=dtype)
+        return input_img, input_img
+    input_img = np.empty(shape=[img_shape[0],img_shape[1],num_channels], dtype=dtype)
+    return input_img, np.moveaxis(input_img, 2, 0)
+
+def channel_view(input_img, channels_first=False):
+    # C x H x W view of an image stack.
+    return input_img if channels_first else np.moveaxis(input_img, 2, 0)
@@ -0,0 +1,109 @@
+import os
+import json
+
+import numpy as np
+
+'''
+Columnar sample index for the image stack datasets (SID and SDD).
+
+The CSV (see "utils_data.gather_all_data") is parsed once into numpy arrays,
+so that "__getitem__" only does integer indexing:
+    paths     (P)          - unique image paths
+    frame_ids (N x nc)     - id (into "paths") of every channel of every sample
+    traj      (N x past+1 x 2) - past positions parsed from the object image names
+    time      (N)          - time step of the current (last) object image
+    T         (N)          - prediction horizon
+    label     (N x 2)      - future position (x, y)
+    index     (N)          - scene index (SID) or video id (SDD)
+The index is saved as a NPZ file next to the dataset, with a signature to detect changes of the source.
+'''
+
+def file_signature(file_path):
+    stat = os.stat(file_path)
+    return {'path':os.path.abspath(file_path), 'size':stat.st_size, 'mtime':stat.st_mtime}
+
+
+class SampleIndex():
+    columns = ['paths', 'frame_ids', 'traj', 'time', 'T', 'label', 'index']
+
+    def __init__(self, paths, frame_ids, traj, time, T, label, index, signature=None):
+        self.paths = paths
+        self.frame_ids = frame_ids
+        self.traj = traj
+        self.time = time
+        self.T = T
+        self.label = label
+        self.index = index
+        self.signature = signature
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    @classmethod
+    def from_info_frame(cls, info_frame, channel_per_image, get_img_path, signature=None):
+        '''
+        Arguments:
+            info_frame   <DataFrame> - The content of the CSV file with dataset info.
+            get_img_path <function>  - Map an image name to its path.
+        '''
+        cpi = channel_per_image
+        nc = len(list(info_frame))-4 # number of image channels in total
+        names = info_frame[[f'f{i}' for i in range(nc)]].to_numpy().astype(str)
+        unique_names, inverse = np.unique(names, return_inverse=True)
+        paths = np.array([get_img_path(n) for n in unique_names])
+        frame_ids = inverse.reshape(names.shape).astype(np.int64)
+
+        # Object images are named as "{id}_{t}_{x}_{y}_{idx}.png", env images as "{id}_{t}_{idx}.png".
+        obj_channels = [i for i in range(nc) if (cpi==1) or (len(names[0,i].split('_'))==5)]
+        traj = np.zeros((len(info_frame), len(obj_channels), 2))
+        for j, i in enumerate(obj_channels):
+            info = info_frame[f'f{i}'].str[:-4].str.split('_', expand=True)
+            traj[:,j,0] = info[2].astype(float).to_numpy()
+            traj[:,j,1] = info[3].astype(float).to_numpy()
+        time = info[1].astype(int).to_numpy()
+
+        return cls(paths, frame_ids, traj, time,
+                   T=info_frame['T'].to_numpy(),
+                   label=info_frame[['x','y']].to_numpy(),
+                   index=info_frame['index'].to_numpy(),
+                   signature=signature)
+
+    @classmethod
+    def from_sdd_info_frame(cls, info_frame, num_channels, get_img_path, signature=None):
+        '''
+        Description:
+            SDD rows have a channel "t{i}" = "{t}_{x}_{y}" per position, the frame is the image "{t}" of the video "index".
+        Arguments:
+            info_frame   <DataFrame> - The content of the CSV file with dataset info.
+            get_img_path <function>  - Map (video id, time step) to the frame path.
+        '''
+        nc = num_channels
+        steps = np.stack([info_frame[f't{i}'].astype(str).str.split('_', expand=True).to_numpy()[:,:3] for i in range(nc)], axis=1) # N x nc x (t,x,y)
+        video = info_frame['index'].to_numpy().astype(str)
+        keys = np.char.add(np.char.add(video[:,np.newaxis], '/'), steps[:,:,0].astype(str)) # N x nc
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        paths = np.array([get_img_path(*k.rsplit('/', 1)) for k in unique_keys])
+        frame_ids = inverse.reshape(keys.shape).astype(np.int64)
+
+        return cls(paths, frame_ids,
+                   traj=steps[:,:,1:].astype(float),
+                   time=steps[:,-1,0].astype(int),
+                   T=info_frame['T'].to_numpy(),
+                   label=info_frame[['x','y']].to_numpy(),
+                   index=video,
+                   signature=signature)
+
+    def save(self, index_path):
+        np.savez(index_path, signature=json.dumps(self.signature), **{c:getattr(self, c) for c in self.columns})
+
+    @classmethod
+    def load(cls, index_path, signature=None):
+        # Return None if the file is missing or its signature does not match.
+        try:
+            with np.load(index_path, allow_pickle=False) as data:
+                saved_signature = json.loads(str(data['signature']))
+                if (signature is not None) and (saved_signature != signature):
+                    return None
+                return cls(signature=saved_signature, **{c:data[c] for c in cls.columns})
+        except (OSError, KeyError, ValueError):
+            return None
@@ -0,0 +1,150 @@
+import os
+import json
+import random
+
+import numpy as np
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data_handle.frame_cache import to_uint8
+
+'''
+Sharded dataset format for streaming.
+
+An image stack dataset (with "get_batch", e.g. "data_handler_zip.ImageStackDataset") is exported into
+fixed-size shards of pre-stacked samples, which are then read sequentially by "ShardedIterableDataset".
+
+Shard folder:
+    shard_dir - meta.json       (number of samples, image shape and dtype, shard list)
+              - shard_00000.npz (image: NxCxHxW uint8, label: Nx2, traj: Nx(past+1)x2, index: N, time: N, T: N, floats are float32)
+              - shard_00001.npz
+              - ...
+'''
+
+def export_shards(dataset, shard_dir, samples_per_shard=1000, batch_size=64, image_dtype=np.uint8, verbose=True):
+    '''
+    Description:
+        Export a dataset into shards (in the order of the dataset, the reader shuffles).
+        Each shard is filled "batch_size" samples at a time into compact arrays, so only one shard is in memory:
+        the images as "image_dtype" (uint8 is rounded as in compact datasets, use float32 to keep non-integer frames),
+        the other floating-point arrays as float32.
+    '''
+    if len(dataset) == 0:
+        raise ValueError('Cannot export an empty dataset.')
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for start in range(0, len(dataset), samples_per_shard):
+        stop = min(start+samples_per_shard, len(dataset))
+        shard = {}
+        for first in range(start, stop, batch_size):
+            batch = dataset.get_batch(list(range(first, min(first+batch_size, stop))))
+            for k, v in batch.items():
+                v = v.numpy()
+                if k not in shard:
+                    dtype = image_dtype if k == 'image' else (np.float32 if np.issubdtype(v.dtype, np.floating) else v.dtype)
+                    shard[k] = np.empty((stop-start,)+v.shape[1:], dtype=dtype)
+                if shard[k].dtype == np.uint8:
+                    v = to_uint8(v)
+                shard[k][first-start:first-start+len(v)] = v
+            if verbose:
+                print(f'\rExport shards: {min(first+batch_size, stop)}/{len(dataset)}', end='    ')
+        shard_name = f'shard_{len(shards):05d}.npz'
+        np.savez(os.path.join(shard_dir, shard_name), **shard)
+        shards.append({'name':shard_name, 'num_samples':stop-start})
+    if verbose:
+        print()
+    meta = {'num_samples':len(dataset), 'image_shape':list(shard['image'].shape[1:]),
+            'image_dtype':str(shard['image'].dtype), 'shards':shards}
+    with open(os.path.join(shard_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+class ShardedIterableDataset(IterableDataset):
+    def __init__(self, shard_dir, shuffle=True, buffer_size=1000, seed=0, transform=None):
+        '''
+        Args:
+            shard_dir: Directory with the shards (see "export_shards").
+            shuffle: Shuffle the shard order (per epoch) and the samples within a buffer.
+            buffer_size: Number of samples in the shuffle buffer.
+            transform: Applied to each sample (dict of tensors).
+        Notes:
+            The samples are split evenly over the distributed processes (if initialized, the remainder is dropped
+            as in "DistributedSampler(drop_last=True)"), each process reads consecutive shards of the shuffled order,
+            which are split over its DataLoader workers.
+            Call "set_epoch" before each epoch to change the shuffling (done by "DataHandler",
+            which does not keep the workers of a streaming dataset alive between epochs).
+        '''
+        super().__init__()
+        with open(os.path.join(shard_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.shard_dir = shard_dir
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.tr = transform
+        self.epoch = 0
+
+    def __len__(self):
+        return self.meta['num_samples'] // self.return_world()[1]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def return_world():
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def return_shards(self):
+        '''Return the (shard, start, stop) parts read by this worker.'''
+        shards = list(self.meta['shards'])
+        if self.shuffle:
+            random.Random(self.seed+self.epoch).shuffle(shards) # the same order in all workers and processes
+        rank, world_size = self.return_world()
+        num_samples = self.meta['num_samples'] // world_size
+        first, last = rank*num_samples, (rank+1)*num_samples # the range of this process in the shuffled order
+        parts = []
+        offset = 0
+        for shard in shards:
+            start, stop = max(first-offset, 0), min(last-offset, shard['num_samples'])
+            if start < stop:
+                parts.append((shard, start, stop))
+            offset += shard['num_samples']
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        return parts[worker_id::num_workers]
+
+    def iter_samples(self):
+        for shard, start, stop in self.return_shards():
+            with np.load(os.path.join(self.shard_dir, shard['name'])) as data:
+                data = {k:data[k] for k in data.files}
+            for i in range(start, stop):
+                yield {k:torch.from_numpy(np.asarray(v[i])) for k,v in data.items()}
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        stream_id = self.return_world()[0]*1000 + (0 if worker_info is None else worker_info.id) # a different buffer order in each stream
+        rng = random.Random(f'{self.seed}_{self.epoch}_{stream_id}')
+        buffer = []
+        for sample in self.iter_samples():
+            if not self.shuffle:
+                yield self.transform(sample)
+                continue
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield self.transform(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.transform(sample)
+
+    def transform(self, sample):
+        if self.tr:
+            sample = self.tr(sample)
+        return sample
@@ -133,6 +133,63 @@ class MovingObject():
                 action = (dire[0]*math.sqrt(vmax)+stagger, dire[1]*math.sqrt(vmax)+stagger)
                 self.one_step(ts, action)
 
+def simulate_objects(paths, ts=.2, vmax=0.5, stagger=0, dyn_obs_path=[(0,0)], seed=None, max_steps=10000):
+    '''
+    Description:
+        Batched version of "MovingObject.run": all objects advance at once (same rules, other random numbers).
+    Arguments:
+        paths        (Kx2 or NxKx2) - Waypoints (the first one is the start), one path for all objects or one per object.
+        dyn_obs_path (Lx2 or NxLx2) - Positions of the dynamic obstacle per step, the last one is kept afterwards.
+                                      Per-object paths of different lengths can be padded by repeating the last position.
+        seed         <int/Generator> - Seed of "numpy.random.default_rng".
+        max_steps    <int> - Maximal number of iterations.
+    Return:
+        traj    (NxTx2) - Trajectories padded with NaN.
+        lengths (N)     - Number of positions of each trajectory.
+    '''
+    rng = np.random.default_rng(seed)
+    paths = np.asarray(paths, dtype=np.float64)
+    dyn_obs_path = np.asarray(dyn_obs_path, dtype=np.float64)
+    if paths.ndim == 2:
+        paths = paths[np.newaxis]
+    if dyn_obs_path.ndim == 2:
+        dyn_obs_path = dyn_obs_path[np.newaxis]
+    N, K = paths.shape[0], paths.shape[1]
+    dyn_obs_path = np.broadcast_to(dyn_obs_path, (N,)+dyn_obs_path.shape[1:])
+
+    pos = paths[:,0].copy()
+    waypoint = np.ones(N, dtype=int) # the next goal
+    traj = np.full((N, 64, 2), np.nan)
+    traj[:,0] = pos
+    lengths = np.ones(N, dtype=int)
+    rows = np.arange(N)
+
+    active = waypoint < K
+    cnt = 0
+    while active.any() and (cnt < max_steps):
+        cnt += 1
+        dyn_obs_pos = dyn_obs_path[:, min(cnt, dyn_obs_path.shape[1]-1)]
+        stagger_i = rng.choice([1,-1], size=N) * rng.integers(0, 11, size=N)/10*stagger
+
+        blocked = active & (pos[:,1]>4) & (dyn_obs_pos[:,1]>4.5) # hard constraint from the dynamic obstacle
+        diff = paths[rows, np.minimum(waypoint, K-1)] - pos
+        dist_to_next_goal = np.hypot(diff[:,0], diff[:,1])
+        reached = active & ~blocked & (dist_to_next_goal < (vmax*ts))
+        moving = active & ~blocked & ~reached
+
+        dire = diff[moving] / dist_to_next_goal[moving, np.newaxis]
+        pos[moving] += ts * (dire*math.sqrt(vmax) + stagger_i[moving, np.newaxis])
+        waypoint[reached] += 1
+
+        step = blocked | moving
+        if lengths.max() >= traj.shape[1]: # grow the buffer
+            traj = np.concatenate((traj, np.full_like(traj, np.nan)), axis=1)
+        traj[rows[step], lengths[step]] = pos[step]
+        lengths[step] += 1
+        active = waypoint < K
+
+    return traj[:, :lengths.max()], lengths
+
 
 if __name__ == '__main__':
 
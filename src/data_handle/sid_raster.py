@@ -0,0 +1,148 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from data_handle.sid_object import return_map
+
+'''
+NumPy rasterizer of SID scenes (replaces the matplotlib rendering of "utils_data.save_SID_data").
+
+Images are uint8 grayscale with the same colors as the matplotlib figures:
+    white (255) - free space
+    gray  (128) - static obstacles ("return_map")
+    black (0)   - target and dynamic obstacle (circles)
+The static background of each map is rasterized once (even-odd rule at pixel centres) and cached,
+so a frame is a copy of the background plus one circle (also filled at pixel centres).
+'''
+
+WHITE, GRAY, BLACK = 255, 128, 0
+
+def matplotlib_axes_size(dots_per_inch=None):
+    '''
+    Description:
+        Side in pixels (not rounded) of the equal-aspect axes of the default figure, which the matplotlib renderer
+        of "utils_data.save_SID_data" saves cropped tightly. The image size and the scale of the rasterizer follow from it.
+    '''
+    import matplotlib.pyplot as plt
+    dpi = plt.rcParams['figure.dpi'] if dots_per_inch is None else dots_per_inch
+    width, height = plt.rcParams['figure.figsize']
+    side = min(width*(plt.rcParams['figure.subplot.right']-plt.rcParams['figure.subplot.left']),
+               height*(plt.rcParams['figure.subplot.top']-plt.rcParams['figure.subplot.bottom']))
+    return side * dpi
+
+def matplotlib_img_size(dots_per_inch=None):
+    # size of the matplotlib images, "savefig" truncates the axes box (the top and right fraction of a pixel is lost)
+    return (int(round(matplotlib_axes_size(dots_per_inch), 6)),)*2 # 461.99999 is 462
+
+def draw_circle(canvas, centre, radius, value=BLACK):
+    '''
+    Description:
+        Fill the pixels whose centre is in the disc (in place), clipped at the borders.
+    Arguments:
+        centre (x, y) - Position in pixels (column, row), pixel (i, j) covers [j, j+1) x [i, i+1).
+        radius <float> - Radius in pixels.
+    '''
+    cx, cy = centre
+    x0, x1 = max(int(np.floor(cx-radius)), 0), min(int(np.ceil(cx+radius)), canvas.shape[1])
+    y0, y1 = max(int(np.floor(cy-radius)), 0), min(int(np.ceil(cy+radius)), canvas.shape[0])
+    if (x0<x1) & (y0<y1):
+        dx = np.arange(x0, x1) + 0.5 - cx
+        dy = (np.arange(y0, y1) + 0.5 - cy)[:,np.newaxis]
+        patch = canvas[y0:y1, x0:x1]
+        patch[dx**2 + dy**2 <= radius**2] = value
+    return canvas
+
+def pixel_scale(img_size, extent=(0,10,0,10), dots_per_inch=None):
+    # Pixels per meter (x, y). The image covers the extent, except at the size of the matplotlib images,
+    # where the extent spans the matplotlib axes (a fraction of a pixel larger, see "matplotlib_img_size").
+    if tuple(img_size) == matplotlib_img_size(dots_per_inch):
+        span = (matplotlib_axes_size(dots_per_inch),)*2
+    else:
+        span = (img_size[1], img_size[0])
+    return (span[0]/(extent[1]-extent[0]), span[1]/(extent[3]-extent[2]))
+
+def world2pixel(points, img_size, extent=(0,10,0,10), scale=None):
+    # (x, y) in meters -> (column, row) in pixels, the y-axis points up from the bottom-left corner
+    if scale is None:
+        scale = pixel_scale(img_size, extent)
+    points = np.asarray(points, dtype=np.float64)
+    col = (points[...,0]-extent[0]) * scale[0]
+    row = img_size[0] - (points[...,1]-extent[2]) * scale[1]
+    return np.stack((col, row), axis=-1)
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def save_png(image, img_path):
+    Image.fromarray(image).save(img_path, format='PNG')
+
+
+class SIDRasterizer():
+    def __init__(self, img_size=None, extent=(0,10,0,10), target_size=0.5, dots_per_inch=None):
+        '''
+        Args:
+            img_size: Image size (height, width) in pixels, if None the size of the matplotlib images ("matplotlib_img_size").
+            extent: The area (x_min, x_max, y_min, y_max) in meters covered by the image.
+            target_size: Diameter of the target and the dynamic obstacle in meters.
+            dots_per_inch: Resolution of the matplotlib images, if None the matplotlib default.
+        '''
+        self.img_size = matplotlib_img_size(dots_per_inch) if img_size is None else tuple(img_size)
+        self.extent = extent
+        self.scale = pixel_scale(self.img_size, extent, dots_per_inch) # pixels per meter (x, y)
+        self.radius = target_size/2 * min(self.scale) # in pixels
+        self._background = {}
+
+    def world2pixel(self, points):
+        return world2pixel(points, self.img_size, self.extent, self.scale)
+
+    def polygon_mask(self, polygon):
+        # Even-odd rule at the pixel centres.
+        vertices = self.world2pixel(polygon)
+        cols = np.arange(self.img_size[1]) + 0.5
+        rows = (np.arange(self.img_size[0]) + 0.5)[:,np.newaxis]
+        mask = np.zeros(self.img_size, dtype=bool)
+        for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            if y0 == y1:
+                continue
+            crossing = (rows>=min(y0,y1)) & (rows<max(y0,y1)) # the edge crosses this row
+            x_cross = x0 + (rows-y0) * (x1-x0) / (y1-y0)
+            mask ^= crossing & (cols<x_cross)
+        return mask
+
+    def background(self, map=1, block=False, empty=False):
+        '''
+        Description:
+            The static scene (cached), white with gray obstacles, or only white if "empty".
+            Do not modify the returned array.
+        '''
+        key = (map, block, empty)
+        if key not in self._background:
+            canvas = np.full(self.img_size, WHITE, dtype=np.uint8)
+            if not empty:
+                for obstacle in return_map(map, block)[1]:
+                    canvas[self.polygon_mask(obstacle)] = GRAY
+            self._background[key] = canvas
+        return self._background[key]
+
+    def render(self, map=1, block=False, empty=False, positions=()):
+        '''
+        Arguments:
+            positions - Circles (x, y) in meters drawn on the background.
+        Return:
+            image (HxW, uint8)
+        '''
+        canvas = self.background(map, block, empty).copy()
+        for pos in positions:
+            draw_circle(canvas, self.world2pixel(pos), self.radius)
+        return canvas
+
+    def render_obj(self, pos):
+        # the "obj" channel: the target on an empty canvas
+        return self.render(empty=True, positions=[pos])
+
+    def render_env(self, map, obs_pos, block=False):
+        # the "env" channel: the static obstacles and the dynamic obstacle
+        return self.render(map, block, positions=[obs_pos])
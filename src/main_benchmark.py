@@ -0,0 +1,254 @@
+import os, sys
+import tempfile
+from timeit import default_timer as timer
+from pathlib import Path
+
+import torchvision
+
+from data_handle import data_handler_zip as dh
+from data_handle import data_handler as dh_folder
+
+from util import utils_yaml
+from util import utils_data
+from util import utils_benchmark as ub
+
+print("Program: benchmark\n")
+
+### Config file name
+config_file = 'ewta_20.yml'
+sdd_config_file = 'sdd_ewta_20_test.yml' # for SDD benchmarks
+benchmark = 'frame_cache' # frame_cache, workers, lru_cache, sdd_latency, compact, batched, io_threads, gather_all_data, sid_render, sid_simulation, sid_archive, dedup, fuse, int8, backends, onnx
+
+### Load parameters and define paths
+root_dir = Path(__file__).parents[1]
+param_path = os.path.join(root_dir, 'Config/', config_file)
+param = utils_yaml.from_yaml(param_path)
+
+zip_path  = os.path.join(root_dir, param['zip_path'])
+csv_path  = os.path.join(param['data_name'], param['label_csv'])
+data_dir  = param['data_name']
+cache_dir = os.path.join(root_dir, param['data_root'], param['data_name']+'_frames')
+
+num_samples = 500
+num_batches = 50
+cache_bytes = 2*1024**3
+max_workers = dh.DataHandler.auto_num_workers()
+io_threads  = 8 # for the folder-based dataset
+
+### Benchmark
+composed = torchvision.transforms.Compose([dh.ToTensor()])
+
+if benchmark == 'frame_cache':
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'])
+    ub.print_result('ZIP', ub.sample_throughput(dataset, num_samples), 'samples/s')
+
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'], cache_dir=cache_dir)
+    ub.print_result('Frame store', ub.sample_throughput(dataset, num_samples), 'samples/s')
+
+elif benchmark == 'workers':
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'])
+    num_workers = 0
+    while num_workers <= max_workers:
+        myDH = dh.DataHandler(dataset, batch_size=param['batch_size'], validation_prop=0, num_workers=num_workers)
+        ub.print_result(f'{num_workers} workers', ub.loader_throughput(myDH, num_batches), 'samples/s')
+        del myDH
+        num_workers = max(2*num_workers, 1)
+
+elif benchmark == 'lru_cache':
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'], cache_bytes=cache_bytes)
+    myDH = dh.DataHandler(dataset, batch_size=param['batch_size'], validation_prop=0)
+    ub.print_result('LRU cache', ub.loader_throughput(myDH, num_batches), 'samples/s')
+    ub.print_result('LRU cache', dataset.cache.stats())
+
+elif benchmark == 'sdd_latency':
+    param = utils_yaml.from_yaml(os.path.join(root_dir, 'Config/', sdd_config_file))
+    zip_path = os.path.join(root_dir, param['zip_path'])
+    csv_path = os.path.join(param['data_name'], param['label_csv'])
+    dataset = dh.ImageStackDatasetSDD(zip_path, csv_path, param['data_name'], transform=composed, T_channel=param['with_T'])
+    ub.print_result('SDD latency, per-item lookups (before)', ub.sample_latency(ub.SDDPerItemLookup(dataset), num_samples), 'ms')
+    ub.print_result('SDD latency, video index (after)', ub.sample_latency(dataset, num_samples), 'ms')
+
+elif benchmark == 'compact':
+    for compact in [False, True]:
+        dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'], compact=compact)
+        myDH = dh.DataHandler(dataset, batch_size=param['batch_size'], validation_prop=0)
+        ub.print_result(f'Compact={compact}, one epoch', ub.epoch_throughput(myDH))
+        del myDH
+
+elif benchmark == 'batched':
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'], cache_dir=cache_dir, compact=True)
+    for batched in [False, True]:
+        myDH = dh.DataHandler(dataset, batch_size=param['batch_size'], validation_prop=0, batched=batched)
+        ub.print_result(f'Batched={batched}', ub.loader_throughput(myDH, num_batches), 'samples/s')
+        del myDH
+
+elif benchmark == 'io_threads':
+    folder_csv = os.path.join(root_dir, param['data_root'], param['data_name'], param['label_csv'])
+    folder_dir = os.path.join(root_dir, param['data_root'], param['data_name'])
+    for threads in [0, io_threads]:
+        dataset = dh_folder.ImageStackDataset(folder_csv, folder_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'], io_threads=threads)
+        ub.print_result(f'{threads} I/O threads', ub.sample_latency(dataset, num_samples), 'ms')
+        myDH = dh_folder.DataHandler(dataset, batch_size=param['batch_size'], validation_prop=0, num_workers=0, read_ahead=dataset.read_ahead)
+        ub.print_result(f'{threads} I/O threads, read-ahead', ub.loader_throughput(myDH, num_batches), 'samples/s')
+        del myDH
+
+elif benchmark == 'gather_all_data':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_dir = os.path.join(tmp_dir, 'objects')
+        ub.make_synthetic_tree(synthetic_dir, num_objects=5000, num_frames=50, channel_per_image=param['cpi'])
+        for num_workers in [0, max_workers]:
+            start = timer()
+            utils_data.gather_all_data(synthetic_dir, past=param['past'], maxT=10, channel_per_image=param['cpi'],
+                                       save_dir=tmp_dir, num_workers=num_workers, verbose=False)
+            ub.print_result(f'Gather all data, {num_workers} workers', timer()-start, 's')
+        ub.make_synthetic_tree(synthetic_dir, num_objects=50, num_frames=50, channel_per_image=param['cpi'], first_id=5001)
+        start = timer()
+        utils_data.gather_all_data(synthetic_dir, past=param['past'], maxT=10, channel_per_image=param['cpi'],
+                                   save_dir=tmp_dir, num_workers=max_workers, verbose=False, incremental=True)
+        ub.print_result('Gather all data, incremental (50 new objects)', timer()-start, 's')
+
+elif benchmark == 'sid_render':
+    from data_handle.sid_raster import SIDRasterizer
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for renderer in ['matplotlib', 'numpy']:
+            start = timer()
+            utils_data.save_SID_data([2], tmp_dir, sim_time_per_scene=5, channel_per_image=param['cpi'], renderer=renderer)
+            nframes = sum([len(files) for _,_,files in os.walk(tmp_dir)])
+            ub.print_result(f'SID {renderer} renderer', nframes/(timer()-start), 'frames/s (with PNG)')
+    raster = SIDRasterizer() # the size of the matplotlib images
+    start = timer()
+    for i in range(num_samples):
+        raster.render_env(2, (4.5, 10-i/num_samples*10))
+    ub.print_result('SID numpy renderer', num_samples/(timer()-start), 'frames/s (array only)')
+
+elif benchmark == 'sid_simulation':
+    # speed and statistics of the per-object and the batched simulator (should match up to sampling noise)
+    import numpy as np
+    from data_handle import sid_object
+    graph = sid_object.Graph(map=1, block=False)
+    path, dyn_obs_path = graph.get_path(2), graph.get_obs_path(0.2)
+    start = timer()
+    trajs = []
+    for _ in range(num_samples):
+        obj = sid_object.MovingObject(path[0], stagger=0.2)
+        obj.run(path, ts=0.2, vmax=1, dyn_obs_path=dyn_obs_path)
+        trajs.append(np.array(obj.traj))
+    ub.print_result('MovingObject.run', num_samples/(timer()-start), 'objects/s')
+    lengths = np.array([len(traj) for traj in trajs])
+    ends = np.array([traj[-1] for traj in trajs])
+    ub.print_result('MovingObject.run', {'length_mean':lengths.mean(), 'length_std':lengths.std(), 'end_y_mean':ends[:,1].mean(), 'end_y_std':ends[:,1].std()})
+
+    start = timer()
+    traj, lengths = sid_object.simulate_objects(np.broadcast_to(path, (num_samples,3,2)), ts=0.2, vmax=1, stagger=0.2, dyn_obs_path=dyn_obs_path, seed=0)
+    ub.print_result('simulate_objects', num_samples/(timer()-start), 'objects/s')
+    ends = traj[np.arange(num_samples), lengths-1]
+    ub.print_result('simulate_objects', {'length_mean':lengths.mean(), 'length_std':lengths.std(), 'end_y_mean':ends[:,1].mean(), 'end_y_std':ends[:,1].std()})
+
+elif benchmark == 'sid_archive':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_workers in [0, max_workers]:
+            start = timer()
+            stats = utils_data.gen_SID_archive(list(range(1,13)), os.path.join(tmp_dir, 'SID_Bench.zip'), sim_time_per_scene=20,
+                                               past=param['past'], maxT=10, channel_per_image=param['cpi'], num_workers=num_workers, verbose=False)
+            nframes = sum([w['frames'] for w in stats.values()])
+            ub.print_result(f'SID archive, {num_workers} workers', nframes/(timer()-start), 'frames/s')
+
+elif benchmark == 'dedup':
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'], cache_dir=cache_dir)
+    ub.print_result('Frame store', dataset.store.stats())
+
+elif benchmark == 'fuse':
+    # Conv-BN folding on CPU, the outputs should match the eval-mode model up to float rounding
+    import copy
+    import torch
+    from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'])
+    image = dataset[0]['image'].unsqueeze(0).float()
+    for Net in [ConvMultiHypoNet, ConvMixtureDensityNet]:
+        net = Net(param['input_channel'], param['dim_out'], param['fc_input'], num_components=param['num_components']).eval()
+        fused = copy.deepcopy(net).fuse_for_inference()
+        with torch.no_grad():
+            ub.print_result(f'{Net.__name__}, fused', {'max_abs_diff':ub.max_abs_diff(fused(image), net(image))})
+        ub.print_result(f'{Net.__name__}, eval', ub.model_latency(net, image), 'ms')
+        ub.print_result(f'{Net.__name__}, fused', ub.model_latency(fused, image), 'ms')
+
+elif benchmark == 'int8':
+    # Int8 (static backbone, dynamic heads) against fp32 on CPU, with the trained model if it exists
+    import torch
+    from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet
+    from net_module import quantization
+    mdn = param['model_path'].split('/')[-1].startswith('mdn')
+    Net = ConvMixtureDensityNet if mdn else ConvMultiHypoNet
+    net = Net(param['input_channel'], param['dim_out'], param['fc_input'], num_components=param['num_components'])
+    model_path = os.path.join(root_dir, param['model_path'])
+    if os.path.exists(model_path):
+        net.load_state_dict({k.replace('Net.', '', 1):v for k,v in torch.load(model_path, map_location='cpu').items()})
+    net.eval()
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'])
+    qnet = quantization.quantize_net(net, dataset, num_samples=num_samples)
+    image = dataset[0]['image'].unsqueeze(0).float()
+    metric = 'NLL' if mdn else 'oracle'
+    loss_fp32 = quantization.evaluate_net(net, dataset, num_samples, mdn=mdn)
+    loss_int8 = quantization.evaluate_net(qnet, dataset, num_samples, mdn=mdn)
+    ub.print_result(f'{Net.__name__}, {metric}', {'fp32':loss_fp32, 'int8':loss_int8, 'delta':loss_int8-loss_fp32})
+    ub.print_result(f'{Net.__name__}, size', {'fp32':quantization.model_size(net), 'int8':quantization.model_size(qnet)}, 'MB')
+    ub.print_result(f'{Net.__name__}, fp32', ub.model_latency(net, image), 'ms')
+    ub.print_result(f'{Net.__name__}, int8', ub.model_latency(qnet, image), 'ms')
+
+elif benchmark == 'backends':
+    # "NetworkManager.inference" on CPU with the compiled backends (cached in a temporary directory)
+    import numpy as np
+    from net_module.net import ConvMultiHypoNet
+    from network_manager import NetworkManager
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'])
+    image = dataset[0]['image']
+    net = ConvMultiHypoNet(param['input_channel'], param['dim_out'], param['fc_input'], num_components=param['num_components'])
+    myNet = NetworkManager(net, loss_function_dict={}, device='cpu', verbose=False)
+    myNet.build_Network()
+    myNet.compile_Model('eager')
+    reference = myNet.inference(image)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in ['eager', 'trace', 'script', 'compile']:
+            start = timer()
+            myNet.compile_Model(backend, example_input=image, cache_dir=tmp_dir)
+            ub.print_result(f'{backend} -> {myNet.backend}, compilation', timer()-start, 's')
+            if myNet.backend != backend:
+                continue
+            hyposM = myNet.inference(image) # also the warm-up (torch.compile compiles lazily)
+            ub.print_result(f'{backend}, parity', {'max_abs_diff':np.abs(hyposM-reference).max()})
+            latency = []
+            for _ in range(num_batches):
+                start = timer()
+                myNet.inference(image)
+                latency.append((timer()-start)*1000)
+            ub.print_result(f'{backend}, inference', {'p50':np.percentile(latency, 50), 'mean':np.mean(latency)}, 'ms')
+
+elif benchmark == 'onnx':
+    # ONNX export of the three networks, parity with PyTorch on a batch of another size (dynamic axis), and CPU latency
+    import numpy as np
+    import torch
+    from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet, ConvMultiHypoMixtureDensityFit
+    from net_module.onnx_export import ExportWrapper, export_onnx, check_parity
+    from onnx_network import OnnxNetwork
+    dataset = dh.ImageStackDataset(zip_path, csv_path, data_dir, channel_per_image=param['cpi'], transform=composed, T_channel=param['with_T'])
+    batch = torch.stack([dataset[i]['image'] for i in range(5)]).float()
+    nets = [ConvMultiHypoNet(param['input_channel'], param['dim_out'], param['fc_input'], num_components=param['num_components']),
+            ConvMixtureDensityNet(param['input_channel'], param['dim_out'], param['fc_input'], num_components=param['num_components']),
+            ConvMultiHypoMixtureDensityFit(param['input_channel'], param['dim_out'], param['fc_input'], num_hypos=param['num_components'], num_gaus=5)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for net in nets:
+            name = type(net).__name__
+            onnx_path = os.path.join(tmp_dir, name+'.onnx')
+            export_onnx(net, onnx_path, batch.shape[1:])
+            onnx_net = OnnxNetwork(onnx_path)
+            ub.print_result(f'{name}, parity', {'max_abs_diff':check_parity(net, onnx_net, batch)})
+            ub.print_result(f'{name}, PyTorch', ub.model_latency(ExportWrapper(net.eval()), batch[:1]), 'ms')
+            latency = []
+            for _ in range(num_batches):
+                start = timer()
+                onnx_net.inference(batch[0].numpy(), mdn=onnx_net.meta['mdn'])
+                latency.append((timer()-start)*1000)
+            ub.print_result(f'{name}, onnxruntime', {'p50':np.percentile(latency, 50), 'mean':np.mean(latency)}, 'ms')
+
+else:
+    raise ModuleNotFoundError(f'No such benchmark as {benchmark}.')
@@ -32,7 +32,7 @@ class SamplingMixtureDensityModule(nn.Module):
         self.myMLP = nn.Linear(dim_input*num_hypos, num_hypos*num_gaus)
         self.sfx = nn.Softmax(dim=2) # for each hypo
 
-    def forward(self, x, device='cuda'): # x as a feature vector, in nbatch * dimension of x
+    def forward(self, x, device: str='cuda'): # x as a feature vector, in nbatch * dimension of x
         '''
             x: Bx(KxC)
             gamma = r1,1 r1,2 ... r1,M
@@ -48,12 +48,12 @@ class SamplingMixtureDensityModule(nn.Module):
         z = self.myMLP(x).reshape((-1, self.K, self.M))
         xK = x.reshape((-1, self.K, self.dim_input))
         gamma = self.sfx(z) # BxKxM
-        alpha = torch.sum(gamma, axis=1)/self.K # BxM
+        alpha = torch.sum(gamma, dim=1)/self.K # BxM
         mu    = torch.zeros(x.shape[0], self.M, self.dim_input).to(device)
         sigma = torch.zeros(x.shape[0], self.M, self.dim_input).to(device)
         for i in range(self.M):
-            mu[:,i,:]    = torch.sum(gamma[:,:,i].unsqueeze(2) * xK, axis=1) / torch.sum(gamma[:,:,i], dim=1).unsqueeze(1)
-            sigma[:,i,:] = torch.sum(gamma[:,:,i].unsqueeze(2) * (xK-mu[:,i,:].unsqueeze(1))**2, axis=1) / torch.sum(gamma[:,:,i], dim=1).unsqueeze(1)
+            mu[:,i,:]    = torch.sum(gamma[:,:,i].unsqueeze(2) * xK, dim=1) / torch.sum(gamma[:,:,i], dim=1).unsqueeze(1)
+            sigma[:,i,:] = torch.sum(gamma[:,:,i].unsqueeze(2) * (xK-mu[:,i,:].unsqueeze(1))**2, dim=1) / torch.sum(gamma[:,:,i], dim=1).unsqueeze(1)
         return alpha, mu, sigma
 
 def take_mainCompo(alp, mu, sigma, main=3):
@@ -1,13 +1,42 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.init import kaiming_normal_, constant_
 
 from net_module.submodules import compact_conv_layer as conv
+from net_module.submodules import compact_linear_layer, fuse_conv_bn_layers
 from net_module.module_wta import *
 
 from net_module import module_mdn
 
+class InferenceMixin():
+    # Shared by the backbones and the networks (with nn.Module), written to be scriptable (torch.jit.script).
+    def fuse_for_inference(self):
+        # Fold the BatchNorm layers into the convolutions (in place), the model is then only for inference.
+        return fuse_conv_bn_layers(self.eval())
+
+    @torch.jit.ignore
+    def plot_features(self, out_conv):
+        # Debug view of the first backbone feature maps of the first sample (on "self.axes").
+        for i, ax in enumerate(self.axes.ravel()):
+            ax.cla()
+            ax.imshow(out_conv[0,i,:,:].cpu().detach().numpy())
+
+    def init_horizon(self, T_embed):
+        # Embedding of a scalar horizon T, appended to the features before "fc1" (identity/unused if T_embed=0).
+        self.T_embed = T_embed
+        self.embed_T = compact_linear_layer(False, 1, T_embed) if T_embed > 0 else nn.Identity()
+
+    def append_horizon(self, x, T: Optional[torch.Tensor]):
+        # Concatenate the embedding of the horizon T (batch) to the flattened features.
+        if self.T_embed > 0:
+            if T is None:
+                raise ValueError('The network expects the input (image, T) with a scalar horizon T.')
+            x = torch.cat((x, self.embed_T(T.view(-1,1).to(x.dtype))), dim=1)
+        return x
+
 def make_layer(block, in_ch, out_ch, num_blocks, stride=1): # layer 1,2,3,4
     downsample = None
     if stride != 1 or in_ch != out_ch:
@@ -22,6 +51,7 @@ def make_layer(block, in_ch, out_ch, num_blocks, stride=1): # layer 1,2,3,4
     return nn.Sequential(*layers)
 
 class StemBlock(nn.Module): # deep stem
+    __constants__ = ['deep'] # only one branch of "forward" is scripted
     def __init__(self, in_channel, deep_stem=False, with_batch_norm=True):
         super().__init__()
         self.deep = deep_stem
@@ -49,6 +79,7 @@ class BasicBlock(nn.Module):
         self.conv2 = conv(with_batch_norm, out_channel, out_channel, kernel_size=3, stride=1, padding=1, activate=False)
         self.downsample = downsample
         self.leaky = nn.LeakyReLU(inplace=True)
+        self.skip_add = nn.quantized.FloatFunctional() # a plain add, but quantizable (see "quantization")
 
     def forward(self, x):
         out = self.conv2(self.conv1(x))
@@ -56,11 +87,30 @@ class BasicBlock(nn.Module):
             identity = self.downsample(x)
         else:
             identity = x
-        out += identity
+        out = self.skip_add.add(out, identity)
         out = self.leaky(out)
         return out
 
-class ResNet34Lite(nn.Module):
+def split_input(x):
+    # The input is an image batch, or (image batch, T) for the networks with a scalar horizon input ("T_embed").
+    # A scripted network only takes an image batch.
+    if not torch.jit.is_scripting():
+        if isinstance(x, (tuple, list)):
+            return x[0], x[1]
+    return x, None
+
+def infer_fc_input(backbone, input_channel, input_size):
+    # Size of the flattened backbone output for an input of "input_size" (HxW), by a dummy forward pass.
+    if input_size is None:
+        raise ValueError('Either "fc_input" or "input_size" must be given.')
+    training = backbone.training
+    backbone.eval()
+    with torch.no_grad():
+        out = backbone(torch.zeros(1, input_channel, *input_size))
+    backbone.train(training)
+    return out[0].numel()
+
+class ResNet34Lite(InferenceMixin, nn.Module):
     def __init__(self, in_channel, block, with_batch_norm):
         super().__init__()
         num_layers = [3,4,6,3]
@@ -81,7 +131,8 @@ class ResNet34Lite(nn.Module):
         x = self.apool(x)
         return x
 
-class ResNet34(nn.Module):
+
+class ResNet34(InferenceMixin, nn.Module):
     def __init__(self, in_channel, block, with_batch_norm):
         super().__init__()
         num_layers = [3,4,6,3]
@@ -103,9 +154,12 @@ class ResNet34(nn.Module):
         return x
 
 
-class ConvMultiHypoNet(nn.Module):
+class ConvMultiHypoNet(InferenceMixin, nn.Module):
     # batch x channel x height x width
-    def __init__(self, input_channel, dim_output, fc_input, num_components, with_batch_norm=True, axes=None, lite=True):
+    __constants__ = ['T_embed']
+    def __init__(self, input_channel, dim_output, fc_input, num_components, with_batch_norm=True, axes=None, lite=True, T_embed=0, input_size=None):
+        # T_embed: Size of the embedding of a scalar horizon T, appended to the features before "fc1" (0 for no T input).
+        # input_size: Image size (HxW), used to infer "fc_input" if it is None.
         super(ConvMultiHypoNet,self).__init__()
 
         if lite:
@@ -113,10 +167,13 @@ class ConvMultiHypoNet(nn.Module):
         else:
             self.resnet34 = ResNet34(input_channel, BasicBlock, with_batch_norm)
 
+        if fc_input is None:
+            fc_input = infer_fc_input(self.resnet34, input_channel, input_size)
+        self.init_horizon(T_embed)
         if lite:
-            self.fc1   = nn.Linear(fc_input,128)
+            self.fc1   = nn.Linear(fc_input+T_embed,128)
         else:
-            self.fc1   = nn.Linear(fc_input,1024)
+            self.fc1   = nn.Linear(fc_input+T_embed,1024)
         self.leaky = nn.LeakyReLU(inplace=True)
 
         self.M = num_components
@@ -129,27 +186,32 @@ class ConvMultiHypoNet(nn.Module):
         self.axes = axes
 
     def forward(self, x):
+        x, T = split_input(x)
         out_conv = self.resnet34(x)
 
         if self.axes is not None:
-            for i, ax in enumerate(self.axes.ravel()):
-                ax.cla()
-                ax.imshow(out_conv[0,i,:,:].cpu().detach().numpy())
+            self.plot_features(out_conv)
 
         x = out_conv.view(out_conv.size(0), -1) # batch x -1
+        x = self.append_horizon(x, T)
         x = self.leaky(self.fc1(x))
         x = self.swarm(x)
 
         return x
 
-class ConvMixtureDensityNet(nn.Module):
+
+class ConvMixtureDensityNet(InferenceMixin, nn.Module):
     # batch x channel x height x width
-    def __init__(self, input_channel, dim_output, fc_input, num_components, with_batch_norm=True, axes=None):
+    __constants__ = ['T_embed']
+    def __init__(self, input_channel, dim_output, fc_input, num_components, with_batch_norm=True, axes=None, T_embed=0, input_size=None):
         super(ConvMixtureDensityNet,self).__init__()
 
         self.resnet34 = ResNet34Lite(input_channel, BasicBlock, with_batch_norm)
 
-        self.fc1   = nn.Linear(fc_input,128)
+        if fc_input is None:
+            fc_input = infer_fc_input(self.resnet34, input_channel, input_size)
+        self.init_horizon(T_embed)
+        self.fc1   = nn.Linear(fc_input+T_embed,128)
         self.leaky = nn.LeakyReLU(inplace=True)
 
         self.M = num_components
@@ -158,19 +220,20 @@ class ConvMixtureDensityNet(nn.Module):
         self.axes = axes
 
     def forward(self, x):
+        x, T = split_input(x)
         out_conv = self.resnet34(x)
 
         if self.axes is not None:
-            for i, ax in enumerate(self.axes.ravel()):
-                ax.cla()
-                ax.imshow(out_conv[0,i,:,:].cpu().detach().numpy())
+            self.plot_features(out_conv)
 
         x = out_conv.view(out_conv.size(0), -1) # batch x -1
+        x = self.append_horizon(x, T)
         x = self.leaky(self.fc1(x))
         x = self.mdn(x)
 
         return x
 
+
 class ConvMixtureDensityFit(nn.Module):
     # batch x channel x height x width
     def __init__(self, multi_hypo_net, dim_output, num_hypos, num_gaus, with_batch_norm=True, axes=None):
@@ -185,20 +248,24 @@ class ConvMixtureDensityFit(nn.Module):
 
         self.axes = axes
 
-    def forward(self, x, device='cuda'):
+    def forward(self, x, device: str='cuda'):
         x = self.multihyponet(x)
         x = self.smdn(x, device=device)
         return x
 
 
-class ConvMultiHypoMixtureDensityFit(nn.Module):
+class ConvMultiHypoMixtureDensityFit(InferenceMixin, nn.Module):
     # batch x channel x height x width
-    def __init__(self, input_channel, dim_output, fc_input, num_hypos, num_gaus, with_batch_norm=True, axes=None):
+    __constants__ = ['T_embed']
+    def __init__(self, input_channel, dim_output, fc_input, num_hypos, num_gaus, with_batch_norm=True, axes=None, T_embed=0, input_size=None):
         super(ConvMultiHypoMixtureDensityFit,self).__init__()
 
         self.resnet34 = ResNet34Lite(input_channel, BasicBlock, with_batch_norm)
 
-        self.fc1   = nn.Linear(fc_input,128)
+        if fc_input is None:
+            fc_input = infer_fc_input(self.resnet34, input_channel, input_size)
+        self.init_horizon(T_embed)
+        self.fc1   = nn.Linear(fc_input+T_embed,128)
         self.leaky = nn.LeakyReLU(inplace=True)
 
         self.K = num_hypos
@@ -208,15 +275,15 @@ class ConvMultiHypoMixtureDensityFit(nn.Module):
 
         self.axes = axes
 
-    def forward(self, x, device='cuda'):
+    def forward(self, x, device: str='cuda'):
+        x, T = split_input(x)
         out_conv = self.resnet34(x)
 
         if self.axes is not None:
-            for i, ax in enumerate(self.axes.ravel()):
-                ax.cla()
-                ax.imshow(out_conv[0,i,:,:].cpu().detach().numpy())
+            self.plot_features(out_conv)
 
         x = out_conv.view(out_conv.size(0), -1) # batch x -1
+        x = self.append_horizon(x, T)
         x = self.leaky(self.fc1(x))
         x = self.swarm(x)
 
@@ -224,3 +291,4 @@ class ConvMultiHypoMixtureDensityFit(nn.Module):
 
         return x
 
+
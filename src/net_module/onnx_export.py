@@ -0,0 +1,79 @@
+import os
+import json
+import copy
+import inspect
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet, ConvMultiHypoMixtureDensityFit
+
+'''
+Export the networks to ONNX (with a dynamic batch axis), to serve them with "onnx_network.OnnxNetwork" (onnxruntime, no PyTorch).
+The export writes "<name>.onnx" and "<name>.json" (the number of components and the input/output names).
+'''
+
+class ExportWrapper(nn.Module):
+    # (image, T) as two graph inputs, and a fixed CPU device for the sampling MDN of "ConvMultiHypoMixtureDensityFit".
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+        self.fit = isinstance(net, ConvMultiHypoMixtureDensityFit)
+
+    def forward(self, image, T=None):
+        x = image if T is None else (image, T)
+        if self.fit:
+            return self.net(x, device='cpu')
+        return self.net(x)
+
+def export_onnx(net, onnx_path, input_shape, opset_version=13):
+    '''
+    Description:
+        Export a (trained) ConvMultiHypoNet, ConvMixtureDensityNet, or ConvMultiHypoMixtureDensityFit.
+    Arguments:
+        input_shape - Shape of one input image (CxHxW), the batch axis is dynamic.
+    Return:
+        meta <dict> - What is saved in the JSON file.
+    '''
+    if not isinstance(net, (ConvMultiHypoNet, ConvMixtureDensityNet, ConvMultiHypoMixtureDensityFit)):
+        raise ModuleNotFoundError(f'No ONNX export for {type(net).__name__}.')
+    model = ExportWrapper(copy.deepcopy(net).cpu().eval())
+    args = (torch.zeros(2, *input_shape),)
+    input_names = ['image']
+    if net.T_embed > 0:
+        args += (torch.ones(2),)
+        input_names.append('T')
+    mdn = not isinstance(net, ConvMultiHypoNet)
+    output_names = ['alpha', 'mu', 'sigma'] if mdn else ['hypos']
+    dynamic_axes = {name:{0:'batch'} for name in input_names+output_names}
+    # the TorchScript exporter ("dynamic_axes"), newer PyTorch defaults to the dynamo exporter which needs onnxscript
+    legacy = {'dynamo':False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model, args, onnx_path, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, **legacy)
+
+    meta = {'net':type(net).__name__, 'M':net.M, 'mdn':mdn, 'inputs':input_names, 'outputs':output_names, 'input_shape':list(input_shape)}
+    with open(os.path.splitext(onnx_path)[0]+'.json', 'w') as jf:
+        json.dump(meta, jf)
+    return meta
+
+def check_parity(net, onnx_net, data, atol=1e-4):
+    '''
+    Description:
+        Compare the outputs of an "onnx_network.OnnxNetwork" with the PyTorch network (CPU, eval mode).
+    Arguments:
+        data - A batch of images (BxCxHxW), or (images, T) for the networks with "T_embed".
+    Return:
+        max_abs_diff <float> - Raises AssertionError if it is above "atol".
+    '''
+    model = ExportWrapper(copy.deepcopy(net).cpu().eval())
+    inputs = data if isinstance(data, (tuple, list)) else (data,)
+    with torch.no_grad():
+        outputs = model(*[torch.as_tensor(np.asarray(x, dtype=np.float32)) for x in inputs])
+    outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+    onnx_outputs = onnx_net.run(data)
+    max_abs_diff = max([np.abs(o.numpy()-r).max() for o, r in zip(outputs, onnx_outputs)])
+    assert(max_abs_diff <= atol), (f'The ONNX outputs differ from PyTorch by {max_abs_diff} (>{atol}).')
+    return max_abs_diff
@@ -0,0 +1,91 @@
+import io
+import copy
+import random
+
+import torch
+import torch.nn as nn
+import torch.quantization as tq
+
+from net_module.submodules import fuse_conv_bn_layers
+from net_module import loss_functions as loss_func
+
+'''
+Int8 quantization of "ConvMultiHypoNet" and "ConvMixtureDensityNet" for CPU inference:
+    backbone ("resnet34") - static quantization (BN folded into the convolutions, calibrated on dataset samples)
+    fc1 and the heads     - dynamic quantization (int8 weights, activations quantized on the fly)
+The backbone is wrapped with Quant/DeQuant stubs, so the rest of the network still works on float tensors.
+'''
+
+def sample_batch(dataset, idc, scalar_T=False):
+    # Stack samples of an ImageStackDataset, the input is (image, T) for the networks with "T_embed".
+    samples = [dataset[idx] for idx in idc]
+    if not all(isinstance(s['image'], torch.Tensor) and isinstance(s['label'], torch.Tensor) for s in samples):
+        raise TypeError('The samples must be tensors (image CxHxW, label), build the dataset with "transform=ToTensor()".')
+    image = torch.stack([torch.as_tensor(s['image']) for s in samples]).float()
+    label = torch.stack([torch.as_tensor(s['label']) for s in samples]).float()
+    if scalar_T:
+        T = torch.tensor([s['T'] for s in samples]).float()
+        return (image, T), label
+    return image, label
+
+def calibrate(net, dataset, num_samples=200, batch_size=20, seed=0):
+    # Run random samples through a prepared network so that the observers record the activation ranges.
+    rng = random.Random(seed)
+    idc = rng.sample(range(len(dataset)), min(num_samples, len(dataset)))
+    with torch.no_grad():
+        for i in range(0, len(idc), batch_size):
+            net(sample_batch(dataset, idc[i:i+batch_size], net.T_embed>0)[0])
+    return net
+
+def quantize_net(net, dataset, num_samples=200, backend='fbgemm', seed=0):
+    '''
+    Description:
+        Quantize a (trained) network for CPU inference, the input network is not modified.
+    Arguments:
+        dataset - Samples for calibration, e.g. an "ImageStackDataset".
+        backend - "fbgemm" for x86 or "qnnpack" for ARM.
+    Return:
+        qnet - The quantized network (eval mode, CPU only).
+    '''
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ModuleNotFoundError(f'The quantization backend {backend} is not supported here ({torch.backends.quantized.supported_engines}).')
+    torch.backends.quantized.engine = backend
+
+    qnet = copy.deepcopy(net).cpu().eval()
+    fuse_conv_bn_layers(qnet.resnet34)
+    for module in qnet.resnet34.modules(): # the quantized leaky_relu does not work in place
+        if isinstance(module, nn.LeakyReLU):
+            module.inplace = False
+    qnet.resnet34 = tq.QuantWrapper(qnet.resnet34)
+    qnet.resnet34.qconfig = tq.get_default_qconfig(backend)
+    tq.prepare(qnet, inplace=True)
+    calibrate(qnet, dataset, num_samples, seed=seed)
+    tq.convert(qnet, inplace=True)
+    return tq.quantize_dynamic(qnet, {nn.Linear}, dtype=torch.qint8)
+
+def evaluate_net(net, dataset, num_samples=200, batch_size=20, mdn=False, seed=1):
+    '''
+    Description:
+        Mean oracle loss (closest hypothesis, for multi-hypothesis networks) or NLL (for mixture density networks)
+        on random samples of a dataset.
+    '''
+    rng = random.Random(seed)
+    idc = rng.sample(range(len(dataset)), min(num_samples, len(dataset)))
+    loss, nsamples = 0, 0
+    with torch.no_grad():
+        for i in range(0, len(idc), batch_size):
+            data, label = sample_batch(dataset, idc[i:i+batch_size], net.T_embed>0)
+            outputs = net(data)
+            if mdn:
+                batch_loss = loss_func.loss_NLL(*outputs, label)
+            else:
+                batch_loss = loss_func.meta_loss(outputs, net.M, label, loss_func.loss_mse)
+            loss += batch_loss.item() * label.shape[0]
+            nsamples += label.shape[0]
+    return loss / nsamples
+
+def model_size(net):
+    # Size of the serialized state dict in MB.
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1024**2
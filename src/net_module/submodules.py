@@ -39,3 +39,36 @@ def compact_conv_layer(with_batch_norm, input_channel, output_channel, kernel_si
         raise(Exception('No need to use compact layers.'))
     return layer
 
+def fuse_conv_bn(conv, bn):
+    # Fold the (running) statistics of a BatchNorm2d into the preceding Conv2d.
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=True, padding_mode=conv.padding_mode)
+    fused = fused.to(device=conv.weight.device, dtype=conv.weight.dtype)
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.affine:
+            scale = scale * bn.weight
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.reshape(-1,1,1,1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + (bn.bias if bn.affine else 0))
+    return fused
+
+def fuse_conv_bn_layers(module):
+    '''
+    Description:
+        Fold every Conv2d-BatchNorm2d pair in the Sequentials of a module (recursively, in place),
+        e.g. "compact_conv_layer" and the downsampling of "make_layer".
+        A Sequential left with one layer is replaced by this layer. Only for inference (eval mode).
+    '''
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential):
+            layers = []
+            for layer in child:
+                if isinstance(layer, nn.BatchNorm2d) and len(layers) and isinstance(layers[-1], nn.Conv2d):
+                    layers[-1] = fuse_conv_bn(layers[-1], layer)
+                else:
+                    layers.append(fuse_conv_bn_layers(layer))
+            setattr(module, name, layers[0] if len(layers)==1 else nn.Sequential(*layers))
+        else:
+            fuse_conv_bn_layers(child)
+    return module
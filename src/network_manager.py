@@ -1,4 +1,5 @@
 import os, sys
+import hashlib
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -38,6 +39,7 @@ class NetworkManager():
         self.save_dir = checkpoint_dir
 
         self.complete = False
+        self.backend = 'eager' # see "compile_Model"
         # self.tracker = []
         # self.grad_tracker = []
 
@@ -73,28 +75,110 @@ class NetworkManager():
             pass
         else:
             raise ModuleNotFoundError(f'No such device as {self.device} (should be "multi", "cuda", or "cpu").')
+        self.inference_model = self.model
         return self.model
 
+    def model_hash(self):
+        # Hash of the architecture and the weights (changes after training or loading a checkpoint).
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(self.model).encode())
+        for key, value in self.model.state_dict().items():
+            h.update(key.encode())
+            h.update(value.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def compile_Model(self, backend='eager', example_input=None, cache_dir=None):
+        '''
+        Description:
+            Compile the (trained/loaded) model for "inference", the training still uses the eager model.
+            Falls back to the eager model if the compilation fails.
+        Arguments:
+            backend       - "eager", "trace" (torch.jit.trace), "script" (torch.jit.script), or "compile" (torch.compile).
+            example_input - One sample (as for "inference"), required for "trace".
+            cache_dir     - Cache the traced/scripted model on disk, keyed by the model hash and the input shape.
+        '''
+        if backend not in ['eager', 'trace', 'script', 'compile']:
+            raise ModuleNotFoundError(f'No such backend as {backend} (should be "eager", "trace", "script", or "compile").')
+        self.model.eval()
+        self.inference_model = self.model
+        self.backend = 'eager'
+        if backend == 'eager':
+            return self.inference_model
+        device = torch.device("cuda:0") if self.device in ['multi', 'cuda'] else 'cpu'
+        model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+        try:
+            if backend == 'compile':
+                if not hasattr(torch, 'compile'):
+                    raise ModuleNotFoundError('torch.compile is not available in this version of PyTorch.')
+                compiled = torch.compile(model) # cached by PyTorch itself (TORCHINDUCTOR_CACHE_DIR)
+            else:
+                if (backend == 'trace') & (example_input is None):
+                    raise ValueError('The "trace" backend needs an example input.')
+                if example_input is not None:
+                    example_input = self.to_device(self.add_batch_dim(example_input), device)
+                cache_path = None
+                if cache_dir is not None:
+                    if example_input is None:
+                        shape = 'any'
+                    else: # (image, T) with a scalar horizon
+                        shapes = example_input if isinstance(example_input, tuple) else (example_input,)
+                        shape = '_'.join(['x'.join([str(d) for d in x.shape]) for x in shapes])
+                    cache_path = os.path.join(cache_dir, f'{backend}_{self.model_hash()}_{shape}.pt')
+                if (cache_path is not None) and os.path.exists(cache_path):
+                    compiled = torch.jit.load(cache_path, map_location=device)
+                else:
+                    with torch.no_grad():
+                        if backend == 'trace':
+                            compiled = torch.jit.trace(model, (example_input,))
+                        else:
+                            compiled = torch.jit.script(model)
+                    if cache_path is not None:
+                        os.makedirs(cache_dir, exist_ok=True)
+                        torch.jit.save(compiled, cache_path)
+        except Exception as err:
+            print(f'>>> Compilation with "{backend}" failed, fall back to eager ({type(err).__name__}: {err}) <<<')
+            return self.inference_model
+        self.inference_model = compiled
+        self.backend = backend
+        return self.inference_model
+
     def gen_Optimizer(self, parameters):
         self.optimizer = optim.Adam(parameters, lr=self.lr, weight_decay=self.w_decay, betas=(0.99, 0.999))
         # self.optimizer = optim.SGD(parameters, lr=1e-3, momentum=0.9)
         self.lr_scheduler = optim.lr_scheduler.ExponentialLR(optimizer=self.optimizer, gamma=0.99)
         return self.optimizer
 
-    def inference(self, data, mdn=False):
+    @staticmethod
+    def to_device(data, device):
+        # Compact (uint8) batches are moved first and converted to float on the device (fewer bytes to transfer).
+        if isinstance(data, (tuple, list)): # (image, T) with a scalar horizon
+            return tuple(NetworkManager.to_device(d, device) for d in data)
+        if data.dtype == torch.uint8:
+            return data.to(device).float()
+        return data.float().to(device)
+
+    @staticmethod
+    def add_batch_dim(data):
+        if isinstance(data, (tuple, list)): # (image, T) with a scalar horizon
+            return tuple(torch.as_tensor(d).unsqueeze(0) for d in data)
+        return data.unsqueeze(0)
+
+    def inference(self, data, mdn=False, centre=None):
+        # centre: The current position (sample['centre']) of an agent-centric sample, added back to the outputs.
         if self.device in ['multi', 'cuda']:
             device = torch.device("cuda:0")
         else:
             device = 'cpu'
+        offset = 0 if centre is None else np.asarray(centre, dtype=np.float64)
         with torch.no_grad():
             if mdn:
-                alp, mu, sigma = self.model(data.unsqueeze(0).float().to(device))
+                alp, mu, sigma = self.inference_model(self.to_device(self.add_batch_dim(data), device))
                 alp = alp[0].cpu().detach().numpy()
-                mu  = mu[0].cpu().detach().numpy()
+                mu  = mu[0].cpu().detach().numpy() + offset
                 sigma = sigma[0].cpu().detach().numpy()
                 return alp, mu, sigma
-            hypos = self.model(data.unsqueeze(0).float().to(device)).cpu().detach()
-        hyposM = hypos.reshape(hypos.shape[0],self.M,-1).numpy() # BxMxC
+            hypos = self.inference_model(self.to_device(self.add_batch_dim(data), device)).cpu().detach()
+        hyposM = hypos.reshape(hypos.shape[0],self.M,-1).numpy() + offset # BxMxC
         return hyposM
 
     def validate(self, data, labels, loss_function, k_top=1):
@@ -137,7 +221,7 @@ class NetworkManager():
                 batch_time_start = timer() ### TIMER
 
                 batch, label = data_handler.return_batch()
-                batch, label = batch.float().to(device), label.float().to(device)
+                batch, label = self.to_device(batch, device), label.float().to(device)
 
                 loss = self.train_batch(batch, label, loss_function=loss_epoch, k_top=k_top) # train here
                 self.Loss.append(loss.item())
@@ -148,7 +232,7 @@ class NetworkManager():
                     del batch
                     del label
                     val_data, val_label = data_handler.return_val()
-                    val_data, val_label = val_data.float().to(device), val_label.float().to(device)
+                    val_data, val_label = self.to_device(val_data, device), val_label.float().to(device)
                     val_loss = self.validate(val_data, val_label, loss_function=loss_epoch)
                     self.Val_loss.append((cnt, val_loss.item()))
                     if self.metric is not None:
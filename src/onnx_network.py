@@ -0,0 +1,50 @@
+import os
+import json
+
+import numpy as np
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+class OnnxNetwork():
+    """
+    Run a network exported by "net_module.onnx_export" with onnxruntime (no PyTorch needed),
+    with the same "inference" interface as "NetworkManager".
+    """
+    def __init__(self, onnx_path, providers=None):
+        '''
+        Args:
+            onnx_path: The ".onnx" file, the ".json" file with the same name must be next to it.
+            providers: onnxruntime execution providers, default CPU.
+        '''
+        if onnxruntime is None:
+            raise ModuleNotFoundError('The ONNX adapter needs onnxruntime (pip install onnxruntime).')
+        with open(os.path.splitext(onnx_path)[0]+'.json', 'r') as jf:
+            self.meta = json.load(jf)
+        self.M = self.meta['M']
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=providers or ['CPUExecutionProvider'])
+
+    def run(self, data):
+        # data: A batch (BxCxHxW), or (batch, T) for the networks with a scalar horizon.
+        inputs = data if isinstance(data, (tuple, list)) else (data,)
+        feed = {name:np.asarray(x, dtype=np.float32) for name, x in zip(self.meta['inputs'], inputs)}
+        return self.session.run(self.meta['outputs'], feed)
+
+    @staticmethod
+    def add_batch_dim(data):
+        if isinstance(data, (tuple, list)): # (image, T) with a scalar horizon
+            return tuple(np.asarray(d, dtype=np.float32)[np.newaxis] for d in data)
+        return np.asarray(data, dtype=np.float32)[np.newaxis]
+
+    def inference(self, data, mdn=False, centre=None):
+        # centre: The current position (sample['centre']) of an agent-centric sample, added back to the outputs.
+        offset = 0 if centre is None else np.asarray(centre, dtype=np.float64)
+        outputs = self.run(self.add_batch_dim(data))
+        if mdn:
+            alp, mu, sigma = outputs
+            return alp[0], mu[0] + offset, sigma[0]
+        hypos = outputs[0]
+        hyposM = hypos.reshape(hypos.shape[0],self.M,-1) + offset # BxMxC
+        return hyposM
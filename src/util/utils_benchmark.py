@@ -0,0 +1,146 @@
+import os
+import random
+import resource
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+'''
+Helpers to measure the data pipeline and the networks.
+'''
+
+def sample_throughput(dataset, num_samples=200, seed=0, warmup=5):
+    '''
+    Description:
+        Read random samples from a dataset one by one.
+    Return:
+        samples_per_second <float>
+    '''
+    rng = random.Random(seed)
+    idc = [rng.randrange(len(dataset)) for _ in range(num_samples+warmup)]
+    for idx in idc[:warmup]:
+        dataset[idx]
+    start = timer()
+    for idx in idc[warmup:]:
+        dataset[idx]
+    return num_samples / (timer()-start)
+
+def sample_latency(dataset, num_samples=200, seed=0, percentiles=(50,90,99)):
+    '''
+    Return:
+        latency <dict> - Per-sample latency [ms] at the given percentiles and the mean.
+    '''
+    rng = random.Random(seed)
+    latency = []
+    for _ in range(num_samples):
+        idx = rng.randrange(len(dataset))
+        start = timer()
+        dataset[idx]
+        latency.append((timer()-start)*1000)
+    result = {f'p{p}':np.percentile(latency, p) for p in percentiles}
+    result['mean'] = np.mean(latency)
+    return result
+
+def loader_throughput(data_handler, num_batches=50, warmup=2):
+    '''
+    Description:
+        Read batches from the training loader of a DataHandler.
+    Return:
+        samples_per_second <float>
+    '''
+    for _ in range(warmup): # also spawns the workers
+        data_handler.return_batch()
+    nsamples = 0
+    start = timer()
+    for _ in range(num_batches):
+        image, _ = data_handler.return_batch()
+        nsamples += image.shape[0]
+    return nsamples / (timer()-start)
+
+def epoch_throughput(data_handler):
+    '''
+    Description:
+        Read one full epoch from the training loader of a DataHandler.
+    Return:
+        result <dict> - Samples per second, bytes of one image batch, and peak memory [MB] of the main process.
+    '''
+    nsamples = 0
+    batch_bytes = 0
+    start = timer()
+    for _ in range(data_handler.return_length_dl()):
+        image, _ = data_handler.return_batch()
+        nsamples += image.shape[0]
+        batch_bytes = max(batch_bytes, image.element_size()*image.nelement())
+    return {'samples_per_second':nsamples/(timer()-start), 'batch_MB':batch_bytes/1024**2,
+            'peak_rss_MB':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024}
+
+class SDDPerItemLookup():
+    '''
+    Description:
+        An SDD dataset with the per-item lookups it did before the video index ("before" numbers of "sdd_latency"):
+        for every channel, a scan of the archive member names for the video's CSV file and an extra image decode
+        (the image shape in "rescale_label").
+    '''
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        video_idx = sample['index']
+        for _ in range(self.dataset.nc):
+            [x for x in self.dataset.archive.namelist() if ((video_idx in x)&('csv' in x))]
+            self.dataset.check_img_shape()
+        return sample
+
+def make_synthetic_tree(data_dir, num_objects=2000, num_frames=50, channel_per_image=2, seed=0, first_id=1):
+    '''
+    Description:
+        Create object folders with only the per-object CSV files (as from "utils_data.gen_csv_trackers"),
+        to benchmark the index generation without images.
+    '''
+    rng = np.random.default_rng(seed)
+    for obj_id in range(first_id, first_id+num_objects):
+        obj_dir = os.path.join(data_dir, str(obj_id), 'obj' if channel_per_image==2 else '')
+        os.makedirs(obj_dir, exist_ok=True)
+        x, y = np.cumsum(rng.normal(size=(2,num_frames)), axis=1).round(4)
+        index = rng.integers(1, 13)
+        f = [f'{obj_id}_{t}_{x[t]}_{y[t]}_{index}.png' for t in range(num_frames)]
+        df = pd.DataFrame({'f':f, 't':np.arange(num_frames), 'x':x, 'y':y, 'index':index})
+        df.to_csv(os.path.join(obj_dir, 'data.csv'), index=False)
+
+def model_latency(model, inputs, num_runs=50, warmup=5, percentiles=(50,90,99)):
+    '''
+    Description:
+        Forward passes of a model (no gradients) on the same inputs.
+    Return:
+        latency <dict> - Per-forward latency [ms] at the given percentiles and the mean.
+    '''
+    latency = []
+    with torch.no_grad():
+        for i in range(num_runs+warmup):
+            start = timer()
+            model(inputs)
+            if i >= warmup:
+                latency.append((timer()-start)*1000)
+    result = {f'p{p}':np.percentile(latency, p) for p in percentiles}
+    result['mean'] = np.mean(latency)
+    return result
+
+def max_abs_diff(outputs, reference):
+    # outputs can be tuples (e.g. alpha, mu, sigma of a mixture density network)
+    if isinstance(outputs, (tuple, list)):
+        return max([max_abs_diff(o, r) for o, r in zip(outputs, reference)])
+    return (outputs.float()-reference.float()).abs().max().item()
+
+def print_result(name, value, unit=''):
+    if isinstance(value, dict):
+        value = ', '.join([f'{k}: {round(v,3)}' for k,v in value.items()])
+    else:
+        value = round(value, 3)
+    print(f'[{name}] {value} {unit}')
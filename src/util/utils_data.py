@@ -1,5 +1,14 @@
 import os, sys
+import json
+import random
+import shutil
+import hashlib
+import zipfile
+import tempfile
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
 
 import numpy as np
 import pandas as pd
@@ -9,9 +18,11 @@ import matplotlib.patches as patches
 
 try:
     from data_handle.sid_object import *
+    from data_handle.sid_raster import SIDRasterizer, save_png, encode_png, matplotlib_img_size
 except:
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from data_handle.sid_object import *
+    from data_handle.sid_raster import SIDRasterizer, save_png, encode_png, matplotlib_img_size
 
 '''
 There are 3 kinds of folder structure:
@@ -24,15 +35,17 @@ Functions 'gen_csv_trackers' and 'gather_all_data' are universal.
 They only depend on the data structure version.
 '''
 
-def gen_csv_trackers(data_dir, channel_per_image=2): # Data structure 2
+def gen_csv_trackers(data_dir, channel_per_image=2, incremental=False): # Data structure 2
     # data_dir - obj - obj&env (each object has its own environment)
+    # If incremental, skip the objects whose CSV file is newer than their image folder.
     cpi = channel_per_image
-    obj_folders = os.listdir(data_dir)
+    obj_folders = [f for f in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, f))]
     for objf in obj_folders:
-        if cpi == 1:
-            obj_files = os.listdir(os.path.join(data_dir, objf)) # all files/images under this folder
-        else:
-            obj_files = os.listdir(os.path.join(data_dir, objf, 'obj')) # all files/images under this folder
+        img_dir = os.path.join(data_dir, objf) if cpi == 1 else os.path.join(data_dir, objf, 'obj')
+        csv_path = obj_csv_path(data_dir, objf, cpi)
+        if incremental and os.path.exists(csv_path) and (os.path.getmtime(csv_path) >= os.path.getmtime(img_dir)):
+            continue
+        obj_files = os.listdir(img_dir) # all files/images under this folder
         t_list = []   # time or time step
         x_list = []   # x coordinate
         y_list = []   # y coordinate
@@ -51,44 +64,147 @@ def gen_csv_trackers(data_dir, channel_per_image=2): # Data structure 2
         for f in invalid_files:
             obj_files.remove(f)
         df = pd.DataFrame({'f':obj_files,'t':t_list,'x':x_list,'y':y_list, 'index':idx_list}).sort_values(by='t', ignore_index=True)
-        if cpi == 1:
-            df.to_csv(os.path.join(data_dir, objf, '/data.csv'), index=False)
-        else:
-            df.to_csv(os.path.join(data_dir, objf, 'obj/data.csv'), index=False)
+        df.to_csv(csv_path, index=False)
+
+def obj_csv_path(data_dir, objf, channel_per_image):
+    # the CSV file generated by "gen_csv_trackers" for an object folder
+    if channel_per_image == 1:
+        return os.path.join(data_dir, objf, 'data.csv')
+    return os.path.join(data_dir, objf, 'obj/data.csv')
+
+def gen_obj_windows(df_obj, past, maxT, channel_per_image=1, minT=1, period=1):
+    '''
+    Description:
+        All samples of one object for all T at once (rows ordered by T, then by start frame).
+        Sample i of horizon T has the frames i+j*period (j=0,...,past) and the label at frame i+past+T.
+    Arguments:
+        df_obj <DataFrame> - Frames of the object sorted by time (see "gen_csv_trackers").
+    Return:
+        columns <dict> - Columns of the samples (see "gather_all_data").
+    '''
+    cpi = channel_per_image
+    Ts = np.arange(minT, maxT+1)
+    counts = np.maximum(len(df_obj)-past*period-Ts, 0) # number of samples per T
+    T = np.repeat(Ts, counts)
+    i = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts) # start frame of each sample
+    frames = i[:,np.newaxis] + np.arange(past+1)*period # N x (past+1)
+    target = i + past + T
+
+    obj_names = df_obj['f'].to_numpy().astype(str)
+    if cpi == 2:
+        parts = df_obj['f'].str.split('_')
+        env_names = (parts.str[0]+'_'+parts.str[1]+'_'+parts.str[-1]).to_numpy().astype(str)
+    columns = {}
+    for j in range(past+1):
+        columns[f'f{cpi*j}'] = obj_names[frames[:,j]]
+        if cpi == 2:
+            columns[f'f{cpi*j+1}'] = env_names[frames[:,j]]
+    columns['T'] = T
+    for c in ['x', 'y', 'index']:
+        columns[c] = df_obj[c].to_numpy()[target]
+    return columns
+
+def bounded_map(pool, fn, tasks, window):
+    # Like "pool.map" (results in the order of the tasks), but at most "window" tasks are submitted
+    # and not yet consumed, so the results waiting in memory do not grow with the number of tasks.
+    tasks = iter(tasks)
+    pending = deque(pool.submit(fn, task) for _, task in zip(range(window), tasks))
+    while pending:
+        result = pending.popleft().result()
+        for task in tasks: # refill one
+            pending.append(pool.submit(fn, task))
+            break
+        yield result
+
+def _gather_obj(args):
+    # worker of "gather_all_data"
+    data_dir, objf, past, maxT, cpi, minT, period = args
+    df_obj = pd.read_csv(obj_csv_path(data_dir, objf, cpi)) # generated by "gen_csv_trackers"
+    return pd.DataFrame(gen_obj_windows(df_obj, past, maxT, cpi, minT, period))
 
-def gather_all_data(data_dir, past, maxT, channel_per_image=1, minT=1, period=1, save_dir=None): # Data structure 2
+def obj_signature(csv_path, old_signature=None):
+    # mtime, size and content hash of an object CSV file, the hash is reused if mtime and size are unchanged
+    stat = os.stat(csv_path)
+    signature = {'mtime':stat.st_mtime, 'size':stat.st_size}
+    if (old_signature is not None) and all(old_signature.get(k)==v for k,v in signature.items()):
+        signature['hash'] = old_signature['hash']
+    else:
+        with open(csv_path, 'rb') as f:
+            signature['hash'] = hashlib.md5(f.read()).hexdigest()
+    return signature
+
+def load_manifest(manifest_path, params):
+    # Return None if the manifest is missing or was made with other parameters.
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('params') != params:
+        return None
+    return manifest
+
+def gather_all_data(data_dir, past, maxT, channel_per_image=1, minT=1, period=1, save_dir=None, num_workers=0, verbose=True,
+                    incremental=False): # Data structure 2
     # data_dir  -  objf(1,2,...) - obj&env
+    '''
+    Description:
+        Generate "all_data.csv" from the CSV files of all object folders.
+        The folders are processed by a pool of "num_workers" processes (0 in this process, 'auto' for all CPU cores),
+        and their samples are appended to the CSV file in the order of the folders.
+        At most 2*num_workers folders are in flight (see "bounded_map"), so the memory does not grow with the dataset.
+        The indexed objects (content hash and number of samples) are recorded in "all_data_manifest.json".
+        If incremental, only new or changed objects are processed: the samples of changed or removed objects
+        are dropped from the existing CSV file, and those of new or changed objects are appended.
+    '''
     if save_dir is None:
         save_dir = data_dir
     cpi = channel_per_image
+    if num_workers == 'auto': # the pool needs a "__main__" guard with the spawn start method
+        num_workers = os.cpu_count() or 1
 
-    column_name = [f'f{i}' for i in range(0,cpi*(past+1))] + ['T', 'x', 'y', 'index']
-    df_all = pd.DataFrame(columns=column_name)
-    obj_folders = os.listdir(data_dir)
-    cnt = 0
-    for objf in obj_folders:
-        cnt += 1
-        print(f'\rProcess {cnt}/{len(obj_folders)}', end='    ')
-        df_obj = pd.read_csv(os.path.join(data_dir, objf, 'obj/data.csv')) # generated by "gen_csv_trackers"
-        for T in range(minT,maxT+1):
-            sample_list = []
-            for i in range(len(df_obj)-past*period-T): # each sample
-                sample = []
-                ################## Sample START ##################
-                for j in range(past+1):
-                    obj_filename = df_obj.iloc[i+j*period]['f']
-                    sample.append(obj_filename)
-                    if cpi == 2:
-                        sample.append(obj_filename.split('_')[0]+'_'+obj_filename.split('_')[1]+'_'+obj_filename.split('_')[-1])
-                sample.append(T)
-                sample.append(df_obj.iloc[i+past+T]['x'])
-                sample.append(df_obj.iloc[i+past+T]['y'])
-                sample.append(df_obj.iloc[i+past+T]['index'])
-                ################## Sample E N D ##################
-                sample_list.append(sample)
-            df_T = pd.DataFrame(sample_list, columns=df_all.columns)
-            df_all = pd.concat([df_all, df_T], ignore_index=True)
-    df_all.to_csv(os.path.join(save_dir, 'all_data.csv'), index=False)
+    csv_path = os.path.join(save_dir, 'all_data.csv')
+    manifest_path = os.path.join(save_dir, 'all_data_manifest.json')
+    params = {'data_dir':os.path.abspath(data_dir), 'past':past, 'maxT':maxT, 'cpi':cpi, 'minT':minT, 'period':period}
+    manifest = load_manifest(manifest_path, params) if (incremental and os.path.exists(csv_path)) else None
+    indexed = {} if manifest is None else manifest['objects'] # objf: signature and number of samples (in the order of the CSV file)
+
+    obj_folders = [f for f in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, f))]
+    signatures = {objf:obj_signature(obj_csv_path(data_dir, objf, cpi), indexed.get(objf)) for objf in obj_folders}
+
+    if manifest is None:
+        column_name = [f'f{i}' for i in range(0,cpi*(past+1))] + ['T', 'x', 'y', 'index']
+        pd.DataFrame(columns=column_name).to_csv(csv_path, index=False) # header
+    else:
+        stale = [objf for objf in indexed if (objf not in signatures) or (signatures[objf]['hash']!=indexed[objf]['hash'])]
+        if stale:
+            keep = np.repeat([objf not in stale for objf in indexed], [indexed[objf]['rows'] for objf in indexed])
+            df_all = pd.read_csv(csv_path, dtype=str, keep_default_na=False) # keep the text as it is
+            df_all[keep].to_csv(csv_path, index=False)
+            indexed = {objf:v for objf,v in indexed.items() if objf not in stale}
+    obj_folders = [objf for objf in obj_folders if objf not in indexed]
+    if os.path.exists(manifest_path): # invalid until the CSV file is complete
+        os.remove(manifest_path)
+
+    tasks = [(data_dir, objf, past, maxT, cpi, minT, period) for objf in obj_folders]
+    if num_workers > 0:
+        pool = ProcessPoolExecutor(max_workers=num_workers)
+        results = bounded_map(pool, _gather_obj, tasks, window=2*num_workers)
+    else:
+        results = map(_gather_obj, tasks)
+    with open(csv_path, 'a', newline='') as f:
+        for cnt, (objf, df_obj) in enumerate(zip(obj_folders, results)):
+            if verbose:
+                print(f'\rProcess {cnt+1}/{len(obj_folders)}', end='    ')
+            df_obj.to_csv(f, header=False, index=False)
+            indexed[objf] = {**signatures[objf], 'rows':len(df_obj)}
+    if num_workers > 0:
+        pool.shutdown()
+    if verbose:
+        print()
+
+    with open(manifest_path, 'w') as f: # written after the CSV file
+        json.dump({'params':params, 'objects':indexed}, f)
 
 
 def index2map(index):
@@ -104,10 +220,19 @@ def index2map(index):
                 }
     return map_dict[index]
 
-def save_SID_data(index_list, save_path, sim_time_per_scene:int, channel_per_image=1, dots_per_inch=None):
+def save_SID_data(index_list, save_path, sim_time_per_scene:int, channel_per_image=1, dots_per_inch=None, renderer='matplotlib', img_size=None):
     # SID - Single-target Interaction Dataset
+    '''
+    Arguments:
+        renderer - "matplotlib" (figures saved by "savefig") or "numpy" ("sid_raster.SIDRasterizer", grayscale PNG).
+        img_size - Image size (height, width) of the numpy renderer, if None the size of the matplotlib images.
+    '''
     cpi = channel_per_image
     dpi = dots_per_inch
+    if renderer == 'numpy':
+        raster = SIDRasterizer(img_size, target_size=0.5, dots_per_inch=dpi)
+    elif renderer != 'matplotlib':
+        raise ModuleNotFoundError(f'No such renderer as {renderer}.')
 
     cnt = 0
     overall_sim_time = sim_time_per_scene * len(index_list)
@@ -129,6 +254,18 @@ def save_SID_data(index_list, save_path, sim_time_per_scene:int, channel_per_ima
             obj = MovingObject(path[0], stagger)
             obj.run(path, ts, vmax, dyn_obs_path=dyn_obs_path)
             for j, tr in enumerate(obj.traj):
+                if renderer == 'numpy':
+                    obs_pos = dyn_obs_path[min(j, len(dyn_obs_path)-1)]
+                    obj_name = f'{cnt}_{j}_{round(tr[0],4)}_{round(tr[1],4)}_{idx}.png'
+                    if cpi == 1:
+                        save_SID_frame(raster.render(map_idx, positions=[tr]), save_path, f'{cnt}/', obj_name)
+                    elif cpi == 2:
+                        save_SID_frame(raster.render_obj(tr), save_path, f'{cnt}/obj', obj_name)
+                        save_SID_frame(raster.render_env(map_idx, obs_pos), save_path, f'{cnt}/env', f'{cnt}_{j}_{idx}.png')
+                    else:
+                        raise(ModuleNotFoundError('CPI must be 1 or 2.'))
+                    continue
+
                 shape = patches.Circle(tr, radius=target_size/2, fc='k')
                 try:
                     obs_shape = patches.Circle(dyn_obs_path[j], radius=target_size/2, fc='k')
@@ -183,4 +320,120 @@ def save_SID_data(index_list, save_path, sim_time_per_scene:int, channel_per_ima
                 else:
                     raise(ModuleNotFoundError('CPI must be 1 or 2.'))
 
-    print()
\ No newline at end of file
+    print()
+
+def save_SID_frame(image, save_path, sub_folder, img_name):
+    if save_path is None:
+        plt.imshow(image, cmap='gray', vmin=0, vmax=255)
+        plt.show()
+    else:
+        folder = os.path.join(save_path, sub_folder)
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        save_png(image, os.path.join(folder, img_name))
+
+_raster_cache = {} # one rasterizer (with its backgrounds) per image size and process
+
+def _render_SID_chunk(args):
+    # worker of "gen_SID_archive": simulate and render a chunk of objects of one scene
+    chunk_id, idx, path, first_id, num_objects, cpi, img_size, root_dir, window_args, seed, obj_images = args
+    start = timer()
+    map_idx, path_idx, interact = index2map(idx) # map parameters
+    stagger, vmax, target_size, ts = (0.2, 1, 0.5, 0.2) # object parameters
+    if img_size not in _raster_cache:
+        _raster_cache[img_size] = SIDRasterizer(img_size, target_size=target_size)
+    raster = _raster_cache[img_size]
+
+    graph = Graph(map=map_idx, block=False)
+    dyn_obs_path = graph.get_obs_path(ts) if interact else [(-1,-1)]
+    traj, lengths = simulate_objects([path]*num_objects, ts, vmax, stagger, dyn_obs_path, seed=[seed, chunk_id])
+
+    members = [] # (name in the archive, bytes)
+    windows = [] # rows of "all_data.csv"
+    for k in range(num_objects):
+        obj_id = first_id + k
+        rows = []
+        for j in range(lengths[k]):
+            tr = traj[k,j]
+            obj_name = f'{obj_id}_{j}_{round(float(tr[0]),4)}_{round(float(tr[1]),4)}_{idx}.png'
+            if cpi == 1:
+                members.append((f'{root_dir}/{obj_id}/{obj_name}', encode_png(raster.render(map_idx, positions=[tr]))))
+            else:
+                obs_pos = dyn_obs_path[min(j, len(dyn_obs_path)-1)]
+                if obj_images:
+                    members.append((f'{root_dir}/{obj_id}/obj/{obj_name}', encode_png(raster.render_obj(tr))))
+                members.append((f'{root_dir}/{obj_id}/env/{obj_id}_{j}_{idx}.png', encode_png(raster.render_env(map_idx, obs_pos))))
+            rows.append((obj_name, j, round(float(tr[0]),4), round(float(tr[1]),4), idx))
+        df_obj = pd.DataFrame(rows, columns=['f','t','x','y','index']) # as from "gen_csv_trackers"
+        members.append((obj_csv_path(root_dir, str(obj_id), cpi), df_obj.to_csv(index=False).encode()))
+        windows.append(pd.DataFrame(gen_obj_windows(df_obj, *window_args)).to_csv(header=False, index=False))
+    return {'members':members, 'windows':''.join(windows), 'pid':os.getpid(),
+            'objects':num_objects, 'frames':int(lengths.sum())*cpi, 'seconds':timer()-start}
+
+def gen_SID_archive(index_list, zip_path, sim_time_per_scene:int, past, maxT, channel_per_image=2, minT=1, period=1,
+                    root_dir=None, img_size=None, num_workers=0, objects_per_chunk=20, seed=0, obj_images=True, verbose=True):
+    # SID - Single-target Interaction Dataset
+    '''
+    Description:
+        Generate a SID dataset directly into a ZIP file (see "data_handler_zip.ImageStackDataset"), in one pass:
+            root_dir - objf(1,2,...) - obj&env (PNG from "sid_raster.SIDRasterizer") & obj/data.csv
+                     - all_data.csv
+        The objects are simulated ("simulate_objects") and rendered in chunks by a pool of "num_workers" processes
+        (0 in this process, 'auto' for all CPU cores), only this process writes the archive.
+    Arguments:
+        root_dir - Folder in the archive, if None the name of the ZIP file.
+        img_size - Image size (height, width), if None the size of the matplotlib images.
+        obj_images - If false (cpi=2), the object images are not written, the dataset must render them ("render_obj").
+    Return:
+        stats <dict> - Objects, frames and busy seconds of each worker (pid).
+    '''
+    cpi = channel_per_image
+    if root_dir is None:
+        root_dir = os.path.splitext(os.path.basename(zip_path))[0]
+    img_size = matplotlib_img_size() if img_size is None else tuple(img_size)
+    if num_workers == 'auto': # the pool needs a "__main__" guard with the spawn start method
+        num_workers = os.cpu_count() or 1
+
+    state = random.getstate()
+    random.seed(seed) # one path per scene (some paths have a random end), as in "save_SID_data"
+    paths = [Graph(map=index2map(idx)[0], block=False).get_path(index2map(idx)[1]) for idx in index_list]
+    random.setstate(state)
+
+    tasks = []
+    obj_id = 1
+    for idx, path in zip(index_list, paths):
+        for first in range(0, sim_time_per_scene, objects_per_chunk):
+            num_objects = min(objects_per_chunk, sim_time_per_scene-first)
+            tasks.append((len(tasks), idx, path, obj_id, num_objects, cpi, img_size, root_dir, (past, maxT, cpi, minT, period), seed, obj_images))
+            obj_id += num_objects
+    total = obj_id - 1
+
+    if num_workers > 0:
+        pool = ProcessPoolExecutor(max_workers=num_workers)
+        results = bounded_map(pool, _render_SID_chunk, tasks, window=2*num_workers)
+    else:
+        results = map(_render_SID_chunk, tasks)
+
+    stats = {}
+    done = 0
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive, tempfile.SpooledTemporaryFile(max_size=2**26) as all_data:
+        column_name = [f'f{i}' for i in range(0,cpi*(past+1))] + ['T', 'x', 'y', 'index']
+        all_data.write(pd.DataFrame(columns=column_name).to_csv(index=False).encode()) # header
+        for result in results:
+            for name, data in result['members']:
+                archive.writestr(name, data)
+            all_data.write(result['windows'].encode())
+            worker = stats.setdefault(result['pid'], {'objects':0, 'frames':0, 'seconds':0})
+            for k in worker:
+                worker[k] += result[k]
+            done += result['objects']
+            if verbose:
+                throughput = ', '.join([f'{w["frames"]/w["seconds"]:.0f}' for w in stats.values()])
+                print(f'\rGenerate: {done}/{total} objects | frames/s per worker: {throughput}', end='    ')
+        all_data.seek(0)
+        with archive.open(f'{root_dir}/all_data.csv', 'w', force_zip64=True) as f:
+            shutil.copyfileobj(all_data, f)
+    if num_workers > 0:
+        pool.shutdown()
+    if verbose:
+        print()
+    return stats
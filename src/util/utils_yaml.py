@@ -7,7 +7,7 @@ from pathlib import Path
 This is used to load and dump parameters in the form of YAML
 '''
 
-file_name = 'sdd_ewta_15_test.yml'
+file_name = 'sdd_ewta_20_test.yml'
 sl_path = os.path.join(Path(__file__).resolve().parents[2], 'Config/', file_name)
 
 general_param = {'with_T'   : False, 
@@ -20,7 +20,7 @@ general_param = {'with_T'   : False,
                  'fc_input' : 23040, # 4608, 23040
                  'device'   : 'cuda',
                  }
-general_param['input_channel'] = (general_param['past']+1) * general_param['cpi'] + general_param['with_T']
+general_param['input_channel'] = (general_param['past']+1) * general_param['cpi'] + int(general_param['with_T'] is True) # no T channel if 'scalar'
 
 training_param = {'epoch'            : 20, 
                   'validation_prop'  : 0.2, 
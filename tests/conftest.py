@@ -0,0 +1,16 @@
+import os, sys
+
+# The modules import each other relative to "src" (as when running the main files from there).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import pytest
+
+@pytest.fixture
+def sid_archive(tmp_path):
+    '''Factory of a small SID archive "SID_T.zip" (root folder "SID_T") in "tmp_path", returns the path of the ZIP file.'''
+    def make(img_size=(100,100)):
+        from util import utils_data
+        zip_path = os.path.join(tmp_path, 'SID_T.zip')
+        utils_data.gen_SID_archive([1], zip_path, sim_time_per_scene=2, past=2, maxT=3, img_size=img_size, num_workers=0, verbose=False)
+        return zip_path
+    return make
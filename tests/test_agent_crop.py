@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+
+from data_handle.agent_crop import crop_stack
+from data_handle import data_handler_zip as dh
+
+def test_crop_stack_pad_per_channel():
+    image = np.arange(2*4*5).reshape(2,4,5)
+    crop, origin = crop_stack(image, (0, 0), (4, 4), channels_first=True, pad_value=[255, 0])
+    assert (origin == [-2, -2]).all()
+    assert (crop[:,2:,2:] == image[:,:2,:2]).all()
+    assert (crop[0,:2] == 255).all() and (crop[1,:2] == 0).all()
+    crop, _ = crop_stack(np.moveaxis(image, 0, 2), (0, 0), (4, 4), pad_value=[255, 0]) # HxWxC
+    assert (crop[:2,:,0] == 255).all() and (crop[:2,:,1] == 0).all()
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_T_plane_not_padded(tmp_path, sid_archive, compact):
+    zip_path = sid_archive()
+    dataset = dh.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', channel_per_image=2, T_channel=True,
+                                   crop_size=(150,150), compact=compact, cache_dir=os.path.join(tmp_path, 'frames'))
+    sample = dataset[0]
+    assert (sample['image'][...,-1] == dataset.index.T[0]).all() # the crop is larger than the image
+    assert (sample['image'][0,0,:-1] == 255).all() # padded with free space
+    batch = dataset.get_batch([0, 1])['image'].numpy()
+    assert (batch[:,-1] == dataset.index.T[[0,1]][:,np.newaxis,np.newaxis]).all()
+    assert np.allclose(batch[0], np.moveaxis(np.asarray(sample['image']), 2, 0))
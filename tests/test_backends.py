@@ -0,0 +1,40 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('matplotlib')
+
+from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet, ConvMultiHypoMixtureDensityFit
+from network_manager import NetworkManager
+
+INPUT_SIZE = (64, 64)
+
+@pytest.mark.parametrize('Net', [ConvMultiHypoNet, ConvMixtureDensityNet], ids=lambda Net: Net.__name__)
+def test_script_backend(Net, tmp_path):
+    torch.manual_seed(0)
+    myNet = NetworkManager(Net(3, 2, None, 5, input_size=INPUT_SIZE), loss_function_dict={}, device='cpu', verbose=False)
+    myNet.build_Network()
+    image = torch.rand(3, *INPUT_SIZE)
+    mdn = Net is ConvMixtureDensityNet
+    myNet.compile_Model('eager')
+    reference = myNet.inference(image, mdn=mdn)
+
+    for _ in range(2): # compile, then load from the cache
+        model = myNet.compile_Model('script', example_input=image, cache_dir=str(tmp_path))
+        assert myNet.backend == 'script'
+        assert isinstance(model, torch.jit.ScriptModule)
+        outputs = myNet.inference(image, mdn=mdn)
+        for out, ref in zip(outputs if mdn else [outputs], reference if mdn else [reference]):
+            assert abs(out-ref).max() < 1e-5
+    assert len(list(tmp_path.iterdir())) == 1
+
+def test_script_fit():
+    net = ConvMultiHypoMixtureDensityFit(3, 2, None, num_hypos=5, num_gaus=3, input_size=INPUT_SIZE).eval()
+    assert isinstance(torch.jit.script(net), torch.jit.ScriptModule)
+
+def test_script_with_horizon():
+    # a scripted network with T_embed>0 only takes an image batch, so it raises instead of ignoring T
+    net = ConvMultiHypoNet(3, 2, None, 5, input_size=INPUT_SIZE, T_embed=4).eval()
+    scripted = torch.jit.script(net)
+    with pytest.raises(Exception):
+        scripted(torch.rand(1, 3, *INPUT_SIZE))
+    assert net((torch.rand(2, 3, *INPUT_SIZE), torch.rand(2))).shape == (2, 10)
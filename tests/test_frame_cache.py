@@ -0,0 +1,86 @@
+import os
+import glob
+import json
+import zipfile
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+from skimage import io
+
+from data_handle import data_handler as dh
+from data_handle import data_handler_zip as dhz
+
+def make_rgb_dataset(tmp_path, zip_path):
+    # RGB frames, so that the decoded gray frames are float (not representable as uint8).
+    with zipfile.ZipFile(zip_path) as zf:
+        zf.extractall(tmp_path)
+    rng = np.random.default_rng(0)
+    for img_path in glob.glob(os.path.join(tmp_path, 'SID_T', '*', '*', '*.png')):
+        gray = io.imread(img_path)
+        gray = gray if gray.ndim == 2 else gray[:,:,0]
+        rgb = np.repeat(gray[:,:,np.newaxis], 3, axis=2).astype(np.int16)
+        rgb[:,:,0] += rng.integers(-1, 2, size=gray.shape)
+        io.imsave(img_path, np.clip(rgb, 0, 255).astype(np.uint8), check_contrast=False)
+    return os.path.join(tmp_path, 'SID_T', 'all_data.csv'), os.path.join(tmp_path, 'SID_T')
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_cache_does_not_change_samples(tmp_path, sid_archive, compact):
+    csv_path, root_dir = make_rgb_dataset(tmp_path, sid_archive())
+    kwargs = dict(channel_per_image=2, T_channel=True, compact=compact, index_path=os.path.join(tmp_path, 'index.npz'))
+    dataset = dh.ImageStackDataset(csv_path, root_dir, **kwargs)
+    cached = dh.ImageStackDataset(csv_path, root_dir, cache_bytes=2**24, **kwargs)
+    assert cached.cache.dtype == (np.uint8 if compact else dataset.frame_dtype)
+    for idx in range(len(dataset)):
+        for _ in range(2): # miss, then hit
+            image = cached[idx]['image']
+            assert image.dtype == dataset[idx]['image'].dtype
+            assert (np.asarray(image) == np.asarray(dataset[idx]['image'])).all()
+
+def zip_rgb_dataset(tmp_path, zip_path):
+    csv_path, root_dir = make_rgb_dataset(tmp_path, zip_path)
+    zip_path = os.path.join(tmp_path, 'SID_RGB.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for path in glob.glob(os.path.join(root_dir, '**', '*.*'), recursive=True):
+            zf.write(path, os.path.relpath(path, tmp_path))
+    return zip_path
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_store_does_not_change_samples(tmp_path, sid_archive, compact):
+    zip_path = zip_rgb_dataset(tmp_path, sid_archive())
+    kwargs = dict(channel_per_image=2, T_channel=True, compact=compact, index_path=os.path.join(tmp_path, 'index.npz'))
+    dataset = dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', **kwargs)
+    stored = dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', cache_dir=os.path.join(tmp_path, 'frames'), **kwargs)
+    assert stored.store.frames.dtype == (np.uint8 if compact else dataset.frame_dtype)
+    for idx in range(len(dataset)):
+        assert (np.asarray(stored[idx]['image']) == np.asarray(dataset[idx]['image'])).all()
+    idc = list(range(len(dataset)))
+    assert (stored.get_batch(idc)['image'] == dataset.get_batch(idc)['image']).all()
+
+def test_store_signature(tmp_path, sid_archive):
+    zip_path = zip_rgb_dataset(tmp_path, sid_archive())
+    cache_dir = os.path.join(tmp_path, 'frames')
+    kwargs = dict(index_path=os.path.join(tmp_path, 'index.npz'), cache_dir=cache_dir, compact=True)
+    dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', channel_per_image=2, **kwargs)
+    mtime = os.path.getmtime(os.path.join(cache_dir, 'index.json'))
+    dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', channel_per_image=2, **kwargs) # reused
+    assert os.path.getmtime(os.path.join(cache_dir, 'index.json')) == mtime
+    dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', channel_per_image=2, **{**kwargs, 'compact':False}) # other dtype
+    assert os.path.getmtime(os.path.join(cache_dir, 'index.json')) != mtime
+    signature = dhz.archive_signature(zip_path, 'SID_T/all_data.csv', None, 'SID_T', 2)
+    assert signature != dhz.archive_signature(zip_path, 'SID_T/all_data.csv', None, 'SID_T', 1)
+    assert signature != dhz.archive_signature(zip_path, 'SID_T/all_data.csv', None, 'other', 2)
+
+def test_store_missing_frame(tmp_path, sid_archive):
+    zip_path = zip_rgb_dataset(tmp_path, sid_archive())
+    kwargs = dict(channel_per_image=2, index_path=os.path.join(tmp_path, 'index.npz'), cache_dir=os.path.join(tmp_path, 'frames'))
+    dataset = dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', render_obj=True, **kwargs)
+    assert (dataset.store_ids[dataset.index.frame_ids[:,0::2]] == -1).all() # the rendered object frames are not stored
+    with open(os.path.join(tmp_path, 'frames', 'index.json')) as f: # drop a frame from a valid store
+        index = json.load(f)
+    index['paths'], index['slots'] = index['paths'][1:], index['slots'][1:]
+    with open(os.path.join(tmp_path, 'frames', 'index.json'), 'w') as f:
+        json.dump(index, f)
+    with pytest.raises(KeyError):
+        dhz.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', render_obj=True, **kwargs)
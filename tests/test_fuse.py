@@ -0,0 +1,38 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet, ConvMultiHypoMixtureDensityFit
+
+INPUT_SIZE = (64, 64)
+
+def make_nets():
+    return [ConvMultiHypoNet(3, 2, None, num_components=5, input_size=INPUT_SIZE),
+            ConvMixtureDensityNet(3, 2, None, num_components=5, input_size=INPUT_SIZE),
+            ConvMultiHypoMixtureDensityFit(3, 2, None, num_hypos=5, num_gaus=3, input_size=INPUT_SIZE)]
+
+def forward(net, x):
+    if isinstance(net, ConvMultiHypoMixtureDensityFit):
+        return net(x, device='cpu')
+    return net(x)
+
+@pytest.mark.parametrize('net', make_nets(), ids=lambda net: type(net).__name__)
+def test_fused_matches_eval(net):
+    torch.manual_seed(0)
+    net.train()
+    with torch.no_grad(): # non-trivial running statistics
+        for _ in range(3):
+            forward(net, torch.rand(4, 3, *INPUT_SIZE))
+    net.eval()
+    fused = copy.deepcopy(net).fuse_for_inference()
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in fused.modules())
+
+    x = torch.rand(2, 3, *INPUT_SIZE)
+    with torch.no_grad():
+        outputs, fused_outputs = forward(net, x), forward(fused, x)
+    outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+    fused_outputs = fused_outputs if isinstance(fused_outputs, tuple) else (fused_outputs,)
+    for out, fused_out in zip(outputs, fused_outputs):
+        assert torch.allclose(out, fused_out, atol=1e-4, rtol=1e-4)
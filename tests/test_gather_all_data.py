@@ -0,0 +1,30 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('torch')
+
+from util import utils_data
+from util.utils_benchmark import make_synthetic_tree
+
+def test_bounded_map_order_and_window():
+    submitted = []
+    tasks = (submitted.append(x) or x for x in range(50))
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = utils_data.bounded_map(pool, lambda x: x*x, tasks, window=3)
+        assert next(results) == 0
+        assert len(submitted) <= 4 # the consumed task and the window
+        assert list(results) == [x*x for x in range(1, 50)]
+
+def test_gather_all_data_workers(tmp_path):
+    data_dir = os.path.join(tmp_path, 'data')
+    make_synthetic_tree(data_dir, num_objects=20, num_frames=12)
+    csv = {}
+    for num_workers in [0, 2]:
+        save_dir = os.path.join(tmp_path, str(num_workers))
+        os.makedirs(save_dir)
+        utils_data.gather_all_data(data_dir, past=2, maxT=3, channel_per_image=2, save_dir=save_dir, num_workers=num_workers, verbose=False)
+        with open(os.path.join(save_dir, 'all_data.csv')) as f:
+            csv[num_workers] = f.read()
+    assert csv[0] == csv[2] and csv[0].count('\n') > 20
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnxruntime')
+pytest.importorskip('onnx')
+
+from net_module.net import ConvMultiHypoNet, ConvMixtureDensityNet, ConvMultiHypoMixtureDensityFit
+from net_module.onnx_export import export_onnx, check_parity
+from onnx_network import OnnxNetwork
+
+INPUT_SHAPE = (3, 64, 64)
+
+NETS = {
+    'ConvMultiHypoNet':          lambda T_embed: ConvMultiHypoNet(3, 2, None, 5, input_size=INPUT_SHAPE[1:], T_embed=T_embed),
+    'ConvMixtureDensityNet':     lambda T_embed: ConvMixtureDensityNet(3, 2, None, 5, input_size=INPUT_SHAPE[1:], T_embed=T_embed),
+    'ConvMultiHypoMixtureDensityFit': lambda T_embed: ConvMultiHypoMixtureDensityFit(3, 2, None, num_hypos=5, num_gaus=3,
+                                                                                     input_size=INPUT_SHAPE[1:], T_embed=T_embed),
+}
+
+@pytest.mark.parametrize('T_embed', [0, 4])
+@pytest.mark.parametrize('name', list(NETS))
+def test_onnx_parity(tmp_path, name, T_embed):
+    torch.manual_seed(0)
+    net = NETS[name](T_embed).eval()
+    onnx_path = os.path.join(tmp_path, name+'.onnx')
+    meta = export_onnx(net, onnx_path, INPUT_SHAPE) # exported with a batch of 2
+    onnx_net = OnnxNetwork(onnx_path)
+    assert meta['inputs'] == (['image', 'T'] if T_embed else ['image'])
+
+    rng = np.random.default_rng(0)
+    image = rng.random((5,)+INPUT_SHAPE, dtype=np.float32) # another batch size (dynamic axis)
+    data = (image, rng.integers(1, 10, size=5).astype(np.float32)) if T_embed else image
+    atol = 1e-4
+    assert check_parity(net, onnx_net, data, atol=atol) <= atol
+    outputs = onnx_net.run(data)
+    assert all(out.shape[0] == 5 for out in outputs)
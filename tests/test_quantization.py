@@ -0,0 +1,29 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from net_module.net import ConvMultiHypoNet
+from net_module import quantization
+
+INPUT_SIZE = (64, 64)
+
+def make_samples(n=8):
+    torch.manual_seed(0)
+    return [{'image':torch.rand(3, *INPUT_SIZE), 'label':torch.rand(2)} for _ in range(n)]
+
+def test_quantize_net():
+    engine = 'fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else 'qnnpack'
+    net = ConvMultiHypoNet(3, 2, None, 5, input_size=INPUT_SIZE).eval()
+    qnet = quantization.quantize_net(net, make_samples(), num_samples=8, backend=engine)
+    # the quantized leaky_relu warns on every forward (from C++, not catchable) if inplace=True
+    leaky = [m for m in qnet.modules() if isinstance(m, torch.ao.nn.quantized.LeakyReLU)]
+    assert leaky and not any(m.inplace for m in leaky)
+    image = torch.rand(2, 3, *INPUT_SIZE)
+    with torch.no_grad():
+        assert qnet(image).shape == net(image).shape
+    assert all(m.inplace for m in net.modules() if isinstance(m, torch.nn.LeakyReLU)) # the input network is not modified
+
+def test_sample_batch_needs_tensors():
+    samples = [{'image':s['image'].numpy().transpose(1, 2, 0), 'label':{'x':0., 'y':0.}} for s in make_samples(2)]
+    with pytest.raises(TypeError, match='ToTensor'):
+        quantization.sample_batch(samples, [0, 1])
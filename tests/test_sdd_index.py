@@ -0,0 +1,71 @@
+import io
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('torch')
+from PIL import Image
+
+from data_handle import data_handler_zip as dh
+
+SHAPE = (30, 40) # frames (HxW)
+SCALES = {'vid_a':(60,80), 'vid_b':(90,160)} # original videos (HxW)
+
+def make_sdd_zip(zip_path, root='SDD_T', nc=3, nsamples=4, seed=0):
+    # SDD-like archive: root/video/{H}_{W}.csv, root/video/{t}.png, root/all_data.csv ("t{i}" = "{t}_{x}_{y}")
+    rng = np.random.default_rng(seed)
+    rows, frames = [], {}
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for video, scale in SCALES.items():
+            zf.writestr(f'{root}/{video}/{scale[0]}_{scale[1]}.csv', 'x\n')
+            for t in range(nsamples+nc):
+                frames[video, t] = rng.integers(0, 256, SHAPE, dtype=np.uint8)
+                buffer = io.BytesIO()
+                Image.fromarray(frames[video, t]).save(buffer, format='PNG')
+                zf.writestr(f'{root}/{video}/{t}.png', buffer.getvalue())
+            for k in range(nsamples):
+                row = {f't{i}': f'{k+i}_{rng.uniform(0,scale[1]):.2f}_{rng.uniform(0,scale[0]):.2f}' for i in range(nc)}
+                row.update({'x':rng.uniform(0,10), 'y':rng.uniform(0,10), 'T':1+k%3, 'index':video})
+                rows.append(row)
+        zf.writestr(f'{root}/all_data.csv', pd.DataFrame(rows).to_csv())
+    return pd.DataFrame(rows), frames
+
+def test_sdd_index(tmp_path):
+    zip_path = os.path.join(tmp_path, 'SDD_T.zip')
+    info_frame, frames = make_sdd_zip(zip_path)
+    for _ in range(2): # build, then load the saved index
+        dataset = dh.ImageStackDatasetSDD(zip_path, 'SDD_T/all_data.csv', 'SDD_T', ext='.png', defer_obj_maps=True)
+        assert len(dataset) == len(info_frame)
+        for idx, row in info_frame.iterrows():
+            sample = dataset[idx]
+            steps = [row[f't{i}'].split('_') for i in range(3)]
+            traj = np.array([[float(x), float(y)] for _, x, y in steps])
+            H, W = SCALES[row['index']]
+            assert sample['index'] == row['index']
+            assert np.allclose(sample['traj'], traj)
+            assert np.allclose(sample['obj_coords'], traj * [SHAPE[1]/W, SHAPE[0]/H])
+            assert np.allclose([sample['label']['x'], sample['label']['y']], [row['x'], row['y']])
+            for i, (t, _, _) in enumerate(steps):
+                assert (sample['image'][:,:,i] == frames[row['index'], int(t)]).all()
+    assert os.path.exists(os.path.join(tmp_path, 'SDD_T_index.npz'))
+
+@pytest.mark.parametrize('truncate', [None, 1.5])
+def test_deferred_heatmaps_in_crop(tmp_path, truncate):
+    # the crop (40x40) is larger than the frames (30x40), the heatmaps outside of them are 0
+    import torch
+    from torch.utils.data import default_collate
+    from data_handle.batch_transform import ObjectHeatmaps
+    zip_path = os.path.join(tmp_path, 'SDD_T.zip')
+    make_sdd_zip(zip_path)
+    kwargs = dict(ext='.png', channels_first=True, crop_size=(40,40), obj_truncate=truncate, T_channel=True)
+    eager = dh.ImageStackDatasetSDD(zip_path, 'SDD_T/all_data.csv', 'SDD_T', **kwargs)
+    deferred = dh.ImageStackDatasetSDD(zip_path, 'SDD_T/all_data.csv', 'SDD_T', defer_obj_maps=True, **kwargs)
+    idc = list(range(len(eager)))
+    batch = ObjectHeatmaps(sigmas=eager.obj_sigmas, truncate=truncate)(default_collate([deferred[i] for i in idc]))
+    reference = torch.stack([torch.from_numpy(eager[i]['image']) for i in idc])
+    assert batch['image'].shape == reference.shape
+    assert (reference[:,1:6:2] == 0).any() and (reference[:,1:6:2] > 0.99).any()
+    assert torch.allclose(batch['image'], reference, atol=1e-6)
@@ -0,0 +1,52 @@
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from data_handle import data_handler_zip as dh
+from data_handle.shard_store import export_shards, ShardedIterableDataset
+
+def test_export_shards_compact(tmp_path, sid_archive):
+    zip_path = sid_archive(img_size=(60,60))
+    dataset = dh.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', channel_per_image=2, T_channel=True)
+    shard_dir = os.path.join(tmp_path, 'shards')
+    meta = export_shards(dataset, shard_dir, samples_per_shard=7, batch_size=3, verbose=False)
+    assert meta['image_dtype'] == 'uint8'
+    assert [s['num_samples'] for s in meta['shards']] == [7]*(len(dataset)//7) + ([len(dataset)%7] if len(dataset)%7 else [])
+
+    reference = dataset.get_batch(list(range(len(dataset)))) # float64
+    samples = list(ShardedIterableDataset(shard_dir, shuffle=False))
+    assert len(samples) == len(dataset)
+    for i, sample in enumerate(samples):
+        assert sample['image'].dtype == torch.uint8 and sample['label'].dtype == torch.float32
+        assert (sample['image'].numpy() == reference['image'][i].numpy()).all()
+        assert np.allclose(sample['label'].numpy(), reference['label'][i].numpy())
+        assert sample['index'] == reference['index'][i]
+
+def test_export_empty_dataset(tmp_path):
+    class Empty:
+        def __len__(self):
+            return 0
+    with pytest.raises(ValueError):
+        export_shards(Empty(), os.path.join(tmp_path, 'shards'), verbose=False)
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_equal_split_over_ranks(tmp_path, sid_archive, monkeypatch, shuffle):
+    zip_path = sid_archive(img_size=(60,60))
+    dataset = dh.ImageStackDataset(zip_path, 'SID_T/all_data.csv', 'SID_T', channel_per_image=2, T_channel=True)
+    shard_dir = os.path.join(tmp_path, 'shards')
+    export_shards(dataset, shard_dir, samples_per_shard=5, batch_size=3, verbose=False) # shards of unequal size
+    reference = ShardedIterableDataset(shard_dir, shuffle=False)
+    key = lambda sample: (sample['traj'].numpy().tobytes(), int(sample['time'])) # the samples of a scene
+    remaining = Counter(key(s) for s in reference)
+    world_size = 3
+    for rank in range(world_size):
+        monkeypatch.setattr(ShardedIterableDataset, 'return_world', staticmethod(lambda rank=rank: (rank, world_size)))
+        shards = ShardedIterableDataset(shard_dir, shuffle=shuffle, buffer_size=4)
+        samples = list(shards)
+        assert len(samples) == len(shards) == len(dataset)//world_size
+        remaining.subtract(key(s) for s in samples)
+    assert min(remaining.values()) == 0 # disjoint ranks
@@ -0,0 +1,52 @@
+import os
+import glob
+
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+from skimage import io
+
+from data_handle.sid_raster import SIDRasterizer, WHITE, GRAY, BLACK
+from util import utils_data
+
+def read_gray(img_path):
+    # matplotlib images are RGBA and antialiased, snap them to the three colors of the rasterizer
+    image = io.imread(img_path)[...,:3].mean(axis=-1)
+    colors = np.array([BLACK, GRAY, WHITE])
+    return colors[np.abs(image[...,np.newaxis]-colors).argmin(axis=-1)], image
+
+@pytest.mark.parametrize('dpi', [None, 50])
+def test_numpy_renderer_matches_matplotlib(tmp_path, dpi):
+    utils_data.save_SID_data([1], str(tmp_path), sim_time_per_scene=1, channel_per_image=2, dots_per_inch=dpi)
+    raster = SIDRasterizer(dots_per_inch=dpi)
+    for env_path in sorted(glob.glob(os.path.join(tmp_path, '1', 'env', '*.png')))[::5]:
+        env, _ = read_gray(env_path)
+        assert env.shape == raster.img_size == utils_data.matplotlib_img_size(dpi)
+        assert (env != raster.render_env(1, (-1, -1))).mean() < 0.01 # the edge lines of the matplotlib polygons
+    for obj_path in sorted(glob.glob(os.path.join(tmp_path, '1', 'obj', '*.png')))[::5]:
+        x, y = map(float, os.path.basename(obj_path).split('_')[2:4])
+        obj, ref = read_gray(obj_path)[1]<(BLACK+WHITE)/2, raster.render_obj((x, y))==BLACK # pixels covered by half of the disc
+        assert obj.shape == ref.shape
+        if ref[[0,-1]].any() or ref[:,[0,-1]].any(): # clipped at the border
+            continue
+        assert abs(int(obj.sum())-int(ref.sum())) <= 0.1*ref.sum()
+        assert (obj ^ ref).sum() <= 0.25 * 2*np.pi*raster.radius # a quarter of the rim of the disc
+        centroid = [np.mean(np.nonzero(mask)[::-1], axis=1) for mask in (obj, ref)]
+        assert np.abs(centroid[0]-centroid[1]).max() < 0.25 # px
+
+@pytest.mark.parametrize('dpi', [None, 50])
+def test_render_obj_with_dpi(tmp_path, dpi):
+    pytest.importorskip('torch')
+    from data_handle import data_handler as dh
+    data_dir, save_dir = os.path.join(tmp_path, 'data'), os.path.join(tmp_path, 'SID')
+    utils_data.save_SID_data([1], data_dir, sim_time_per_scene=1, channel_per_image=2, dots_per_inch=dpi, renderer='numpy')
+    utils_data.gen_csv_trackers(data_dir, channel_per_image=2)
+    os.makedirs(save_dir)
+    utils_data.gather_all_data(data_dir, past=2, maxT=3, channel_per_image=2, save_dir=save_dir, verbose=False)
+    kwargs = dict(channel_per_image=2, save_index=False, dots_per_inch=dpi)
+    dataset = dh.ImageStackDataset(os.path.join(save_dir, 'all_data.csv'), data_dir, **kwargs)
+    rendered = dh.ImageStackDataset(os.path.join(save_dir, 'all_data.csv'), data_dir, render_obj=True, **kwargs)
+    assert rendered.img_shape == utils_data.matplotlib_img_size(dpi)
+    for idx in range(0, len(dataset), 7):
+        assert (rendered[idx]['image'] != dataset[idx]['image']).sum() <= 4 # the positions in the image names are rounded
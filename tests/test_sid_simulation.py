@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pytest
+
+from data_handle import sid_object
+
+N = 500 # objects per simulator
+TS, VMAX, STAGGER = 0.2, 1, 0.2
+
+def trajectory_stats(trajs):
+    steps = [np.diff(traj, axis=0) for traj in trajs]
+    turns, lengths = [], []
+    for step in steps:
+        length = np.hypot(step[:,0], step[:,1])
+        moving = step[length>1e-9] # blocked steps have no heading
+        heading = np.arctan2(moving[:,1], moving[:,0])
+        turns.append(np.angle(np.exp(1j*np.diff(heading)))) # wrapped to (-pi, pi]
+        lengths.append(length[length>1e-9])
+    lengths, turns = np.concatenate(lengths), np.concatenate(turns)
+    ends = np.array([traj[-1] for traj in trajs])
+    num_points = np.array([len(traj) for traj in trajs])
+    return {'step_mean':lengths.mean(), 'step_std':lengths.std(),
+            'turn_abs_mean':np.abs(turns).mean(), 'turn_std':turns.std(), 'turn_quantiles':np.percentile(turns, [10,50,90]),
+            'end_mean':ends.mean(axis=0), 'end_std':ends.std(axis=0),
+            'num_points_mean':num_points.mean()}
+
+@pytest.mark.parametrize('map_idx, path_idx', [(1, 1), (1, 2), (1, 3), (2, 3)]) # (2, 3) has a random end
+def test_batched_matches_per_object(map_idx, path_idx):
+    graph = sid_object.Graph(map=map_idx, block=False)
+    random.seed(0)
+    path, dyn_obs_path = graph.get_path(path_idx), graph.get_obs_path(TS) # one path per scene
+    per_object = []
+    for _ in range(N):
+        obj = sid_object.MovingObject(path[0], stagger=STAGGER)
+        obj.run(path, ts=TS, vmax=VMAX, dyn_obs_path=dyn_obs_path)
+        per_object.append(np.array(obj.traj))
+    traj, lengths = sid_object.simulate_objects(np.broadcast_to(path, (N,3,2)), ts=TS, vmax=VMAX, stagger=STAGGER,
+                                                dyn_obs_path=dyn_obs_path, seed=0)
+    batched = [traj[i,:lengths[i]] for i in range(N)]
+    assert not np.isnan(np.concatenate(batched)).any()
+
+    a, b = trajectory_stats(per_object), trajectory_stats(batched)
+    assert b['step_mean'] == pytest.approx(a['step_mean'], rel=0.02)
+    assert b['step_std'] == pytest.approx(a['step_std'], rel=0.05)
+    assert b['turn_abs_mean'] == pytest.approx(a['turn_abs_mean'], rel=0.05)
+    assert b['turn_std'] == pytest.approx(a['turn_std'], rel=0.05)
+    assert np.allclose(b['turn_quantiles'], a['turn_quantiles'], atol=0.02)
+    assert np.allclose(b['end_mean'], a['end_mean'], atol=0.02) # meters
+    assert np.allclose(b['end_std'], a['end_std'], rtol=0.15, atol=0.005)
+    assert b['num_points_mean'] == pytest.approx(a['num_points_mean'], abs=0.5)
+
+def test_archive_one_path_per_scene(tmp_path):
+    # index 11 (map 2, path 3) has a random end, all objects of a scene follow the same path (as in "save_SID_data")
+    import zipfile
+    import pandas as pd
+    from util import utils_data
+    zip_path = str(tmp_path/'SID_T.zip')
+    ends = []
+    for seed in range(3):
+        utils_data.gen_SID_archive([11], zip_path, sim_time_per_scene=12, past=2, maxT=3, img_size=(40,40),
+                                   objects_per_chunk=3, num_workers=0, seed=seed, verbose=False)
+        with zipfile.ZipFile(zip_path) as zf:
+            end_y = [pd.read_csv(zf.open(f'SID_T/{obj_id}/obj/data.csv'))['y'].iloc[-1] for obj_id in range(1, 13)]
+        assert np.std(end_y) < 0.1 # meters
+        ends.append(np.mean(end_y))
+    assert np.ptp(ends) > 0.1 # the end is random per scene